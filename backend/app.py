@@ -1,19 +1,17 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import PlainTextResponse, RedirectResponse, StreamingResponse
 from pydantic import BaseModel
-import random
-import string
-
-# google_servicesから関数をインポート
-from google_services import (
-    step1_get_audio_material_urls,
-    step2_get_latest_folder_url,
-    step3_get_script_email_body,
-    step4_duplicate_document,
-    step5_write_info_to_documents,
-    get_credentials # 認証情報取得関数も念のため（直接は使わないかも）
-)
+from datetime import datetime
+import json
+
+# Google APIのライブラリ (googleapiclient・google_auth_oauthlib) は読み込みに時間がかかるため、
+# google_services・workflow などは使うエンドポイントの中で読み込む。
+# リダイレクトなどGoogle APIを使わないリクエストは、コールドスタート時にその読み込みを待たない。
+from config import settings
+from metrics import render_prometheus
+from url_store import get_url_store
+from jobs import describe_job, get_job_store, start_workflow_job, stream_job_events
 
 app = FastAPI()
 
@@ -34,8 +32,8 @@ app.add_middleware(
 class EchoMessage(BaseModel):
     message: str | None = None
 
-# 短縮URL用のデータ保存（本来はデータベースを使用）
-url_database = {}
+# 短縮URL用のデータ保存は url_store.py の get_url_store() を使う
+# (保存先は URL_STORE_BACKEND で切り替える。初回アクセス時に作成される)
 
 @app.get("/")
 def hello():
@@ -78,10 +76,6 @@ class URLResponse(BaseModel):
     short_url: str
     original_url: str
 
-# 短縮ID生成関数（6文字のランダム文字列）
-def generate_short_id():
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=6))
-
 @app.post("/api/count")
 def count_characters(message: CountMessage):
     print("count")
@@ -100,11 +94,8 @@ def create_short_url(url_request: URLRequest):
     if not original_url.startswith(('http://', 'https://')):
         original_url = 'https://' + original_url
     
-    short_id = generate_short_id()
-    while short_id in url_database:
-        short_id = generate_short_id()
-    
-    url_database[short_id] = original_url
+    # 短縮IDは連番から衝突なしに払い出されるため、空きIDを探す必要はない
+    short_id = get_url_store().create(original_url)
     short_url = f"http://localhost:8000/s/{short_id}" # FastAPIサーバーのポートに注意
     
     return URLResponse(
@@ -116,14 +107,50 @@ def create_short_url(url_request: URLRequest):
 @app.get("/s/{short_id}")
 def redirect_to_original(short_id: str):
     print(f"redirect: {short_id}")
-    if short_id not in url_database:
+    original_url = get_url_store().get(short_id)
+    if original_url is None:
         raise HTTPException(status_code=404, detail="Short URL not found")
-    original_url = url_database[short_id]
     return RedirectResponse(url=original_url)
 
+# 一覧は件数が増えても応答が重くならないよう、カーソル方式でページングする
 @app.get("/api/urls")
-def get_all_urls():
-    return {"urls": url_database}
+def get_all_urls(
+    limit: int = 100,
+    cursor: str | None = None,
+    prefix: str | None = None,
+    created_since: datetime | None = None,
+    format: str = "json",
+):
+    """
+    短縮URLの一覧を返す。
+    limit: 1ページの件数 (最大1000) / cursor: 前ページの next_cursor
+    prefix: 元のURLの前方一致 / created_since: この日時以降に作成されたもののみ
+    format=ndjson を指定すると、cursor以降の全件を1行1件のNDJSONでストリーミングする。
+    """
+    if not 1 <= limit <= 1000:
+        raise HTTPException(status_code=400, detail="limitは1〜1000で指定してください")
+    # isdigit() は「²」なども真になり int() で失敗するため、ASCIIの数字だけを受け付ける
+    if cursor is not None and not (cursor.isascii() and cursor.isdecimal()):
+        raise HTTPException(status_code=400, detail="cursorが不正です")
+    after_seq = int(cursor) if cursor else 0
+    created_since_ts = created_since.timestamp() if created_since else None
+    store = get_url_store()
+
+    if format == "ndjson":
+        def generate_lines():
+            for entry in store.iter_entries(after_seq, prefix, created_since_ts):
+                yield json.dumps(entry, ensure_ascii=False) + "\n"
+        return StreamingResponse(generate_lines(), media_type="application/x-ndjson")
+    if format != "json":
+        raise HTTPException(status_code=400, detail="formatには json または ndjson を指定してください")
+
+    entries = store.list_entries(after_seq, limit, prefix, created_since_ts)
+    next_cursor = str(entries[-1]["seq"]) if len(entries) == limit else None
+    return {
+        "urls": {entry["short_id"]: entry["original_url"] for entry in entries},
+        "entries": entries,
+        "next_cursor": next_cursor,
+    }
 
 # --- デバッグ用エンドポイント ---
 @app.get("/api/test_auth")
@@ -209,14 +236,28 @@ def test_auth():
             "debug": debug_info if 'debug_info' in locals() else {}
         }
 
+@app.get("/api/cache_stats")
+def cache_stats():
+    """認証情報・APIクライアントキャッシュのヒット/ミス数を返すエンドポイント"""
+    from google_clients import get_cache_stats
+    return {"cache_stats": get_cache_stats()}
+
+@app.get("/api/metrics", response_class=PlainTextResponse)
+def metrics():
+    """各STEPとGoogle API呼び出しのメトリクスをPrometheusのテキスト形式で返すエンドポイント"""
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # --- 新しいワークフロー用のコード --- 
 class WorkflowRequest(BaseModel):
     number_of_copies: int # STEP4で複製するドキュメントの数
+    # 冪等キー (任意)。同じキーで再実行すると、完了済みのSTEPと書き込み済みのドキュメントを飛ばして再開する
+    idempotency_key: str | None = None
 
 @app.post("/api/execute_workflow")
 async def execute_workflow(request: WorkflowRequest):
     print("ワークフロー実行リクエスト受信")
-    all_step_results = {}
+    from workflow import StepError, run_workflow
+    from workflow_checkpoints import IdempotencyKeyConflict
 
     try:
         # 認証情報を事前にチェック (オプション)
@@ -224,60 +265,19 @@ async def execute_workflow(request: WorkflowRequest):
         # if not creds or not creds.valid:
         #     raise HTTPException(status_code=503, detail="Google API認証に失敗しました。リフレッシュトークンを確認してください。")
 
-        # STEP1
-        print("STEP1 実行中...")
-        step1_data = step1_get_audio_material_urls()
-        if "エラー:" in step1_data or "見つかりませんでした" in step1_data: # エラー判定を強化
-            print(f"STEP1エラー: {step1_data}")
-            raise HTTPException(status_code=500, detail=f"STEP1処理エラー: {step1_data}")
-        all_step_results["step1_output"] = step1_data
-        print("STEP1 完了")
-
-        # STEP2
-        print("STEP2 実行中...")
-        step2_data = step2_get_latest_folder_url()
-        if "エラー:" in step2_data or "見つかりませんでした" in step2_data:
-            print(f"STEP2エラー: {step2_data}")
-            raise HTTPException(status_code=500, detail=f"STEP2処理エラー: {step2_data}")
-        all_step_results["step2_output"] = step2_data
-        print("STEP2 完了")
-
-        # STEP3
-        print("STEP3 実行中...")
-        step3_data = step3_get_script_email_body()
-        if "エラー:" in step3_data or "見つかりませんでした" in step3_data:
-            print(f"STEP3エラー: {step3_data}")
-            raise HTTPException(status_code=500, detail=f"STEP3処理エラー: {step3_data}")
-        all_step_results["step3_output"] = step3_data
-        print("STEP3 完了")
-
-        # STEP4
-        print(f"STEP4 実行中 (複製数: {request.number_of_copies})...")
-        step4_output_str, duplicated_doc_ids = step4_duplicate_document(request.number_of_copies)
-        if "エラー:" in step4_output_str or "失敗しました" in step4_output_str:
-            print(f"STEP4エラー: {step4_output_str}")
-            raise HTTPException(status_code=500, detail=f"STEP4処理エラー: {step4_output_str}")
-        if not duplicated_doc_ids: # IDリストが空の場合もエラーと見なす
-             print(f"STEP4エラー: 複製されたドキュメントIDが取得できませんでした。出力: {step4_output_str}")
-             raise HTTPException(status_code=500, detail=f"STEP4処理エラー: 複製されたドキュメントIDが取得できませんでした。出力: {step4_output_str}")
-        all_step_results["step4_output"] = step4_output_str
-        all_step_results["step4_duplicated_ids"] = duplicated_doc_ids # デバッグ用にIDも返す
-        print("STEP4 完了")
-
-        # STEP5
-        print("STEP5 実行中...")
-        step5_message = step5_write_info_to_documents(duplicated_doc_ids, step1_data, step2_data, step3_data)
-        if "エラー:" in step5_message:
-            print(f"STEP5エラー: {step5_message}")
-            raise HTTPException(status_code=500, detail=f"STEP5処理エラー: {step5_message}")
-        all_step_results["step5_final_message"] = step5_message
-        print("STEP5 完了")
+        # STEP1〜3とSTEP4は互いに独立しているため並行実行し、STEP5は全ての完了後に実行する
+        print(f"ワークフロー実行中 (複製数: {request.number_of_copies})...")
+        all_step_results = await run_workflow(request.number_of_copies, idempotency_key=request.idempotency_key)
 
         return {
             "message": "ワークフローが正常に完了しました。",
             "details": all_step_results
         }
 
+    except StepError as step_error:
+        raise HTTPException(status_code=500, detail=str(step_error))
+    except IdempotencyKeyConflict as conflict:
+        raise HTTPException(status_code=409, detail=str(conflict))
     except HTTPException as http_exc: # FastAPIのHTTPExceptionを再raise
         raise http_exc 
     except Exception as e:
@@ -287,4 +287,88 @@ async def execute_workflow(request: WorkflowRequest):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"ワークフロー実行中に予期せぬサーバーエラーが発生しました: {str(e)}")
 
+# --- 複数の出力先 (番組) をまとめて実行するワークフローAPI ---
+class WorkflowTargetRequest(BaseModel):
+    name: str # 出力先 (番組) の名前。結果はこの名前ごとに返す
+    number_of_copies: int
+    # 省略した項目は .env の設定 (DOC_ID_FOR_STEP4 など) を使う
+    template_doc_id: str | None = None
+    drive_folder_id: str | None = None
+    gmail_query_audio: str | None = None
+    gmail_query_script: str | None = None
+
+class MultiWorkflowRequest(BaseModel):
+    # 省略した場合は WORKFLOW_DEFINITION_PATH のJSONファイルの定義を使う
+    targets: list[WorkflowTargetRequest] | None = None
+    idempotency_key: str | None = None
+
+@app.post("/api/execute_workflows")
+async def execute_workflows(request: MultiWorkflowRequest):
+    print("複数出力先のワークフロー実行リクエスト受信")
+    from workflow import StepError, run_workflow_targets
+    from workflow_checkpoints import IdempotencyKeyConflict
+    from workflow_targets import WorkflowTarget, load_workflow_definition, validate_targets
+
+    try:
+        if request.targets is None:
+            targets = load_workflow_definition()
+        else:
+            targets = [
+                WorkflowTarget.from_dict(target.model_dump(), index) for index, target in enumerate(request.targets)
+            ]
+            validate_targets(targets)
+    except (OSError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"出力先の定義が不正です: {e}")
+
+    try:
+        print(f"ワークフロー実行中 (出力先: {', '.join(t.name for t in targets)})...")
+        results = await run_workflow_targets(targets, idempotency_key=request.idempotency_key)
+        return {
+            "message": "ワークフローが正常に完了しました。",
+            "targets": results,
+        }
+    except IdempotencyKeyConflict as conflict:
+        raise HTTPException(status_code=409, detail=str(conflict))
+    except StepError as step_error:
+        raise HTTPException(status_code=500, detail=str(step_error))
+    except Exception as e:
+        print(f"ワークフロー実行中に予期せぬエラー: {e}")
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"ワークフロー実行中に予期せぬサーバーエラーが発生しました: {str(e)}")
+
+# --- 非同期ジョブ版のワークフローAPI ---
+# POSTはすぐにジョブIDを返し、ワークフローはバックグラウンドで実行される。
+# 進捗は GET /api/jobs/{job_id} のポーリングか、/api/jobs/{job_id}/events のSSEで取得する。
+@app.post("/api/jobs", status_code=202)
+def create_workflow_job(request: WorkflowRequest):
+    print("ワークフロージョブ登録リクエスト受信")
+    if not settings.job_mode_enabled:
+        # 呼び出し側は /api/execute_workflow (同期実行) を使う
+        raise HTTPException(status_code=503, detail="ジョブモードは無効です (JOB_MODE_ENABLED)。/api/execute_workflow を使ってください。")
+    if request.number_of_copies <= 0:
+        raise HTTPException(status_code=400, detail="複製数は1以上である必要があります。")
+    job = start_workflow_job(request.number_of_copies, request.idempotency_key)
+    return {"job_id": job["id"], "status": job["status"]}
+
+@app.get("/api/jobs/{job_id}")
+def get_workflow_job(job_id: str):
+    job = get_job_store().get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません")
+    return describe_job(job)
+
+@app.get("/api/jobs/{job_id}/events")
+def stream_workflow_job_events(job_id: str, request: Request):
+    if get_job_store().get_job(job_id) is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません")
+    # 再接続時はLast-Event-ID以降のイベントから送る
+    last_event_id = request.headers.get("last-event-id", "0")
+    after_seq = int(last_event_id) if last_event_id.isdigit() else 0
+    return StreamingResponse(
+        stream_job_events(job_id, after_seq),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
 # uvicorn app:app --reload --port 8000 で起動する場合の参考
\ No newline at end of file
@@ -0,0 +1,155 @@
+"""
+ワークフロー実行中のイベントループの応答性の負荷試験。
+uvicornでアプリを起動し、偽トランスポート (fake_google) に対して /api/execute_workflow を同時に複数実行しながら、
+短縮URLのリダイレクト (/s/{short_id}) を繰り返し呼び、その応答時間の分布 (p50/p99/最大) を記録する。
+
+・idle: ワークフローを実行していない時
+・workflow: /api/execute_workflow (STEPはスレッドプールで実行され、イベントループは止まらない)
+・blocking (--include-blocking): 比較用に、同期のSTEP関数をイベントループ上で直接呼ぶエンドポイント
+
+使い方 (backendディレクトリで実行):
+    python -m benchmarks.bench_event_loop
+    python -m benchmarks.bench_event_loop --workflows 8 --copies 10 --latency 0.05 --include-blocking
+"""
+import argparse
+import datetime
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+import httpx
+import uvicorn
+
+import google_services
+from app import WorkflowRequest, app
+from config import settings
+from benchmarks.bench_workflow import install_fake_backend
+from benchmarks.fake_google import FakeGoogleBackend
+
+@app.post("/bench/blocking_workflow")
+async def blocking_workflow(request: WorkflowRequest):
+    """比較用: STEP関数をイベントループのスレッドで順に呼ぶ (ループはその間止まる)。"""
+    step1 = google_services.step1_get_audio_material_urls()
+    step2 = google_services.step2_get_latest_folder_url()
+    step3 = google_services.step3_get_script_email_body()
+    _, doc_ids = google_services.step4_duplicate_document(request.number_of_copies)
+    return {"step5_final_message": google_services.step5_write_info_to_documents(doc_ids, step1, step2, step3)}
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server() -> tuple:
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread, f"http://127.0.0.1:{port}"
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def summarize(latencies: list) -> dict:
+    return {
+        "requests": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2),
+    }
+
+def probe_redirects(base_url: str, short_id: str, stop: threading.Event, interval: float) -> list:
+    """stop が立つまでリダイレクトを1件ずつ呼び、応答時間のリストを返す。"""
+    latencies = []
+    with httpx.Client(base_url=base_url, follow_redirects=False, timeout=120) as client:
+        while not stop.is_set():
+            started = time.perf_counter()
+            response = client.get(f"/s/{short_id}")
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code in (302, 307), response.status_code
+            time.sleep(interval)
+    return latencies
+
+def measure_phase(base_url: str, short_id: str, path: str | None, workflows: int, copies: int,
+                  idle_seconds: float, interval: float) -> dict:
+    """path のワークフローを workflows 件同時に実行している間のリダイレクトの応答時間を測る。"""
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=workflows + 1) as executor:
+        probe = executor.submit(probe_redirects, base_url, short_id, stop, interval)
+        started = time.perf_counter()
+        if path is None:
+            time.sleep(idle_seconds)
+            statuses = []
+        else:
+            def post(_):
+                with httpx.Client(base_url=base_url, timeout=600) as client:
+                    return client.post(path, json={"number_of_copies": copies}).status_code
+            statuses = list(executor.map(post, range(workflows)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        latencies = probe.result()
+    return {"wall_seconds": round(elapsed, 3), "workflow_statuses": statuses, "redirect": summarize(latencies)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ワークフロー実行中のリダイレクトの応答時間の負荷試験")
+    parser.add_argument("--workflows", type=int, default=4, help="同時に実行するワークフロー数")
+    parser.add_argument("--copies", type=int, default=10, help="1回のワークフローの複製数")
+    parser.add_argument("--thread-size", type=int, default=50, help="Gmailスレッドのメッセージ数")
+    parser.add_argument("--latency", type=float, default=0.05, help="全APIの1往復あたりの遅延 (秒)")
+    parser.add_argument("--interval", type=float, default=0.01, help="リダイレクトを呼ぶ間隔 (秒)")
+    parser.add_argument("--idle-seconds", type=float, default=3.0, help="idleの測定時間 (秒)")
+    parser.add_argument("--include-blocking", action="store_true", help="イベントループを止める比較用の実装も測定する")
+    parser.add_argument("--output", default="bench_event_loop_results.json", help="結果を書き出すJSONファイル")
+    args = parser.parse_args(argv)
+
+    # 偽トランスポートに対して測るため、Google APIのレート制限は無効にする
+    for name in ("gmail_api_units_per_second", "drive_api_reads_per_second", "drive_api_writes_per_second",
+                 "docs_api_reads_per_second", "docs_api_writes_per_second"):
+        setattr(settings, name, 0)
+    settings.url_store_backend = "sqlite"
+    settings.url_store_sqlite_path = os.path.join(tempfile.mkdtemp(), "bench_urls.sqlite3")
+    install_fake_backend(FakeGoogleBackend(thread_size=args.thread_size, latency=args.latency))
+
+    server, thread, base_url = start_server()
+    try:
+        with httpx.Client(base_url=base_url) as client:
+            short_id = client.post("/api/shorten", json={"url": "https://example.com/"}).json()["short_id"]
+
+        phases = {"idle": measure_phase(base_url, short_id, None, 0, 0, args.idle_seconds, args.interval)}
+        print(f"idle: {phases['idle']}")
+        phases["workflow"] = measure_phase(
+            base_url, short_id, "/api/execute_workflow", args.workflows, args.copies, 0, args.interval)
+        print(f"workflow: {phases['workflow']}")
+        if args.include_blocking:
+            phases["blocking"] = measure_phase(
+                base_url, short_id, "/bench/blocking_workflow", args.workflows, args.copies, 0, args.interval)
+            print(f"blocking: {phases['blocking']}")
+    finally:
+        server.should_exit = True
+        thread.join()
+
+    report = {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "workflows": args.workflows,
+        "copies": args.copies,
+        "latency": args.latency,
+        "phases": phases,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"ベンチマーク結果を {args.output} に書き出しました。")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+複数の出力先 (番組) をまとめて実行するワークフローのベンチマーク。
+偽トランスポート (fake_google) に対して、番組数ごとに
+・engine: run_workflow_targets で全番組を1回の実行にまとめた場合
+・sequential: 番組ごとに run_workflow を順に実行した場合 (従来の使い方)
+の所要時間とAPIの往復回数を測定し、JSONで書き出す。
+全番組で検索条件 (Gmailのクエリ・素材フォルダ) は共通にし、テンプレートは番組ごとに別にする。
+
+使い方 (backendディレクトリで実行):
+    python -m benchmarks.bench_multi_target
+    python -m benchmarks.bench_multi_target --targets 1 5 10 --copies 2 --latency 0.05 --no-rate-limit
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+from config import settings
+from workflow import run_workflow_targets
+from workflow_targets import WorkflowTarget
+from benchmarks.bench_workflow import install_fake_backend, measure
+from benchmarks.fake_google import FakeGoogleBackend
+
+def make_targets(count: int, copies: int) -> list:
+    return [
+        WorkflowTarget(f"show{i + 1:02d}", copies, template_doc_id=f"1TeMpLaTeDoCfOrShOw{i + 1:02d}000000000000000")
+        for i in range(count)
+    ]
+
+def bench_targets(target_counts, copies: int, latency, thread_size: int) -> list:
+    results = []
+    for count in target_counts:
+        targets = make_targets(count, copies)
+        for mode in ("engine", "sequential"):
+            backend = FakeGoogleBackend(thread_size=thread_size, latency=latency)
+            install_fake_backend(backend)
+            if mode == "engine":
+                func = lambda: asyncio.run(run_workflow_targets(targets))
+            else:
+                func = lambda: [asyncio.run(run_workflow_targets([target])) for target in targets]
+            result = measure(func, backend)
+            results.append({"mode": mode, "targets": count, "copies": copies, **result})
+            print(f"{mode} (番組数 {count}): {result['wall_seconds']:.3f}秒, 往復 {result['round_trips']} 回")
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="複数の出力先をまとめて実行するワークフローのベンチマーク")
+    parser.add_argument("--targets", type=int, nargs="+", default=[1, 10], help="番組数")
+    parser.add_argument("--copies", type=int, default=1, help="番組ごとの複製数")
+    parser.add_argument("--thread-size", type=int, default=50, help="Gmailスレッドのメッセージ数")
+    parser.add_argument("--latency", type=float, default=0.05, help="全APIの1往復あたりの遅延 (秒)")
+    parser.add_argument("--no-rate-limit", action="store_true", help="google_api_policy のレート制限を無効にする")
+    parser.add_argument("--output", default="bench_multi_target_results.json", help="結果を書き出すJSONファイル")
+    args = parser.parse_args(argv)
+
+    if args.no_rate_limit:
+        for name in ("gmail_api_units_per_second", "drive_api_reads_per_second", "drive_api_writes_per_second",
+                     "docs_api_reads_per_second", "docs_api_writes_per_second"):
+            setattr(settings, name, 0)
+
+    report = {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "latency": args.latency,
+        "thread_size": args.thread_size,
+        "rate_limit": not args.no_rate_limit,
+        "results": bench_targets(args.targets, args.copies, args.latency, args.thread_size),
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"ベンチマーク結果を {args.output} に書き出しました。")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+コールドスタート (新しいPythonプロセスでの起動) のベンチマーク。
+・python -X importtime で app を読み込み、モジュールごとの読み込み時間 (自身のみ / 依存を含む累計) を記録する。
+・新しいプロセスで app の読み込みから最初のリクエスト (/api/hello とリダイレクト) の応答までの時間と、
+  ワークフロー用のモジュール (workflow → google_services → googleapiclient) を初めて読み込む時間を測る。
+Google APIのライブラリはワークフローのエンドポイントで初めて読み込まれるため、
+app の読み込み時点では googleapiclient などが読み込まれていないことも確認する。
+
+使い方 (backendディレクトリで実行):
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --repeat 10 --top 30
+"""
+import argparse
+import datetime
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 起動時に読み込まれていないはずのモジュール (ワークフローを実行するまで読み込まない)
+LAZY_MODULES = ("googleapiclient", "google_auth_oauthlib", "google_services", "workflow", "google_clients")
+
+_FIRST_REQUEST_SCRIPT = r"""
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+client = TestClient(app.app)
+client.get("/api/hello")
+hello = time.perf_counter()
+short_id = client.post("/api/shorten", json={"url": "https://example.com/"}).json()["short_id"]
+client.get(f"/s/{short_id}", follow_redirects=False)
+redirected = time.perf_counter()
+loaded_lazy = sorted({name.split(".")[0] for name in sys.modules} & set(LAZY_MODULES))
+lazy_started = time.perf_counter()
+import workflow
+workflow_imported = time.perf_counter()
+print(json.dumps({
+    "import_app_ms": (imported - started) * 1000,
+    "first_hello_ms": (hello - started) * 1000,
+    "first_redirect_ms": (redirected - hello) * 1000,
+    "import_workflow_ms": (workflow_imported - lazy_started) * 1000,
+    "lazy_modules_loaded_at_startup": loaded_lazy,
+}))
+"""
+
+_IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+def _env(tmpdir: str) -> dict:
+    env = dict(os.environ)
+    env["URL_STORE_SQLITE_PATH"] = os.path.join(tmpdir, "bench_urls.sqlite3")
+    env["URL_STORE_BACKEND"] = "sqlite"
+    return env
+
+def measure_import_times(tmpdir: str) -> list:
+    """app を読み込んだ時のモジュールごとの読み込み時間 (ミリ秒)。"""
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=BACKEND_DIR, env=_env(tmpdir), capture_output=True, text=True, check=True,
+    )
+    modules = []
+    for line in completed.stderr.splitlines():
+        match = _IMPORTTIME_RE.match(line)
+        if match:
+            modules.append({
+                "module": match.group(4),
+                "self_ms": int(match.group(1)) / 1000,
+                "cumulative_ms": int(match.group(2)) / 1000,
+                "depth": len(match.group(3)) // 2,
+            })
+    return modules
+
+def measure_first_request(tmpdir: str) -> dict:
+    script = f"LAZY_MODULES = {LAZY_MODULES!r}\n" + _FIRST_REQUEST_SCRIPT
+    completed = subprocess.run(
+        [sys.executable, "-c", script], cwd=BACKEND_DIR, env=_env(tmpdir), capture_output=True, text=True, check=True,
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="コールドスタートのベンチマーク")
+    parser.add_argument("--repeat", type=int, default=5, help="新しいプロセスで測定する回数 (中央値を記録)")
+    parser.add_argument("--top", type=int, default=20, help="記録する読み込み時間の上位モジュール数")
+    parser.add_argument("--output", default="bench_startup_results.json", help="結果を書き出すJSONファイル")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # 1回目は .pyc の作成などを含むため捨てる
+        measure_first_request(tmpdir)
+        runs = [measure_first_request(tmpdir) for _ in range(args.repeat)]
+        modules = measure_import_times(tmpdir)
+
+    summary = {
+        key: round(statistics.median(run[key] for run in runs), 2)
+        for key in ("import_app_ms", "first_hello_ms", "first_redirect_ms", "import_workflow_ms")
+    }
+    summary["lazy_modules_loaded_at_startup"] = runs[-1]["lazy_modules_loaded_at_startup"]
+    # トップレベル (depth 1) のモジュールごとの累計。app 自身の読み込みのうち、どこに時間がかかっているか
+    top_level = sorted((m for m in modules if m["depth"] == 1), key=lambda m: m["cumulative_ms"], reverse=True)
+    print(f"起動: {summary}")
+    for module in top_level[:10]:
+        print(f"  {module['module']}: {module['cumulative_ms']:.1f}ms")
+
+    report = {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "summary": summary,
+        "runs": runs,
+        "top_level_modules": top_level,
+        "slowest_modules": sorted(modules, key=lambda m: m["self_ms"], reverse=True)[:args.top],
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"ベンチマーク結果を {args.output} に書き出しました。")
+
+if __name__ == "__main__":
+    main()
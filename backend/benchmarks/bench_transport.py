@@ -0,0 +1,121 @@
+"""
+HTTPトランスポートのベンチマーク。
+ローカルのHTTP/1.1サーバーに、STEPを模した「スレッドプールを作って並行にリクエストを送る」処理を繰り返し、
+google_transport の各トランスポートで所要時間とサーバー側で受け付けた接続数を比べる。
+httplib2 はこれまでと同じくスレッドごとに Http を作るため、プールのスレッドが変わるたびに接続し直す。
+実際のGoogle APIではこの接続ごとにTLSハンドシェイクが加わる。
+
+使い方 (backendディレクトリで実行):
+    python -m benchmarks.bench_transport
+    python -m benchmarks.bench_transport --steps 20 --requests-per-step 20 --workers 8
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+from google.oauth2.credentials import Credentials
+
+import google_transport
+from config import settings
+
+_RESPONSE_BODY = json.dumps({"id": "1AbCdEf", "name": "指示書"}, ensure_ascii=False).encode("utf-8")
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def _respond(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(_RESPONSE_BODY)))
+        self.end_headers()
+        self.wfile.write(_RESPONSE_BODY)
+
+    do_GET = do_POST = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.connections = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run(transport: str, url: str, steps: int, requests_per_step: int, workers: int) -> float:
+    settings.google_http_transport = transport
+    google_transport.close_sessions()
+    creds = Credentials(token="fake-token", expiry=datetime.datetime.utcnow() + datetime.timedelta(days=1))
+    shared_http = google_transport.create_http(creds)
+    local = threading.local()
+
+    def http_for_thread():
+        # スレッドセーフでないトランスポートは、google_clients と同じくスレッドごとに作る
+        if google_transport.is_thread_safe(shared_http):
+            return shared_http
+        if not hasattr(local, "http"):
+            local.http = google_transport.create_http(creds)
+        return local.http
+
+    def call(_):
+        response, _content = http_for_thread().request(url, "GET")
+        assert response.status == 200
+
+    started = time.perf_counter()
+    for _ in range(steps):
+        # 各STEPと同じく、呼び出しごとに新しいスレッドプールを作る
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(call, range(requests_per_step)))
+    return time.perf_counter() - started
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HTTPトランスポートの接続の再利用のベンチマーク")
+    parser.add_argument("--steps", type=int, default=10, help="スレッドプールを作り直す回数")
+    parser.add_argument("--requests-per-step", type=int, default=20, help="1回のスレッドプールで送るリクエスト数")
+    parser.add_argument("--workers", type=int, default=8, help="スレッドプールのワーカー数")
+    parser.add_argument("--transports", nargs="+", default=["httplib2", "requests"], help="比較するトランスポート")
+    parser.add_argument("--output", default="bench_transport_results.json", help="結果を書き出すJSONファイル")
+    args = parser.parse_args(argv)
+
+    results = []
+    for transport in args.transports:
+        server = start_server()
+        url = f"http://127.0.0.1:{server.server_address[1]}/drive/v3/files/1AbCdEf"
+        seconds = run(transport, url, args.steps, args.requests_per_step, args.workers)
+        results.append({
+            "transport": transport,
+            "requests": args.steps * args.requests_per_step,
+            "seconds": round(seconds, 6),
+            "connections": server.connections,
+        })
+        server.shutdown()
+        print(results[-1])
+    google_transport.close_sessions()
+
+    report = {"created_at": datetime.datetime.now().isoformat(timespec="seconds"), "results": results}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"ベンチマーク結果を {args.output} に書き出しました。")
+
+if __name__ == "__main__":
+    main()
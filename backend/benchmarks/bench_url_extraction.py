@@ -0,0 +1,89 @@
+"""
+URL抽出のベンチマーク。
+返信ごとにそれまでの履歴を「>」付きで引用する長いスレッドの本文 (数MB) を作り、
+従来の re.findall + set による抽出と url_extraction.extract_urls の所要時間・抽出件数を比べる。
+skip_quoted は STEP1 と同じく gmail_quotes.iter_new_content で引用された履歴を除いてから抽出した場合。
+
+使い方 (backendディレクトリで実行):
+    python -m benchmarks.bench_url_extraction
+    python -m benchmarks.bench_url_extraction --replies 50 100 200 --repeat 5
+"""
+import argparse
+import datetime
+import json
+import os
+import re
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+from gmail_quotes import iter_new_content
+from url_extraction import extract_urls
+
+DEFAULT_REPLY_COUNTS = [10, 50, 100, 200]
+
+_LEGACY_URL_RE = re.compile(r'https?://[\S]+')
+
+def legacy_extract_urls(text: str) -> list:
+    """変更前の extract_urls_from_text と同じ処理。"""
+    return list(set(_LEGACY_URL_RE.findall(text)))
+
+def build_thread_bodies(replies: int) -> list:
+    """各メッセージの本文のリストを返す。n通目はそれまでの全履歴を引用する。"""
+    bodies = []
+    previous = ""
+    for i in range(replies + 1):
+        text = (
+            f"お疲れさまです。{i}本目の音声素材です：https://drive.google.com/file/d/1AuDiO{i:04d}xxxxxxxxxxxxxxxx/view?usp=sharing、"
+            f"差し替え版は（https://app.box.com/s/rEpLaCe{i:04d}）にあります。\n"
+            f"参考: https://www.google.com/url?q=https://example.com/notes/{i}&sa=D。\n"
+        )
+        if previous:
+            quoted = "\n".join("> " + line for line in previous.splitlines())
+            text += f"\n2024年6月17日(月) 14:{i % 60:02d} 音声担当 <audio@example.com>:\n{quoted}\n"
+        bodies.append(text)
+        previous = text
+    return bodies
+
+def measure(func, bodies, repeat: int, skip_quoted: bool = False) -> dict:
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        found = {}
+        for body in (iter_new_content(bodies) if skip_quoted else bodies):
+            for url in func(body):
+                found.setdefault(url, None)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {"seconds": round(best, 6), "unique_urls": len(found)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="長い引用スレッドでのURL抽出のベンチマーク")
+    parser.add_argument("--replies", type=int, nargs="+", default=DEFAULT_REPLY_COUNTS, help="スレッドの返信数")
+    parser.add_argument("--repeat", type=int, default=3, help="各条件の試行回数 (最速値を記録)")
+    parser.add_argument("--output", default="bench_url_extraction_results.json", help="結果を書き出すJSONファイル")
+    args = parser.parse_args(argv)
+
+    results = []
+    for replies in args.replies:
+        bodies = build_thread_bodies(replies)
+        size = sum(len(body.encode("utf-8")) for body in bodies)
+        results.append({
+            "replies": replies,
+            "thread_bytes": size,
+            "legacy": measure(legacy_extract_urls, bodies, args.repeat),
+            "extract_urls": measure(extract_urls, bodies, args.repeat),
+            "skip_quoted": measure(extract_urls, bodies, args.repeat, skip_quoted=True),
+        })
+        print(f"返信数 {replies} ({size / 1_000_000:.1f}MB): {results[-1]}")
+
+    report = {"created_at": datetime.datetime.now().isoformat(timespec="seconds"), "results": results}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"ベンチマーク結果を {args.output} に書き出しました。")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+記録済みフィクスチャを使ったワークフローのベンチマーク。
+実際のGoogleアカウントなしで、各STEP関数と execute_workflow 全体の
+所要時間・CPU時間・APIの往復回数を測定し、JSONで書き出す。
+
+使い方 (backendディレクトリで実行):
+    python -m benchmarks.bench_workflow
+    python -m benchmarks.bench_workflow --copies 1 10 50 --thread-sizes 1 50 200 --latency 0.05
+    python -m benchmarks.bench_workflow --latency-json '{"gmail": 0.08, "drive.files.copy": 0.3}'
+    python -m benchmarks.bench_workflow --quota-json '{"drive.files.copy": 3}' --copies 50 --skip-workflow
+    python -m benchmarks.bench_workflow --step5-write-mode placeholders
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+from google.oauth2.credentials import Credentials
+
+import google_clients
+import google_services
+from config import settings
+from doc_pool import get_document_pool
+from drive_folder_index import get_folder_index
+from gmail_cache import gmail_search_cache
+from google_api_policy import reset_rate_limiters
+from template_cache import template_cache
+from benchmarks.fake_google import FakeGoogleBackend, FakeHttp
+
+DEFAULT_COPY_COUNTS = [1, 5, 20, 50, 100]
+DEFAULT_THREAD_SIZES = [1, 10, 50, 100, 200]
+
+def install_fake_backend(backend: FakeGoogleBackend):
+    """google_clientsのトランスポートと認証情報を偽物に差し替える。"""
+    settings.drive_folder_id_step2 = settings.drive_folder_id_step2 or "1PaReNtFoLdErStEp2000000000000"
+    settings.doc_id_for_step4 = settings.doc_id_for_step4 or "1TeMpLaTeDoC00000000000000000000000000000"
+    creds = Credentials(
+        token="fake-token",
+        expiry=datetime.datetime.utcnow() + datetime.timedelta(days=1),
+    )
+    google_clients.set_credentials(creds)
+    google_clients.set_http_factory(lambda _creds: FakeHttp(backend))
+    # 前の条件で測定したGmail検索結果・フォルダ索引・テンプレート情報・プールの在庫を持ち越さない
+    gmail_search_cache.clear()
+    get_folder_index(settings.drive_folder_id_step2).clear()
+    template_cache.clear()
+    reset_rate_limiters()
+    pool = get_document_pool()
+    if pool:
+        pool.clear()
+
+def measure(func, backend: FakeGoogleBackend) -> dict:
+    """func を1回実行し、所要時間・CPU時間・ルートごとの往復回数を返す。"""
+    backend.reset_round_trips()
+    wall_started = time.perf_counter()
+    cpu_started = time.process_time()
+    output = func()
+    cpu_seconds = time.process_time() - cpu_started
+    wall_seconds = time.perf_counter() - wall_started
+    round_trips = dict(backend.round_trips)
+    return {
+        "wall_seconds": round(wall_seconds, 6),
+        "cpu_seconds": round(cpu_seconds, 6),
+        "round_trips": sum(round_trips.values()),
+        "round_trips_by_route": round_trips,
+        "rate_limited": sum(backend.rate_limited.values()),
+        "output_chars": len(output if isinstance(output, str) else json.dumps(output, ensure_ascii=False)),
+    }
+
+def prewarm_document_pool():
+    """ドキュメントプールが有効なら、測定前に在庫を満たしておく。"""
+    pool = get_document_pool()
+    if pool:
+        template = template_cache.describe(google_clients.get_service('drive', 'v3'), settings.doc_id_for_step4)
+        pool.wait_for_refill()
+        pool.refill(template)
+
+def wait_for_document_pool():
+    """STEP4の後に始まったプールの補充を、次の測定に含めないよう待つ。"""
+    pool = get_document_pool()
+    if pool:
+        pool.wait_for_refill()
+
+def bench_steps(thread_sizes, copy_counts, latency, quota) -> list:
+    """各STEP関数を単体で測定する。STEP1/STEP3はスレッドサイズ、STEP4/STEP5は複製数ごと。"""
+    results = []
+    for thread_size in thread_sizes:
+        backend = FakeGoogleBackend(thread_size=thread_size, latency=latency, quota=quota)
+        install_fake_backend(backend)
+        for step_name, func in (
+            ("STEP1", google_services.step1_get_audio_material_urls),
+            ("STEP3", google_services.step3_get_script_email_body),
+        ):
+            results.append({"step": step_name, "thread_size": thread_size, **measure(func, backend)})
+
+    backend = FakeGoogleBackend(thread_size=1, latency=latency, quota=quota)
+    install_fake_backend(backend)
+    results.append({"step": "STEP2", **measure(google_services.step2_get_latest_folder_url, backend)})
+
+    for copies in copy_counts:
+        prewarm_document_pool()
+        result = measure(lambda: google_services.step4_duplicate_document(copies), backend)
+        results.append({"step": "STEP4", "copies": copies, **result})
+
+        _, doc_ids = google_services.step4_duplicate_document(copies)
+        wait_for_document_pool()
+        result = measure(
+            lambda: google_services.step5_write_info_to_documents(doc_ids, "STEP1", "STEP2", "STEP3"),
+            backend,
+        )
+        results.append({"step": "STEP5", "copies": copies, **result})
+    return results
+
+def bench_workflow(thread_sizes, copy_counts, latency, quota) -> list:
+    """execute_workflow エンドポイント全体を測定する。"""
+    from app import WorkflowRequest, execute_workflow
+
+    results = []
+    for thread_size in thread_sizes:
+        backend = FakeGoogleBackend(thread_size=thread_size, latency=latency, quota=quota)
+        install_fake_backend(backend)
+        for copies in copy_counts:
+            prewarm_document_pool()
+            request = WorkflowRequest(number_of_copies=copies)
+            result = measure(lambda: asyncio.run(execute_workflow(request)), backend)
+            results.append({"thread_size": thread_size, "copies": copies, **result})
+            wait_for_document_pool()
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="記録済みフィクスチャによるワークフローのベンチマーク")
+    parser.add_argument("--copies", type=int, nargs="+", default=DEFAULT_COPY_COUNTS, help="STEP4/STEP5の複製数")
+    parser.add_argument("--thread-sizes", type=int, nargs="+", default=DEFAULT_THREAD_SIZES, help="Gmailスレッドのメッセージ数")
+    parser.add_argument("--latency", type=float, default=0.0, help="全APIの1往復あたりの遅延 (秒)")
+    parser.add_argument("--latency-json", help='ルート名/API名ごとの遅延 (例: \'{"gmail": 0.05, "drive.files.copy": 0.3}\')')
+    parser.add_argument("--quota-json", help='ルート名/API名ごとの1秒あたりの上限回数。超えると429を返す (例: \'{"drive.files.copy": 3}\')')
+    parser.add_argument("--no-rate-limit", action="store_true", help="google_api_policy のレート制限を無効にする (再試行は有効)")
+    parser.add_argument("--output", default="bench_workflow_results.json", help="結果を書き出すJSONファイル")
+    parser.add_argument("--skip-workflow", action="store_true", help="execute_workflow全体の測定を省略する")
+    parser.add_argument("--doc-pool-size", type=int, default=0, help="STEP4のドキュメントプールの在庫数 (0で無効)")
+    parser.add_argument("--step5-write-mode", choices=("auto", "append", "placeholders"),
+                        help="STEP5の書き込み方法 (省略時は STEP5_WRITE_MODE の設定)")
+    args = parser.parse_args(argv)
+
+    if args.step5_write_mode:
+        settings.step5_write_mode = args.step5_write_mode
+
+    if args.doc_pool_size > 0:
+        settings.doc_pool_size = args.doc_pool_size
+        settings.doc_pool_folder_id = settings.doc_pool_folder_id or "1PoOlStAgInGfOlDeR000000000000"
+
+    if args.no_rate_limit:
+        for name in ("gmail_api_units_per_second", "drive_api_reads_per_second", "drive_api_writes_per_second",
+                     "docs_api_reads_per_second", "docs_api_writes_per_second"):
+            setattr(settings, name, 0)
+
+    latency = json.loads(args.latency_json) if args.latency_json else args.latency
+    quota = json.loads(args.quota_json) if args.quota_json else None
+
+    report = {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "latency": latency,
+        "doc_pool_size": args.doc_pool_size,
+        "step5_write_mode": settings.step5_write_mode,
+        "quota": quota,
+        "rate_limit": not args.no_rate_limit,
+        "steps": bench_steps(args.thread_sizes, args.copies, latency, quota),
+    }
+    if not args.skip_workflow:
+        report["workflow"] = bench_workflow(args.thread_sizes, args.copies, latency, quota)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"ベンチマーク結果を {args.output} に書き出しました。")
+
+if __name__ == "__main__":
+    main()
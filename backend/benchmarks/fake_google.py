@@ -0,0 +1,282 @@
+"""
+ベンチマーク用の偽Googleトランスポート。
+記録済みのGmail/Drive/Docsのレスポンス (fixtures/*.json) を返す httplib2.Http 互換のオブジェクトで、
+google_clients.set_http_factory() に渡して実際のGoogleアカウントなしで各STEPを動かす。
+呼び出しごとの遅延と1秒あたりの上限回数 (クォータ) を設定でき、ルートごとの往復回数を記録する。
+"""
+import base64
+import copy
+import itertools
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter, deque
+from urllib.parse import parse_qs
+
+import httplib2
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+def load_fixture(name: str):
+    with open(os.path.join(FIXTURES_DIR, f"{name}.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+def _b64(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+
+class FakeGoogleBackend:
+    """
+    偽トランスポートが共有する状態 (フィクスチャ・生成済みスレッド・往復回数)。
+    thread_size: STEP1/STEP3で取得するスレッドのメッセージ数
+    latency: 1回の往復にかける遅延 (秒)。数値なら全ルート共通、dictならルート名またはAPI名ごと
+    quota: ルート名またはAPI名ごとの1秒あたりの上限回数。超えた分は 429 rateLimitExceeded を返す
+    """
+
+    def __init__(self, thread_size: int = 1, latency=0.0, quota=None):
+        self.thread_size = thread_size
+        self.latency = latency
+        self.quota = quota or {}
+        self._quota_windows = {} # {ルート名またはAPI名: 直近1秒以内に受け付けた時刻のdeque}
+        self.rate_limited = Counter()
+        self._lock = threading.Lock()
+        self._copy_ids = itertools.count(1)
+        self.round_trips = Counter()
+        self.created_files = {} # 複製で作られたファイル {ID: {id, name, parents, appProperties}}
+        self.fixtures = {
+            name: load_fixture(name)
+            for name in (
+                "gmail_profile", "gmail_messages_list", "gmail_message", "drive_files_list", "drive_file_get",
+                "drive_file_copy", "docs_document_get", "docs_batch_update",
+            )
+        }
+        self.thread_messages = self._build_thread(thread_size)
+        self._routes = [
+            ("POST", re.compile(r"/batch/gmail/v1$"), "gmail.batch", self._gmail_batch),
+            ("GET", re.compile(r"/gmail/v1/users/me/profile$"), "gmail.getProfile", self._gmail_profile),
+            ("GET", re.compile(r"/gmail/v1/users/me/history$"), "gmail.history.list", self._gmail_history_list),
+            ("GET", re.compile(r"/gmail/v1/users/me/messages$"), "gmail.messages.list", self._gmail_messages_list),
+            ("GET", re.compile(r"/gmail/v1/users/me/messages/([^/]+)$"), "gmail.messages.get", self._gmail_message_get),
+            ("GET", re.compile(r"/gmail/v1/users/me/threads/([^/]+)$"), "gmail.threads.get", self._gmail_thread_get),
+            ("GET", re.compile(r"/drive/v3/files$"), "drive.files.list", self._drive_files_list),
+            ("GET", re.compile(r"/drive/v3/changes/startPageToken$"), "drive.changes.getStartPageToken", self._drive_start_page_token),
+            ("GET", re.compile(r"/drive/v3/changes$"), "drive.changes.list", self._drive_changes_list),
+            ("POST", re.compile(r"/drive/v3/files/([^/]+)/copy$"), "drive.files.copy", self._drive_file_copy),
+            ("GET", re.compile(r"/drive/v3/files/([^/]+)$"), "drive.files.get", self._drive_file_get),
+            ("PATCH", re.compile(r"/drive/v3/files/([^/]+)$"), "drive.files.update", self._drive_file_update),
+            ("POST", re.compile(r"/v1/documents/([^/:]+):batchUpdate$"), "docs.documents.batchUpdate", self._docs_batch_update),
+            ("GET", re.compile(r"/v1/documents/([^/:]+)$"), "docs.documents.get", self._docs_document_get),
+        ]
+
+    # --- スレッドの生成 ---
+
+    def _build_thread(self, size: int) -> list:
+        """
+        記録済みのメッセージをもとに size 件のスレッドを作る。
+        実際の返信と同じく、各返信は本文の後にそれまでの履歴を「>」付きで引用する。
+        """
+        template = self.fixtures["gmail_message"]
+        thread_id = template["threadId"]
+        original_text = base64.urlsafe_b64decode(template["payload"]["parts"][0]["body"]["data"]).decode("utf-8")
+
+        messages = []
+        previous_text = ""
+        for i in range(size):
+            if i == 0:
+                text = original_text
+            else:
+                quoted = "\n".join("> " + line for line in previous_text.splitlines())
+                text = (
+                    f"返信{i}です。追加の素材をお送りします。\n"
+                    f"https://drive.google.com/file/d/1RePlY{i:04d}xxxxxxxxxxxxxxxxxxxxx/view\n\n"
+                    f"2024年6月17日(月) 14:{i % 60:02d} 音声担当 <audio@example.com>:\n{quoted}\n"
+                )
+            message = copy.deepcopy(template)
+            message["id"] = thread_id if i == 0 else f"{thread_id}{i:04x}"
+            message["internalDate"] = str(int(template["internalDate"]) + i * 60000)
+            message["payload"]["parts"][0]["body"] = {"size": len(text.encode("utf-8")), "data": _b64(text)}
+            # HTMLパートはプレーンテキストと同じ内容を持つため、ここでは省略してサイズを抑える
+            del message["payload"]["parts"][1]
+            messages.append(message)
+            previous_text = text
+        return messages
+
+    # --- ルートごとの応答 ---
+
+    def _gmail_profile(self, match, body, params):
+        return 200, self.fixtures["gmail_profile"]
+
+    def _gmail_history_list(self, match, body, params):
+        # 記録時点から新着メッセージはない
+        return 200, {"historyId": self.fixtures["gmail_profile"]["historyId"]}
+
+    def _gmail_messages_list(self, match, body, params):
+        return 200, self.fixtures["gmail_messages_list"]
+
+    def _gmail_message_get(self, match, body, params):
+        message_id = match.group(1)
+        for message in self.thread_messages:
+            if message["id"] == message_id:
+                return 200, message
+        return 404, {"error": {"code": 404, "message": "Requested entity was not found.", "status": "NOT_FOUND"}}
+
+    def _gmail_thread_get(self, match, body, params):
+        return 200, {"id": match.group(1), "historyId": "2841937", "messages": self.thread_messages}
+
+    def _drive_files_list(self, match, body, params):
+        query = params.get("q", [""])[0]
+        if "appProperties has" in query:
+            # ドキュメントプールの在庫の検索: 複製で作られたファイルのうち、条件に合うものを返す
+            parent = re.search(r"'([^']+)' in parents", query).group(1)
+            key, value = re.search(r"key='([^']+)' and value='([^']+)'", query).groups()
+            with self._lock:
+                files = [
+                    dict(f) for f in self.created_files.values()
+                    if parent in f["parents"] and f["appProperties"].get(key) == value and not f.get("trashed")
+                ]
+            return 200, {"files": files}
+        return 200, self.fixtures["drive_files_list"]
+
+    def _drive_start_page_token(self, match, body, params):
+        return 200, {"startPageToken": "48213"}
+
+    def _drive_changes_list(self, match, body, params):
+        # 記録時点から変更はない
+        return 200, {"changes": [], "newStartPageToken": "48213"}
+
+    def _drive_file_get(self, match, body, params):
+        with self._lock:
+            file = self.created_files.get(match.group(1))
+            if file is not None:
+                return 200, {**file, "parents": list(file["parents"]), "appProperties": dict(file["appProperties"])}
+        return 200, self.fixtures["drive_file_get"]
+
+    def _drive_file_copy(self, match, body, params):
+        request = json.loads(body) if body else {}
+        copied = dict(self.fixtures["drive_file_copy"])
+        with self._lock:
+            copied["id"] = f"1CoPiEdDoC{next(self._copy_ids):06d}"
+            self.created_files[copied["id"]] = {
+                "id": copied["id"],
+                "name": request.get("name", copied.get("name")),
+                "parents": request.get("parents", []),
+                "appProperties": request.get("appProperties", {}),
+            }
+        return 200, copied
+
+    def _drive_file_update(self, match, body, params):
+        request = json.loads(body) if body else {}
+        with self._lock:
+            file = self.created_files.get(match.group(1))
+            if file is None:
+                return 404, {"error": {"code": 404, "message": "File not found.", "status": "NOT_FOUND"}}
+            removed = set(params.get("removeParents", [""])[0].split(","))
+            file["parents"] = [p for p in file["parents"] if p not in removed] + [
+                p for p in params.get("addParents", [""])[0].split(",") if p
+            ]
+            for key, value in request.get("appProperties", {}).items():
+                if value is None:
+                    file["appProperties"].pop(key, None)
+                else:
+                    file["appProperties"][key] = value
+            if "trashed" in request:
+                file["trashed"] = request["trashed"]
+            return 200, {"id": file["id"], "name": file["name"]}
+
+    def _docs_document_get(self, match, body, params):
+        return 200, self.fixtures["docs_document_get"]
+
+    def _docs_batch_update(self, match, body, params):
+        # replaceAllText には置き換えた数を返す (テンプレートにプレースホルダーが1つずつある想定)
+        requests = json.loads(body).get("requests", []) if body else []
+        replies = [{"replaceAllText": {"occurrencesChanged": 1}} if "replaceAllText" in r else {} for r in requests]
+        return 200, dict(self.fixtures["docs_batch_update"], documentId=match.group(1), replies=replies)
+
+    def _gmail_batch(self, match, body, params):
+        """multipart/mixed のバッチリクエストを分解し、各パートを個別に処理して応答をまとめる。"""
+        boundary = "batch_fake_response"
+        text = body.decode("utf-8") if isinstance(body, bytes) else body
+        request_boundary = text.split("\r\n", 1)[0].strip()
+        parts = [p for p in text.split(request_boundary) if p.strip() and p.strip() != "--"]
+        response_parts = []
+        for part in parts:
+            content_id = re.search(r"Content-ID: <([^>]+)>", part).group(1)
+            request_line = re.search(r"^(GET|POST) (\S+) HTTP/1\.1", part, re.MULTILINE)
+            path, _, query = request_line.group(2).partition("?")
+            status, payload = self._dispatch(request_line.group(1), path, None, parse_qs(query), count=False)
+            response_parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{json.dumps(payload, ensure_ascii=False)}\r\n"
+            )
+        return 200, "".join(response_parts) + f"--{boundary}--", f"multipart/mixed; boundary={boundary}"
+
+    # --- ディスパッチ ---
+
+    def _delay_for(self, route_name: str) -> float:
+        if isinstance(self.latency, dict):
+            api = route_name.split(".", 1)[0]
+            return self.latency.get(route_name, self.latency.get(api, self.latency.get("default", 0.0)))
+        return self.latency
+
+    def _over_quota(self, route_name: str) -> bool:
+        """route_name のクォータを超えていればTrue。超えていなければ今回の呼び出しを記録する (ロック内で呼ぶ)。"""
+        api = route_name.split(".", 1)[0]
+        key = route_name if route_name in self.quota else api if api in self.quota else None
+        if key is None:
+            return False
+        now = time.monotonic()
+        window = self._quota_windows.setdefault(key, deque())
+        while window and now - window[0] >= 1.0:
+            window.popleft()
+        if len(window) >= self.quota[key]:
+            return True
+        window.append(now)
+        return False
+
+    def _dispatch(self, method: str, path: str, body, params: dict, count: bool = True):
+        for route_method, pattern, route_name, handler in self._routes:
+            match = pattern.search(path)
+            if route_method == method and match:
+                if count:
+                    with self._lock:
+                        self.round_trips[route_name] += 1
+                        if self._over_quota(route_name):
+                            self.rate_limited[route_name] += 1
+                            return 429, {"error": {
+                                "code": 429, "message": "Rate Limit Exceeded", "status": "RESOURCE_EXHAUSTED",
+                                "errors": [{"reason": "rateLimitExceeded", "message": "Rate Limit Exceeded"}],
+                            }}
+                    delay = self._delay_for(route_name)
+                    if delay:
+                        time.sleep(delay)
+                return handler(match, body, params)
+        raise AssertionError(f"フィクスチャのないリクエストです: {method} {path}")
+
+    def request(self, uri, method="GET", body=None, headers=None):
+        path, _, query = re.sub(r"^https?://[^/]+", "", uri).partition("?")
+        result = self._dispatch(method, path, body, parse_qs(query))
+        status, payload = result[0], result[1]
+        content_type = result[2] if len(result) > 2 else "application/json; charset=UTF-8"
+        content = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)
+        response = httplib2.Response({"status": str(status), "content-type": content_type})
+        return response, content.encode("utf-8")
+
+    def reset_round_trips(self):
+        with self._lock:
+            self.round_trips.clear()
+            self.rate_limited.clear()
+
+class FakeHttp:
+    """httplib2.Http互換の偽トランスポート。全インスタンスが同じ FakeGoogleBackend を参照する。"""
+
+    # 状態は FakeGoogleBackend がロック付きで持つため、接続プール付きのトランスポートと同様にスレッド間で共有できる
+    thread_safe = True
+
+    def __init__(self, backend: FakeGoogleBackend):
+        self.backend = backend
+        self.timeout = None
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=5, connection_type=None):
+        return self.backend.request(uri, method, body, headers)
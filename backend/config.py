@@ -5,6 +5,11 @@ from pydantic_settings import BaseSettings
 # .envファイルから環境変数を読み込む
 load_dotenv()
 
+# サーバーレス環境 (Vercel / AWS Lambda) で動いているか。
+# サーバーレス環境では作業ディレクトリに書き込めないため、SQLiteファイルの既定の置き場所を /tmp にする
+RUNNING_SERVERLESS = bool(os.getenv("VERCEL") or os.getenv("AWS_LAMBDA_FUNCTION_NAME"))
+_DEFAULT_DATA_DIR = "/tmp" if RUNNING_SERVERLESS else ""
+
 class Settings(BaseSettings):
     google_client_id: str = os.getenv("GOOGLE_CLIENT_ID", "")
     google_client_secret: str = os.getenv("GOOGLE_CLIENT_SECRET", "")
@@ -16,6 +21,87 @@ class Settings(BaseSettings):
     drive_folder_id_step2: str = os.getenv("DRIVE_FOLDER_ID_STEP2", "")
     doc_id_for_step4: str = os.getenv("DOC_ID_FOR_STEP4", "")
     google_redirect_uri: str = os.getenv("GOOGLE_REDIRECT_URI", "http://localhost:8080/")
+    # アクセストークンの有効期限が残りこの秒数を切ったらリフレッシュする
+    google_token_refresh_margin_seconds: int = int(os.getenv("GOOGLE_TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+    # Google API呼び出しの再試行回数と、ジッター付き指数バックオフの待ち時間 (秒)
+    google_api_max_retries: int = int(os.getenv("GOOGLE_API_MAX_RETRIES", "5"))
+    google_api_backoff_base_seconds: float = float(os.getenv("GOOGLE_API_BACKOFF_BASE_SECONDS", "1.0"))
+    google_api_backoff_max_seconds: float = float(os.getenv("GOOGLE_API_BACKOFF_MAX_SECONDS", "32.0"))
+    # Google API呼び出し1回 (再試行・レート制限の待ちを含む) の期限 (秒)。0以下で期限なし
+    google_api_call_deadline_seconds: float = float(os.getenv("GOOGLE_API_CALL_DEADLINE_SECONDS", "120"))
+    # APIごとのレート制限 (1秒あたりの補充数と、瞬間的に使える最大数)。補充数を0以下にするとそのAPIは制限しない
+    # Gmailはユーザーあたり250クォータ単位/秒 (messages.get 1回で5単位)
+    gmail_api_units_per_second: float = float(os.getenv("GMAIL_API_UNITS_PER_SECOND", "250"))
+    gmail_api_burst_units: float = float(os.getenv("GMAIL_API_BURST_UNITS", "250"))
+    # Driveはユーザーあたり12,000リクエスト/分、複製などの書き込みは継続して3回/秒程度まで
+    drive_api_reads_per_second: float = float(os.getenv("DRIVE_API_READS_PER_SECOND", "200"))
+    drive_api_read_burst: float = float(os.getenv("DRIVE_API_READ_BURST", "200"))
+    drive_api_writes_per_second: float = float(os.getenv("DRIVE_API_WRITES_PER_SECOND", "3"))
+    drive_api_write_burst: float = float(os.getenv("DRIVE_API_WRITE_BURST", "10"))
+    # Docsはユーザーあたり読み取り300回/分、書き込み60回/分
+    docs_api_reads_per_second: float = float(os.getenv("DOCS_API_READS_PER_SECOND", "5"))
+    docs_api_read_burst: float = float(os.getenv("DOCS_API_READ_BURST", "50"))
+    docs_api_writes_per_second: float = float(os.getenv("DOCS_API_WRITES_PER_SECOND", "1"))
+    docs_api_write_burst: float = float(os.getenv("DOCS_API_WRITE_BURST", "10"))
+    # Google APIのHTTPトランスポート (requests: 接続プール (デフォルト) / httpx: HTTP/2 / httplib2: 従来の方式)
+    google_http_transport: str = os.getenv("GOOGLE_HTTP_TRANSPORT", "requests")
+    # 接続プールに保持する接続数。同時にAPIを呼ぶスレッド数 (複製・書き込みのワーカー数など) 以上にする
+    google_http_pool_size: int = int(os.getenv("GOOGLE_HTTP_POOL_SIZE", "32"))
+    # ワークフローのSTEPを並行実行するスレッドプールのワーカー数
+    workflow_max_workers: int = int(os.getenv("WORKFLOW_MAX_WORKERS", "4"))
+    # STEP内で並行に送るAPI呼び出し (複製・書き込みなど) のスレッドプールのワーカー数。全ワークフローで共有する
+    google_api_max_concurrency: int = int(os.getenv("GOOGLE_API_MAX_CONCURRENCY", "16"))
+    # 同時に実行されたワークフロー間で、実行中のSTEP1〜3の結果を共有するか
+    workflow_coalesce_steps: bool = os.getenv("WORKFLOW_COALESCE_STEPS", "true").lower() in ("1", "true", "yes")
+    # Gmailのバッチリクエスト1回あたりのリクエスト数 (Gmail APIの推奨は50以下)
+    gmail_batch_size: int = int(os.getenv("GMAIL_BATCH_SIZE", "50"))
+    # STEP1/STEP3の検索結果キャッシュ (history: 新着メールの有無で判定 / ttl: 時間のみで判定 / off: 無効)
+    gmail_cache_mode: str = os.getenv("GMAIL_CACHE_MODE", "history")
+    gmail_cache_ttl_seconds: float = float(os.getenv("GMAIL_CACHE_TTL_SECONDS", "600"))
+    # STEP2のサブフォルダ索引 (Drive Changes APIで差分を反映) の有効期間。過ぎたら一覧を全件取得し直す。0以下で索引を使わない
+    drive_folder_index_ttl_seconds: float = float(os.getenv("DRIVE_FOLDER_INDEX_TTL_SECONDS", "3600"))
+    # 索引に変更を取り込む最短間隔 (秒)。この間は changes.list を呼ばずに索引だけで答える
+    drive_folder_index_poll_interval_seconds: float = float(os.getenv("DRIVE_FOLDER_INDEX_POLL_INTERVAL_SECONDS", "0"))
+    # STEP4の複製元テンプレートの情報をキャッシュし、更新の有無を確認する間隔 (秒)
+    template_cache_check_interval_seconds: float = float(os.getenv("TEMPLATE_CACHE_CHECK_INTERVAL_SECONDS", "300"))
+    # STEP4のドキュメント複製の同時実行数
+    drive_copy_max_workers: int = int(os.getenv("DRIVE_COPY_MAX_WORKERS", "8"))
+    # STEP4用のドキュメントプール (任意)。DOC_POOL_SIZE を1以上にし、待機用フォルダのIDを指定すると有効になる
+    doc_pool_folder_id: str = os.getenv("DOC_POOL_FOLDER_ID", "")
+    doc_pool_size: int = int(os.getenv("DOC_POOL_SIZE", "0"))
+    doc_pool_low_water_mark: int = int(os.getenv("DOC_POOL_LOW_WATER_MARK", "5")) # 在庫がこの数以下になったら補充する
+    doc_pool_refill_concurrency: int = int(os.getenv("DOC_POOL_REFILL_CONCURRENCY", "2")) # 補充時に同時に複製する数
+    # サーバーレス環境 (Vercel / AWS Lambda) で動いているか。サーバーレス環境ではプールを使わない
+    running_serverless: bool = RUNNING_SERVERLESS
+    doc_pool_allow_serverless: bool = os.getenv("DOC_POOL_ALLOW_SERVERLESS", "false").lower() == "true" # trueならサーバーレス環境でもプールを使う
+    # STEP5でドキュメントへ同時に書き込む数
+    step5_max_workers: int = int(os.getenv("STEP5_MAX_WORKERS", "8"))
+    # STEP5の書き込み方法 (placeholders: テンプレートの {{AUDIO_URLS}} などを置換 / append: 末尾に追記 /
+    # auto: テンプレートにプレースホルダーがあれば置換、なければ追記)
+    step5_write_mode: str = os.getenv("STEP5_WRITE_MODE", "auto")
+
+    # 非同期ジョブ (/api/jobs) の設定
+    # ジョブはレスポンスを返した後もプロセス内のスレッドで実行するため、常駐するプロセス (uvicornなど) でだけ有効にする。
+    # Vercelなどのサーバーレス環境では応答後にスレッドが止まり、別インスタンスからジョブも参照できないので無効のままにする
+    job_mode_enabled: bool = os.getenv("JOB_MODE_ENABLED", "false").lower() in ("1", "true", "yes")
+    job_store_backend: str = os.getenv("JOB_STORE_BACKEND", "memory") # memory または sqlite
+    job_store_sqlite_path: str = os.getenv("JOB_STORE_SQLITE_PATH", os.path.join(_DEFAULT_DATA_DIR, "jobs.sqlite3"))
+    job_max_workers: int = int(os.getenv("JOB_MAX_WORKERS", "2")) # 同時に実行するジョブ数
+    # JOB_STORE_BACKEND=memory で終了したジョブを保持する時間 (秒) と、保持するジョブ数の上限 (超えたら終了済みの古い順に捨てる)
+    job_retention_seconds: float = float(os.getenv("JOB_RETENTION_SECONDS", "3600"))
+    job_max_retained: int = int(os.getenv("JOB_MAX_RETAINED", "1000"))
+    job_event_poll_interval_seconds: float = float(os.getenv("JOB_EVENT_POLL_INTERVAL_SECONDS", "0.5"))
+
+    # 冪等キー付きのワークフロー実行の記録 (再実行時に完了済みのSTEPと書き込み済みのドキュメントを飛ばす)
+    workflow_checkpoint_sqlite_path: str = os.getenv("WORKFLOW_CHECKPOINT_SQLITE_PATH", os.path.join(_DEFAULT_DATA_DIR, "workflow_checkpoints.sqlite3"))
+    # 複数の番組をまとめて実行する時の出力先の定義 (JSONファイル)。/api/execute_workflows で targets を省略した時に使う
+    workflow_definition_path: str = os.getenv("WORKFLOW_DEFINITION_PATH", "")
+
+    # 短縮URLの保存先 (sqlite または redis)
+    url_store_backend: str = os.getenv("URL_STORE_BACKEND", "sqlite")
+    url_store_sqlite_path: str = os.getenv("URL_STORE_SQLITE_PATH", os.path.join(_DEFAULT_DATA_DIR, "urls.sqlite3"))
+    url_store_redis_url: str = os.getenv("URL_STORE_REDIS_URL", "redis://localhost:6379/0")
+    url_store_cache_size: int = int(os.getenv("URL_STORE_CACHE_SIZE", "1024")) # 読み取りキャッシュの件数
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,65 @@
+"""
+Google APIのディスカバリー文書 (Gmail v1 / Drive v3 / Docs v1) の読み込み。
+サービスオブジェクトは backend/discovery/ に同梱した前処理済みの文書から作り、実行時にネットワークから取得しない。
+前処理では、docstringの生成にしか使わない説明文 (description / enumDescriptions) を除き、空白なしのJSONにする。
+説明文がなくなる分、読み込みとサービスの作成 (各メソッドのdocstringの生成) が軽くなる。
+ファイルの内容はプロセス内で1回だけ読み込む。
+
+googleapiclientを更新した時は、backendディレクトリで python discovery_docs.py を実行して作り直す。
+"""
+import functools
+import json
+import os
+
+DISCOVERY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "discovery")
+BUNDLED_APIS = (("gmail", "v1"), ("drive", "v3"), ("docs", "v1"))
+
+# docstringにしか使われないキー。同名のプロパティ定義 (Driveのファイルの description など) はdictなので残す
+_DESCRIPTION_KEYS = {"description", "enumDescriptions"}
+
+def _document_path(api_name: str, api_version: str) -> str:
+    return os.path.join(DISCOVERY_DIR, f"{api_name}.{api_version}.json")
+
+@functools.lru_cache(maxsize=None)
+def _read_document(api_name: str, api_version: str) -> str | None:
+    path = _document_path(api_name, api_version)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+def load_discovery_document(api_name: str, api_version: str) -> dict | None:
+    """
+    同梱したディスカバリー文書を返す。同梱していないAPIならNone。
+    googleapiclientはサービスの作成時に文書のdictを書き換えるため、呼び出しごとに新しいdictを返す。
+    """
+    text = _read_document(api_name, api_version)
+    return json.loads(text) if text is not None else None
+
+def _strip_descriptions(node):
+    if isinstance(node, dict):
+        return {
+            key: _strip_descriptions(value)
+            for key, value in node.items()
+            if not (key in _DESCRIPTION_KEYS and not isinstance(value, dict))
+        }
+    if isinstance(node, list):
+        return [_strip_descriptions(item) for item in node]
+    return node
+
+def write_bundled_documents():
+    """googleapiclientに同梱されている文書から、前処理済みの文書を作り直す。"""
+    from googleapiclient.discovery_cache import get_static_doc
+
+    os.makedirs(DISCOVERY_DIR, exist_ok=True)
+    for api_name, api_version in BUNDLED_APIS:
+        document = _strip_descriptions(json.loads(get_static_doc(api_name, api_version)))
+        path = _document_path(api_name, api_version)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(document, f, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+            f.write("\n")
+        print(f"{path} を書き出しました (リビジョン {document.get('revision')})。")
+    _read_document.cache_clear()
+
+if __name__ == "__main__":
+    write_bundled_documents()
@@ -0,0 +1,254 @@
+"""
+STEP4用の、あらかじめ複製しておいたテンプレートのドキュメントのプール (任意機能)。
+DOC_POOL_SIZE を1以上にし、DOC_POOL_FOLDER_ID に待機用フォルダを指定すると有効になる。
+
+・待機用フォルダにテンプレートの複製を DOC_POOL_SIZE 個まで用意しておく。
+  複製には appProperties でテンプレートIDと版 (Driveの version) を記録し、版が変わったものは使わずにゴミ箱へ移す。
+・STEP4はプールからドキュメントを取り出して複製先のフォルダへ移動し、足りない分だけをその場で複製する。
+・残りが DOC_POOL_LOW_WATER_MARK 個以下になったら、バックグラウンドで
+  DOC_POOL_REFILL_CONCURRENCY 個ずつ並行して複製し、DOC_POOL_SIZE 個まで補充する。
+取り出す時は appProperties に取り出した側の目印 (docPoolClaim) を書き、移動後に読み直して
+目印が自分のものでなければ (別のプロセスが同時に取り出した場合は) そのドキュメントを使わない。
+ただし完全な排他ではないため、同じ待機用フォルダは1つのプロセスで使うことを推奨する。
+サーバーレス環境 (VERCEL / AWS_LAMBDA_FUNCTION_NAME が設定されている) では、
+インスタンスごとに在庫を読み込み、応答後に補充のスレッドが止まるため、DOC_POOL_ALLOW_SERVERLESS を
+true にしない限りプールを使わない。
+"""
+import threading
+import uuid
+from collections import deque
+
+from config import settings
+from drive_copy import copy_file_with_retry
+from executors import map_bounded
+from google_clients import get_service
+from metrics import REGISTRY
+
+POOL_TEMPLATE_KEY = "docPoolTemplate"
+POOL_VERSION_KEY = "docPoolTemplateVersion"
+POOL_CLAIM_KEY = "docPoolClaim"
+
+POOL_CLAIMS = REGISTRY.counter(
+    "doc_pool_claims_total", "STEP4で必要になったドキュメント数 (hit: プールから取り出した / miss: その場で複製した)", ["result"])
+POOL_REFILLED = REGISTRY.counter(
+    "doc_pool_refilled_total", "プールに補充したドキュメント数")
+POOL_DISCARDED = REGISTRY.counter(
+    "doc_pool_discarded_total", "テンプレートの更新などで使わずにゴミ箱へ移したプールのドキュメント数")
+POOL_CONFLICTS = REGISTRY.counter(
+    "doc_pool_conflicts_total", "別のプロセスが先に取り出していたため使わなかったプールのドキュメント数")
+
+class DocumentPool:
+    def __init__(self, folder_id: str, size: int, low_water_mark: int, refill_concurrency: int):
+        self.folder_id = folder_id
+        self.size = size
+        self.low_water_mark = low_water_mark
+        self.refill_concurrency = max(1, refill_concurrency)
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._available = deque() # 取り出せるドキュメントの {id, name}
+        self._template_key = None # 在庫がどのテンプレート・版の複製か (テンプレートID, version)
+        self._loaded = False
+        self._refill_thread = None
+
+    def available_count(self) -> int:
+        with self._lock:
+            return len(self._available)
+
+    def clear(self):
+        """プロセス内の在庫情報を捨てる (Drive上のドキュメントはそのまま。次回使う時に読み込み直す)。"""
+        self.wait_for_refill()
+        with self._lock:
+            self._available.clear()
+            self._template_key = None
+            self._loaded = False
+
+    def claim(self, drive_service, template, target_parent_id: str | None, count: int) -> list:
+        """
+        プールから最大 count 個のドキュメントを取り出し、target_parent_id (Noneならマイドライブ直下) へ移動する。
+        移動できたドキュメントの {id, name} のリストを返す。取り出した後、必要なら補充を始める。
+        """
+        self._prepare(drive_service, template)
+        with self._lock:
+            taken = [self._available.popleft() for _ in range(min(count, len(self._available)))]
+
+        claim_id = uuid.uuid4().hex
+        parent_id = target_parent_id or 'root'
+
+        def move(doc):
+            service = get_service('drive', 'v3')
+            try:
+                # 別のプロセスが先に取り出していれば使わない
+                current = service.files().get(fileId=doc['id'], fields='parents, appProperties').execute()
+                if self.folder_id not in (current.get('parents') or []) or \
+                        POOL_CLAIM_KEY in (current.get('appProperties') or {}):
+                    POOL_CONFLICTS.inc()
+                    return None
+                moved = service.files().update(
+                    fileId=doc['id'],
+                    addParents=parent_id,
+                    removeParents=self.folder_id,
+                    # プールの目印を消して通常の複製と同じ状態にし、取り出した側の目印を書く
+                    body={'appProperties': {POOL_TEMPLATE_KEY: None, POOL_VERSION_KEY: None, POOL_CLAIM_KEY: claim_id}},
+                    fields='id, name',
+                ).execute()
+                # 確認から移動までの間に別のプロセスも取り出した場合は、目印が後から書いた側のものになる
+                after = service.files().get(fileId=doc['id'], fields='parents, appProperties').execute()
+                if (after.get('appProperties') or {}).get(POOL_CLAIM_KEY) != claim_id:
+                    print(f"プールのドキュメント {doc['id']} は別のプロセスが取り出したため使いません。")
+                    if len(after.get('parents') or []) > 1:
+                        # 移動先が別のフォルダなら、自分が追加した親を外す
+                        service.files().update(fileId=doc['id'], removeParents=parent_id, fields='id').execute()
+                    POOL_CONFLICTS.inc()
+                    return None
+                return moved
+            except Exception as e:
+                # 移動できなかったものはプールからも外し、その分はその場で複製する
+                print(f"プールのドキュメント {doc['id']} を移動できませんでした: {e}")
+                return None
+
+        moved = [doc for doc in map_bounded(move, taken, settings.drive_copy_max_workers) if doc]
+        POOL_CLAIMS.inc(len(moved), result="hit")
+        POOL_CLAIMS.inc(count - len(moved), result="miss")
+        print(f"プールから {len(moved)} 個のドキュメントを取り出しました (残り {self.available_count()} 個)。")
+        self.maybe_refill(template)
+        return moved
+
+    def refill(self, template):
+        """在庫が DOC_POOL_SIZE 個になるまでテンプレートを複製する (呼び出し元のスレッドで完了まで待つ)。"""
+        self._prepare(get_service('drive', 'v3'), template)
+        with self._lock:
+            shortfall = self.size - len(self._available)
+        if shortfall <= 0:
+            return
+
+        body = {
+            'name': template.name,
+            'parents': [self.folder_id],
+            'appProperties': {POOL_TEMPLATE_KEY: template.template_id, POOL_VERSION_KEY: template.version or ""},
+        }
+
+        def copy_one(_):
+            try:
+                return copy_file_with_retry(template.template_id, dict(body), 'id, name')
+            except Exception as e:
+                print(f"プールへの補充に失敗しました: {e}")
+                return None
+
+        for copied in map_bounded(copy_one, range(shortfall), self.refill_concurrency):
+            if copied is None:
+                continue
+            with self._lock:
+                if self._template_key == (template.template_id, template.version):
+                    self._available.append(copied)
+                    POOL_REFILLED.inc()
+                    continue
+            # 補充中にテンプレートが更新された場合は使わない
+            self._discard([copied])
+        print(f"プールを補充しました (在庫 {self.available_count()} 個)。")
+
+    def maybe_refill(self, template):
+        """在庫が下限以下なら、バックグラウンドで補充を始める (補充中なら何もしない)。"""
+        with self._lock:
+            if len(self._available) > self.low_water_mark:
+                return
+            if self._refill_thread is not None and self._refill_thread.is_alive():
+                return
+            self._refill_thread = threading.Thread(
+                target=self._refill_in_background, args=(template,), name="doc-pool-refill", daemon=True)
+            self._refill_thread.start()
+
+    def wait_for_refill(self, timeout: float | None = None):
+        """バックグラウンドの補充が終わるまで待つ。"""
+        with self._lock:
+            thread = self._refill_thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _refill_in_background(self, template):
+        try:
+            self.refill(template)
+        except Exception as e:
+            print(f"プールの補充中にエラーが発生しました: {e}")
+
+    def _prepare(self, drive_service, template):
+        """テンプレートの版が変わっていれば在庫を入れ替え、初回は待機用フォルダから在庫を読み込む。"""
+        template_key = (template.template_id, template.version)
+        stale = []
+        with self._lock:
+            if self._template_key != template_key:
+                stale = list(self._available)
+                self._available.clear()
+                self._template_key = template_key
+                self._loaded = False
+            loaded = self._loaded
+        if stale:
+            self._discard(stale)
+        if loaded:
+            return
+        # 在庫の読み込みは1スレッドずつ行い、同じドキュメントが二重に在庫に入らないようにする
+        with self._load_lock:
+            with self._lock:
+                if self._loaded and self._template_key == template_key:
+                    return
+            self._load(drive_service, template, template_key)
+
+    def _load(self, drive_service, template, template_key):
+        query = (
+            f"'{self.folder_id}' in parents and trashed = false"
+            f" and appProperties has {{ key='{POOL_TEMPLATE_KEY}' and value='{template.template_id}' }}"
+        )
+        found = []
+        page_token = None
+        while True:
+            response = drive_service.files().list(
+                q=query, pageSize=1000, pageToken=page_token, fields='nextPageToken, files(id, name, appProperties)'
+            ).execute()
+            found.extend(response.get('files', []))
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+
+        current, outdated = [], []
+        for file in found:
+            version = (file.get('appProperties') or {}).get(POOL_VERSION_KEY)
+            doc = {'id': file['id'], 'name': file.get('name')}
+            (current if version == (template.version or "") else outdated).append(doc)
+        with self._lock:
+            if self._template_key == template_key:
+                self._available.extend(current)
+                self._loaded = True
+        if outdated:
+            self._discard(outdated)
+
+    def _discard(self, docs: list):
+        """古い版の複製をゴミ箱へ移す。"""
+        service = get_service('drive', 'v3')
+        for doc in docs:
+            try:
+                service.files().update(fileId=doc['id'], body={'trashed': True}, fields='id').execute()
+                POOL_DISCARDED.inc()
+            except Exception as e:
+                print(f"プールのドキュメント {doc['id']} をゴミ箱へ移せませんでした: {e}")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_document_pool() -> DocumentPool | None:
+    """
+    設定に応じたプールを返す。DOC_POOL_SIZE が0以下か DOC_POOL_FOLDER_ID が未設定なら None。
+    サーバーレス環境では DOC_POOL_ALLOW_SERVERLESS が true の場合だけ使う。
+    """
+    global _pool
+    if settings.doc_pool_size <= 0 or not settings.doc_pool_folder_id:
+        return None
+    if settings.running_serverless and not settings.doc_pool_allow_serverless:
+        return None
+    with _pool_lock:
+        if _pool is None or _pool.folder_id != settings.doc_pool_folder_id:
+            _pool = DocumentPool(
+                settings.doc_pool_folder_id,
+                settings.doc_pool_size,
+                settings.doc_pool_low_water_mark,
+                settings.doc_pool_refill_concurrency,
+            )
+        return _pool
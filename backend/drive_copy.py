@@ -0,0 +1,85 @@
+"""
+Google Driveのファイルをまとめて複製するためのモジュール (STEP4用)。
+複製リクエストは共有のAPI用スレッドプール (executors.py) で、上限付きで並行実行する。
+レート制限エラー (403 rateLimitExceeded / 429) の再試行は、全API共通の google_api_policy で行う。
+結果は依頼した順番で返し、一部が失敗しても作成済みのファイル情報は失わない。
+"""
+from config import settings
+from executors import map_bounded
+from google_clients import get_service
+from metrics import REGISTRY
+
+COPY_CALLBACK_FAILURES = REGISTRY.counter(
+    "drive_copy_callback_failures_total", "複製できたファイルについて、on_copied (実行記録など) の呼び出しが失敗した数")
+
+def copy_file_with_retry(file_id: str, body: dict, fields: str):
+    """ファイルを1つ複製する。レート制限エラーの場合は google_api_policy が待ってから再試行する。"""
+    drive_service = get_service('drive', 'v3')
+    if not drive_service:
+        raise RuntimeError("Google Drive APIの認証に失敗しました。")
+    return drive_service.files().copy(fileId=file_id, body=body, fields=fields).execute()
+
+class CopyResult:
+    """
+    1件分の複製結果。成功時は file に複製されたファイル情報、失敗時は error にエラー内容が入る。
+    複製できた後に on_copied が失敗した場合は、file はそのままで callback_error にエラー内容が入る
+    (複製自体は成功しているため ok は True)。
+    """
+
+    def __init__(self, index: int, file: dict | None = None, error: Exception | None = None,
+                 callback_error: Exception | None = None):
+        self.index = index
+        self.file = file
+        self.error = error
+        self.callback_error = callback_error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+def notify_copied(result: CopyResult, on_copied) -> CopyResult:
+    """複製できたファイルを on_copied に渡す。失敗してもファイル情報は失わず、callback_error に記録する。"""
+    if on_copied and result.ok:
+        try:
+            on_copied(result.file)
+        except Exception as e:
+            print(f"複製したファイル {result.file.get('id')} のコールバックに失敗しました: {e}")
+            COPY_CALLBACK_FAILURES.inc()
+            result.callback_error = e
+    return result
+
+def bulk_copy_file(file_id: str, body: dict, count: int, fields: str = 'id, name, webViewLink', on_copied=None):
+    """
+    ファイルを count 個複製し、CopyResultのリストを依頼順に返す。
+    失敗したものがあっても他の複製は続行し、作成済みのファイルは結果に含まれる。
+    on_copied を指定すると、複製できたファイル (dict) ごとに完了した時点で呼ぶ (実行記録用、複数スレッドから呼ばれる)。
+    on_copied が失敗しても複製したファイルは結果に残し、CopyResult.callback_error で報告する。
+    """
+    def copy_one(index: int) -> CopyResult:
+        try:
+            copied_file = copy_file_with_retry(file_id, dict(body), fields)
+        except Exception as e:
+            print(f"{index + 1}回目の複製に失敗しました: {e}")
+            return CopyResult(index, error=e)
+        print(f"{index + 1}回目の複製完了: {copied_file.get('name')} (ID: {copied_file.get('id')})")
+        return notify_copied(CopyResult(index, file=copied_file), on_copied)
+
+    if count <= 0:
+        return []
+    # map_boundedは依頼順に結果を返す
+    return map_bounded(copy_one, range(count), settings.drive_copy_max_workers)
+
+def trash_files(file_ids: list) -> int:
+    """
+    ファイルをまとめてゴミ箱へ移し、移せた数を返す (後続のSTEPが失敗して使われなくなった複製の片付け用)。
+    移せなかったファイルはログに残して続行する。
+    """
+    def trash_one(file_id: str) -> bool:
+        try:
+            get_service('drive', 'v3').files().update(fileId=file_id, body={'trashed': True}, fields='id').execute()
+            return True
+        except Exception as e:
+            print(f"ファイル {file_id} をゴミ箱へ移せませんでした: {e}")
+            return False
+
+    return sum(map_bounded(trash_one, list(file_ids), settings.drive_copy_max_workers))
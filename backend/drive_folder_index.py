@@ -0,0 +1,131 @@
+"""
+STEP2用の、指定フォルダ直下のサブフォルダの索引。
+初回 (と DRIVE_FOLDER_INDEX_TTL_SECONDS 経過後) は files.list でサブフォルダを全件取得し、
+それ以降は Drive Changes API (changes.list) で前回以降の変更だけを取り込む。
+最新フォルダの判定は索引上で行うため、変更がなければ changes.list の1往復で済み、
+DRIVE_FOLDER_INDEX_POLL_INTERVAL_SECONDS の間はAPIを呼ばずに索引だけで答える。
+"""
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+from config import settings
+from metrics import REGISTRY
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+_FOLDER_FIELDS = "id, name, webViewLink, createdTime"
+_CHANGE_FIELDS = (
+    "nextPageToken, newStartPageToken, "
+    f"changes(fileId, removed, file(mimeType, parents, trashed, {_FOLDER_FIELDS}))"
+)
+
+INDEX_REFRESHES = REGISTRY.counter(
+    "drive_folder_index_refreshes_total", "STEP2のフォルダ索引の更新回数 (full: 全件取得 / changes: 差分の取り込み)", ["kind"])
+
+class DriveFolderIndex:
+    """parent_id 直下のサブフォルダを {フォルダID: フォルダ情報} で保持する。"""
+
+    def __init__(self, parent_id: str):
+        self.parent_id = parent_id
+        self._lock = threading.Lock()
+        self._folders = {}
+        self._page_token = None
+        self._loaded_at = None
+        self._polled_at = 0.0
+
+    def latest_folder(self, service) -> dict | None:
+        """作成日が最も新しいサブフォルダの情報 (id, name, webViewLink, createdTime) を返す。なければNone。"""
+        with self._lock:
+            now = time.monotonic()
+            if self._loaded_at is None or now - self._loaded_at > settings.drive_folder_index_ttl_seconds:
+                self._full_refresh(service)
+            elif now - self._polled_at >= settings.drive_folder_index_poll_interval_seconds:
+                if not self._apply_changes(service):
+                    self._full_refresh(service)
+            if not self._folders:
+                return None
+            return max(self._folders.values(), key=lambda f: (f.get("createdTime", ""), f["id"]))
+
+    def clear(self):
+        with self._lock:
+            self._folders = {}
+            self._page_token = None
+            self._loaded_at = None
+            self._polled_at = 0.0
+
+    def _full_refresh(self, service):
+        # 一覧の取得中に起きた変更も次回取り込めるよう、先に変更の開始位置を取得する
+        start_token = service.changes().getStartPageToken().execute()["startPageToken"]
+        query = f"'{self.parent_id}' in parents and mimeType = '{FOLDER_MIME_TYPE}' and trashed = false"
+        folders = {}
+        page_token = None
+        while True:
+            response = service.files().list(
+                q=query,
+                pageSize=1000,
+                pageToken=page_token,
+                fields=f"nextPageToken, files({_FOLDER_FIELDS})",
+            ).execute()
+            for folder in response.get("files", []):
+                folders[folder["id"]] = folder
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                break
+        self._folders = folders
+        self._page_token = start_token
+        self._loaded_at = self._polled_at = time.monotonic()
+        INDEX_REFRESHES.inc(kind="full")
+
+    def _apply_changes(self, service) -> bool:
+        """前回以降の変更を索引に反映する。変更を取得できなかった場合はFalseを返す。"""
+        page_token = self._page_token
+        try:
+            while page_token:
+                response = service.changes().list(
+                    pageToken=page_token,
+                    spaces="drive",
+                    includeRemoved=True,
+                    pageSize=1000,
+                    fields=_CHANGE_FIELDS,
+                ).execute()
+                for change in response.get("changes", []):
+                    self._apply_change(change)
+                if "newStartPageToken" in response:
+                    self._page_token = response["newStartPageToken"]
+                    break
+                page_token = response.get("nextPageToken")
+                self._page_token = page_token
+        except HttpError as error:
+            # トークンが無効になった場合などは全件取得し直す
+            print(f"Google Driveの変更履歴を取得できませんでした: {error}")
+            return False
+        self._polled_at = time.monotonic()
+        INDEX_REFRESHES.inc(kind="changes")
+        return True
+
+    def _apply_change(self, change: dict):
+        file_id = change.get("fileId")
+        file = change.get("file") or {}
+        in_folder = (
+            not change.get("removed")
+            and not file.get("trashed")
+            and file.get("mimeType") == FOLDER_MIME_TYPE
+            and self.parent_id in file.get("parents", [])
+        )
+        if in_folder:
+            self._folders[file_id] = {key: file[key] for key in ("id", "name", "webViewLink", "createdTime") if key in file}
+        else:
+            # 削除・ゴミ箱への移動・別フォルダへの移動
+            self._folders.pop(file_id, None)
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_folder_index(parent_id: str) -> DriveFolderIndex:
+    """親フォルダIDごとの索引を返す (プロセス内で共有)。"""
+    with _indexes_lock:
+        index = _indexes.get(parent_id)
+        if index is None:
+            index = _indexes[parent_id] = DriveFolderIndex(parent_id)
+        return index
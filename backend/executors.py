@@ -0,0 +1,63 @@
+"""
+ワークフローとGoogle API呼び出しを実行する、プロセス内で共有する上限付きのスレッドプール。
+googleapiclientは同期APIのため、イベントループ (FastAPIのリクエスト処理やジョブ) からは
+ここのスレッドプールに処理を渡して await で待ち、ループ自体は止めない。
+
+・STEP用 (WORKFLOW_MAX_WORKERS): google_services のSTEP関数を実行する。
+・API用 (GOOGLE_API_MAX_CONCURRENCY): STEP内で並行に送る複製・書き込み・移動などの個々のAPI呼び出し。
+同時に実行されるワークフローが増えても、スレッド数はこの2つの上限を超えない。
+API用のプールで動く処理からは、さらに map_bounded() を呼ばないこと (プールが埋まると待ち合って止まるため)。
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import settings
+from metrics import bind_step_context
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+def _get_executor(name: str, max_workers: int) -> ThreadPoolExecutor:
+    with _executors_lock:
+        executor = _executors.get(name)
+        if executor is None:
+            executor = _executors[name] = ThreadPoolExecutor(
+                max_workers=max(1, max_workers), thread_name_prefix=name)
+        return executor
+
+def get_workflow_executor() -> ThreadPoolExecutor:
+    """STEP実行用のスレッドプール (プロセス内で共有、ワーカー数に上限あり) を返す。"""
+    return _get_executor("workflow-step", settings.workflow_max_workers)
+
+def get_api_executor() -> ThreadPoolExecutor:
+    """STEP内で並行に送るAPI呼び出し用のスレッドプールを返す。"""
+    return _get_executor("google-api", settings.google_api_max_concurrency)
+
+async def run_blocking(func, *args, **kwargs):
+    """同期関数をSTEP用のスレッドプールで実行し、完了を待つ (イベントループは止めない)。"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_workflow_executor(), functools.partial(func, *args, **kwargs))
+
+def map_bounded(func, items, limit: int) -> list:
+    """
+    items の各要素に func をAPI用のスレッドプールで適用し、結果を items の順に返す。
+    1回の呼び出しで同時に実行するのは limit 件まで。func の例外はそのまま送出されるため、
+    一部の失敗を許す場合は func の中で処理する。呼び出し元のSTEPのコンテキスト (メトリクス) を引き継ぐ。
+    """
+    executor = get_api_executor()
+    bound = bind_step_context(func)
+    slots = threading.Semaphore(max(1, limit))
+
+    def run(item):
+        try:
+            return bound(item)
+        finally:
+            slots.release()
+
+    futures = []
+    for item in items:
+        slots.acquire()
+        futures.append(executor.submit(run, item))
+    return [future.result() for future in futures]
@@ -0,0 +1,110 @@
+"""
+STEP1/STEP3のGmail検索結果のキャッシュ。
+同じクエリでワークフローが短時間に繰り返し実行された場合に、
+スレッドの再取得とデコードを省いて前回の結果をそのまま返す。
+
+キャッシュの有効性は GMAIL_CACHE_MODE で切り替える。
+    history: 結果を保存した時点のhistoryIdから users.history.list で新着メッセージの有無を確認し、
+             新着がなければキャッシュを使う (確認は1往復で済む)。GMAIL_CACHE_TTL_SECONDS が上限。
+    ttl:     GMAIL_CACHE_TTL_SECONDS 秒の間は確認せずにキャッシュを使う。
+    off:     キャッシュしない。
+"""
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+from config import settings
+from metrics import REGISTRY
+
+CACHE_LOOKUPS = REGISTRY.counter(
+    "gmail_search_cache_lookups_total", "Gmail検索結果キャッシュの参照回数", ["step", "result"])
+
+class _CacheEntry:
+    def __init__(self, result: str, history_id: str | None):
+        self.result = result
+        self.history_id = history_id
+        self.cached_at = time.monotonic()
+
+class GmailSearchCache:
+    """(STEP名, クエリ) ごとに、パース済みの結果文字列とその時点のhistoryIdを保持する。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    @staticmethod
+    def _mode() -> str:
+        return settings.gmail_cache_mode.lower()
+
+    def lookup(self, service, step: str, query: str) -> str | None:
+        """有効なキャッシュがあればその結果を、なければNoneを返す。"""
+        mode = self._mode()
+        if mode == "off":
+            return None
+
+        key = (step, query)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            CACHE_LOOKUPS.inc(step=step, result="miss")
+            return None
+
+        if time.monotonic() - entry.cached_at > settings.gmail_cache_ttl_seconds:
+            self._discard(key, entry)
+            CACHE_LOOKUPS.inc(step=step, result="expired")
+            return None
+
+        if mode == "history" and not self._unchanged_since(service, entry.history_id):
+            self._discard(key, entry)
+            CACHE_LOOKUPS.inc(step=step, result="invalidated")
+            return None
+
+        CACHE_LOOKUPS.inc(step=step, result="hit")
+        print(f"{step}: 「{query}」の検索結果をキャッシュから返します。")
+        return entry.result
+
+    def current_history_id(self, service) -> str | None:
+        """結果を計算する前に呼び、その時点のメールボックスのhistoryIdを返す (historyモード以外はNone)。"""
+        if self._mode() != "history":
+            return None
+        profile = service.users().getProfile(userId='me').execute()
+        return profile.get('historyId')
+
+    def store(self, step: str, query: str, result: str, history_id: str | None):
+        if self._mode() == "off":
+            return
+        if self._mode() == "history" and not history_id:
+            return
+        with self._lock:
+            self._entries[(step, query)] = _CacheEntry(result, history_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _discard(self, key, entry):
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+
+    @staticmethod
+    def _unchanged_since(service, history_id: str | None) -> bool:
+        """history_id 以降にメッセージが追加されていなければTrueを返す。"""
+        if not history_id:
+            return False
+        try:
+            response = service.users().history().list(
+                userId='me',
+                startHistoryId=history_id,
+                historyTypes=['messageAdded'],
+                maxResults=1,
+            ).execute()
+        except HttpError as error:
+            # historyIdが古すぎる場合 (404) などは確認できないのでキャッシュを使わない
+            print(f"Gmailの変更履歴を確認できませんでした: {error}")
+            return False
+        return not response.get('history')
+
+# プロセス内で共有するキャッシュ
+gmail_search_cache = GmailSearchCache()
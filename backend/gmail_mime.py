@@ -0,0 +1,184 @@
+"""
+Gmail APIのメッセージペイロード (MIMEツリー) から本文テキストを取り出す。
+STEP1/STEP3で共通に使う。
+
+・ツリーは再帰せずスタックで深さ優先にたどり、multipart/alternative や multipart/mixed、
+  転送メール (message/rfc822) の中にある本文パートも見つける。
+・ファイル名のあるパート (添付ファイル) と text/* 以外のパートはデコードしない。
+・本文は text/plain を優先し、なければ text/html をテキストに変換して使う。
+  必要になったパートだけを一度ずつデコードする。
+・base64url のデータは一定サイズずつデコードし、Content-Type の charset に従って
+  インクリメンタルに文字列へ変換する。HTMLはデコードしながらパーサーに流し込み、
+  HTML全体の文字列を作らずに1回の走査でテキストにする。
+"""
+import base64
+import codecs
+from html.parser import HTMLParser
+from typing import NamedTuple
+
+from metrics import record_bytes_decoded
+
+# 一度にデコードするbase64文字数 (4の倍数)
+DECODE_CHUNK_CHARS = 64 * 1024
+
+# 改行として扱うHTMLのブロック要素
+_BLOCK_TAGS = frozenset({
+    "address", "article", "blockquote", "br", "dd", "div", "dl", "dt", "footer", "h1", "h2", "h3", "h4",
+    "h5", "h6", "header", "hr", "li", "ol", "p", "pre", "section", "table", "tr", "ul",
+})
+# 前後を空行で区切るブロック要素 (段落・見出し・引用・リスト・表など)
+_PARAGRAPH_TAGS = frozenset({
+    "blockquote", "dl", "h1", "h2", "h3", "h4", "h5", "h6", "hr", "ol", "p", "pre", "table", "ul",
+})
+# 中身をテキストとして出力しない要素
+_SKIP_TAGS = frozenset({"head", "script", "style", "title"})
+
+class MessageText(NamedTuple):
+    text: str
+    from_html: bool # text/plain がなく、HTMLから変換した場合はTrue
+
+def _header_params(part: dict, name: str) -> tuple:
+    """パートのヘッダー name の値を (本体, {パラメータ名: 値}) に分けて返す。"""
+    for header in part.get("headers", ()):
+        if header.get("name", "").lower() == name:
+            value, *params = header.get("value", "").split(";")
+            parsed = {}
+            for param in params:
+                key, _, param_value = param.partition("=")
+                parsed[key.strip().lower()] = param_value.strip().strip('"')
+            return value.strip().lower(), parsed
+    return "", {}
+
+def _charset(part: dict) -> str:
+    charset = _header_params(part, "content-type")[1].get("charset") or "utf-8"
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        # 不明なcharsetはUTF-8として読む
+        return "utf-8"
+
+def _is_attachment(part: dict) -> bool:
+    if part.get("filename"):
+        return True
+    return _header_params(part, "content-disposition")[0] == "attachment"
+
+def iter_text_parts(payload: dict):
+    """
+    ペイロードのMIMEツリーを文書順にたどり、本文になり得る (mimeType, パート) を返すジェネレータ。
+    添付ファイル・text/plain と text/html 以外のパート・データのないパートは返さない。
+    """
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        children = part.get("parts")
+        if children:
+            # 文書順に取り出せるよう逆順に積む
+            stack.extend(reversed(children))
+            continue
+        mime_type = part.get("mimeType", "").lower()
+        if mime_type not in ("text/plain", "text/html") or _is_attachment(part):
+            continue
+        if not part.get("body", {}).get("data"):
+            continue
+        yield mime_type, part
+
+def iter_decoded_chunks(part: dict, chunk_chars: int = DECODE_CHUNK_CHARS):
+    """パートの本文データを chunk_chars 文字ずつbase64urlデコードし、文字列の断片を順に返す。"""
+    data = part["body"]["data"]
+    decoder = codecs.getincrementaldecoder(_charset(part))(errors="replace")
+    chunk_chars -= chunk_chars % 4
+    for start in range(0, len(data), chunk_chars):
+        chunk = data[start:start + chunk_chars]
+        if start + chunk_chars >= len(data):
+            # 末尾のパディングが省略されている場合に補う
+            chunk += "=" * (-len(chunk) % 4)
+        raw = base64.urlsafe_b64decode(chunk)
+        record_bytes_decoded(len(raw))
+        text = decoder.decode(raw)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+def decode_part(part: dict) -> str:
+    """パートの本文データ全体を文字列にデコードする。"""
+    return "".join(iter_decoded_chunks(part))
+
+class _HTMLTextExtractor(HTMLParser):
+    """タグを取り除き、ブロック要素を改行に、段落などの区切りを空行に置き換えながらテキストを集める。"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._pieces = []
+        self._skip_depth = 0
+        self._line_has_text = False # 最後の改行の後にテキストがあるか
+
+    def _break(self, tag):
+        if tag == "br":
+            self._pieces.append("\n")
+        elif tag in _PARAGRAPH_TAGS:
+            self._pieces.append("\n\n")
+        elif self._line_has_text:
+            # 連続するブロック要素 (</div><div>) の境界で空行を作らない
+            self._pieces.append("\n")
+        self._line_has_text = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag in _BLOCK_TAGS:
+            self._break(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in _BLOCK_TAGS:
+            self._break(tag)
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in _BLOCK_TAGS and tag != "br":
+            self._break(tag)
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self._pieces.append(data)
+            last_line = data.rsplit("\n", 1)[-1]
+            self._line_has_text = bool(last_line.strip()) or (self._line_has_text and "\n" not in data)
+
+    def text(self) -> str:
+        lines = [line.strip() for line in "".join(self._pieces).splitlines()]
+        # 連続する空行は1行にまとめ、段落の区切りとして残す
+        kept = (line for i, line in enumerate(lines) if line or (i > 0 and lines[i - 1]))
+        return "\n".join(kept).strip("\n")
+
+def html_to_text(chunks) -> str:
+    """HTML (文字列またはその断片のイテラブル) を1回の走査でプレーンテキストに変換する。"""
+    parser = _HTMLTextExtractor()
+    for chunk in ([chunks] if isinstance(chunks, str) else chunks):
+        parser.feed(chunk)
+    parser.close()
+    return parser.text()
+
+def extract_message_text(payload: dict, first_only: bool = False) -> MessageText:
+    """
+    ペイロードから本文テキストを取り出す。
+    text/plain のパートがあればそれらを (first_only なら最初の1つだけ) 連結して返し、
+    HTMLパートはデコードしない。なければ text/html のパートをテキストに変換して返す。
+    """
+    plain_parts = []
+    html_parts = []
+    for mime_type, part in iter_text_parts(payload):
+        if mime_type == "text/plain":
+            plain_parts.append(part)
+            if first_only:
+                break
+        else:
+            html_parts.append(part)
+
+    if plain_parts:
+        return MessageText("\n".join(decode_part(part) for part in plain_parts), False)
+    if html_parts:
+        targets = html_parts[:1] if first_only else html_parts
+        return MessageText("\n".join(html_to_text(iter_decoded_chunks(part)) for part in targets), True)
+    return MessageText("", False)
@@ -0,0 +1,97 @@
+"""
+返信メールの本文から引用された履歴を取り除く。
+スレッドの返信は通常それまでの全履歴を引用するため、そのままURLを探すと
+返信数に対して二乗のオーダーで同じテキストを走査することになる。
+スレッド内の返信については、新しく書かれた部分だけを走査対象にする。
+
+・「>」で始まる行は引用とみなし、連続する引用行の塊を履歴として読み飛ばす。
+  引用の塊と塊の間に書かれたインラインの返答は新しく書かれた部分として残す。
+・引用の直前にある「On … wrote:」「… のメッセージ:」「2024年6月17日(月) 14:00 名前 <アドレス>:」
+  などの帰属行も取り除く。日付で始まる行は、時刻を含む場合だけ帰属行とみなす。
+・Outlook形式の「-----Original Message-----」「-----元のメッセージ-----」以降は全て履歴とみなす。
+引用の塊は正規表現で見つけるので、引用された部分を行単位のPythonの処理で調べることはしない。
+"""
+import re
+
+from metrics import REGISTRY
+
+QUOTED_CHARS_SKIPPED = REGISTRY.counter(
+    "gmail_quoted_chars_skipped_total", "引用された履歴として走査を省いた文字数")
+
+# 引用行、またはOutlook形式の元のメッセージの区切り
+_QUOTE_START_RE = re.compile(
+    r"^[ \t]*(?:>|-{3,}[ \t]*(?P<separator>Original Message|元のメッセージ)[ \t]*-{3,})",
+    re.MULTILINE | re.IGNORECASE,
+)
+# 引用行の塊の終わり (次の行が引用行でない改行)
+_QUOTE_END_RE = re.compile(r"\n(?![ \t]*>)")
+# 引用の直前に置かれる帰属行の末尾 (「… wrote:」「… のメッセージ:」「… <アドレス>:」「2024年6月17日(月) 14:00 …:」)
+# 日付で始まる行は「2024/06/17 の収録分:」のような本文と区別するため、時刻 (14:00) の後に名前が続くものに限る
+_ATTRIBUTION_END_RE = re.compile(
+    r"(?:\bwrote:|のメッセージ:|>:|^\s*\d{4}[年/-].*\b\d{1,2}:\d{2}\S*\s+\S.*:)\s*$", re.IGNORECASE)
+# 折り返された帰属行の先頭
+_ATTRIBUTION_START_RE = re.compile(r"^\s*(?:On\s|\d{4}[年/-])", re.IGNORECASE)
+# 帰属行は長い名前やアドレスで折り返されることがあるため、引用の直前の数行までを調べる
+_MAX_ATTRIBUTION_LINES = 3
+
+def _strip_attribution(head: str) -> str:
+    """head の末尾にある帰属行を取り除く。"""
+    lines = head.rstrip().rsplit("\n", _MAX_ATTRIBUTION_LINES)
+    if not _ATTRIBUTION_END_RE.search(lines[-1]):
+        return head
+    start = len(lines) - 1
+    # 帰属行の先頭まで遡る (空行を挟んだ前の段落には遡らない)
+    for i in range(len(lines) - 1, 0, -1):
+        if not lines[i].strip():
+            break
+        if _ATTRIBUTION_START_RE.match(lines[i]):
+            start = i
+            break
+    return "\n".join(lines[:start])
+
+def split_new_content(text: str) -> tuple:
+    """
+    本文を (新しく書かれた部分, 引用された履歴の文字数) に分ける。
+    新しく書かれた部分は、最初の引用より前、引用の塊と塊の間 (インラインの返答)、最後の引用より後ろの部分。
+    """
+    match = _QUOTE_START_RE.search(text)
+    if match is None:
+        return text, 0
+
+    head = _strip_attribution(text[:match.start()])
+    if match.group("separator"):
+        # Outlook形式では区切り以降の履歴が「>」なしで続く
+        return head, len(text) - len(head)
+
+    parts = [head]
+    while True:
+        # match は引用の塊の先頭。塊の終わりから次の引用 (または区切り) までが新しく書かれた部分
+        end = _QUOTE_END_RE.search(text, match.start())
+        if end is None:
+            break
+        next_match = _QUOTE_START_RE.search(text, end.end())
+        gap = text[end.end():next_match.start() if next_match else len(text)]
+        if next_match is None:
+            parts.append(gap.strip())
+            break
+        # 次の引用の帰属行は取り除く
+        parts.append(_strip_attribution(gap).strip())
+        if next_match.group("separator"):
+            break
+        match = next_match
+    fresh = "\n".join(part for part in parts if part)
+    return fresh, len(text) - len(fresh)
+
+def iter_new_content(bodies):
+    """
+    スレッド内のメッセージ本文を古い順に受け取り、走査すべきテキストを順に返すジェネレータ。
+    最初のメッセージはスレッド外 (転送元など) の引用を含み得るため、全文をそのまま返す。
+    """
+    for index, body in enumerate(bodies):
+        if index == 0 or not body:
+            yield body
+            continue
+        fresh, skipped = split_new_content(body)
+        if skipped:
+            QUOTED_CHARS_SKIPPED.inc(skipped)
+        yield fresh
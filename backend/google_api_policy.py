@@ -0,0 +1,231 @@
+"""
+全てのGoogle API呼び出しに共通で適用する実行ポリシー (レート制限・再試行・期限)。
+google_clients.InstrumentedHttpRequest.execute() と Gmailのバッチリクエストがこのモジュールを通る。
+
+・APIごとのトークンバケットで、1秒あたりのリクエスト数 (Gmailはクォータ単位) をクォータ以下に抑える。
+  バケットが空の場合は、失敗させずにトークンが貯まるまで待つ。
+・429、403 rateLimitExceeded / userRateLimitExceeded はジッター付き指数バックオフで再試行する。
+  Retry-After ヘッダーがあればその秒数だけ待つ。
+・5xxと通信エラーは、同じリクエストを送り直しても結果が変わらない読み取り (GET) のみ再試行する。
+  複製や書き込みを送り直すと二重に作成・書き込みされる恐れがあるため。
+・1回の呼び出しには GOOGLE_API_CALL_DEADLINE_SECONDS の期限があり、
+  トークン待ちや再試行の待ち時間が期限を超える場合は待たずにエラーにする。
+"""
+import datetime
+import email.utils
+import random
+import threading
+import time
+
+import google.auth.exceptions
+import httplib2
+import requests
+from googleapiclient.errors import HttpError
+
+from config import settings
+from metrics import REGISTRY, record_retry, track_api_call
+
+# 再試行の対象とする403エラーの理由
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+# Gmail APIのメソッドごとのクォータ単位 (https://developers.google.com/gmail/api/reference/quota)
+GMAIL_METHOD_COSTS = {
+    "users.getProfile": 1,
+    "users.history.list": 2,
+    "users.messages.get": 5,
+    "users.messages.list": 5,
+    "users.threads.get": 10,
+    "users.threads.list": 10,
+}
+DEFAULT_GMAIL_METHOD_COST = 5
+
+RATE_LIMIT_WAIT = REGISTRY.histogram(
+    "google_api_rate_limit_wait_seconds", "レート制限のトークン待ちの時間 (秒)", ["bucket"])
+
+class ApiDeadlineExceeded(TimeoutError):
+    """Google API呼び出しが期限 (GOOGLE_API_CALL_DEADLINE_SECONDS) までに完了しない場合の例外。"""
+
+class TokenBucket:
+    """rate 個/秒 で補充され、最大 capacity 個まで貯まるトークンバケット (スレッドセーフ)。"""
+
+    def __init__(self, name: str, rate: float, capacity: float):
+        self.name = name
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0, deadline: float | None = None):
+        """amount 個のトークンを取り出す。足りなければ貯まるまで待ち、期限を超える場合は ApiDeadlineExceeded。"""
+        # 容量を超える要求は永久に満たされないため、容量分で打ち切る
+        amount = min(amount, self.capacity)
+        started_at = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    if now > started_at:
+                        RATE_LIMIT_WAIT.observe(now - started_at, bucket=self.name)
+                    return
+                wait = (amount - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                raise ApiDeadlineExceeded(f"レート制限 ({self.name}) の待ち時間が呼び出しの期限を超えます。")
+            time.sleep(wait)
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def _bucket_limits(name: str) -> tuple:
+    """バケット名ごとの (1秒あたりの補充数, 最大保持数)。"""
+    return {
+        "gmail": (settings.gmail_api_units_per_second, settings.gmail_api_burst_units),
+        "drive_read": (settings.drive_api_reads_per_second, settings.drive_api_read_burst),
+        "drive_write": (settings.drive_api_writes_per_second, settings.drive_api_write_burst),
+        "docs_read": (settings.docs_api_reads_per_second, settings.docs_api_read_burst),
+        "docs_write": (settings.docs_api_writes_per_second, settings.docs_api_write_burst),
+    }.get(name, (0, 0))
+
+def get_bucket(name: str) -> TokenBucket | None:
+    """バケットを返す (プロセス内で共有)。補充数が0以下なら制限しないのでNone。"""
+    with _buckets_lock:
+        if name not in _buckets:
+            rate, capacity = _bucket_limits(name)
+            _buckets[name] = TokenBucket(name, rate, capacity) if rate > 0 else None
+        return _buckets[name]
+
+def reset_rate_limiters():
+    """バケットを破棄する。設定を変更した後や、ベンチマークの条件を切り替える時に呼ぶ。"""
+    with _buckets_lock:
+        _buckets.clear()
+
+def request_cost(api: str, method: str, write: bool) -> tuple:
+    """リクエストが使う (バケット名, トークン数)。Gmailはクォータ単位、Drive/Docsは読み取り・書き込み別の件数。"""
+    if api == "gmail":
+        return "gmail", GMAIL_METHOD_COSTS.get(method, DEFAULT_GMAIL_METHOD_COST)
+    return f"{api}_{'write' if write else 'read'}", 1
+
+def call_deadline() -> float | None:
+    """今から始める呼び出しの期限 (time.monotonic() 基準)。期限を設けない設定ならNone。"""
+    if settings.google_api_call_deadline_seconds <= 0:
+        return None
+    return time.monotonic() + settings.google_api_call_deadline_seconds
+
+def is_rate_limit_error(error: HttpError) -> bool:
+    """HttpErrorがレート制限によるもの (429 または 403 rateLimitExceeded) かどうかを判定する。"""
+    status = getattr(error, "status_code", None) or int(error.resp.status)
+    if status == 429:
+        return True
+    if status != 403:
+        return False
+
+    details = error.error_details if isinstance(error.error_details, list) else []
+    reasons = {d.get("reason") for d in details if isinstance(d, dict)}
+    if reasons & RATE_LIMIT_REASONS:
+        return True
+    # error_detailsが解析できない場合はレスポンス本文で判定する
+    content = error.content.decode("utf-8", "ignore") if isinstance(error.content, bytes) else str(error.content)
+    return any(reason in content for reason in RATE_LIMIT_REASONS)
+
+_network_errors = None
+
+def _network_error_types() -> tuple:
+    """
+    通信エラーとみなす例外の型。トランスポート (httplib2 / requests / httpx) ごとに送出する例外が異なる。
+    httpx は任意の依存関係なので、入っている場合だけ加える。
+    """
+    global _network_errors
+    if _network_errors is None:
+        types = [
+            ConnectionError,
+            TimeoutError,
+            httplib2.HttpLib2Error,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            google.auth.exceptions.TransportError,
+        ]
+        try:
+            import httpx
+            types.append(httpx.TransportError)
+        except ImportError:
+            pass
+        _network_errors = tuple(types)
+    return _network_errors
+
+def retry_reason(error: Exception, idempotent: bool = True) -> str | None:
+    """再試行すべきエラーなら理由 (rate_limit / server_error / network) を、そうでなければNoneを返す。"""
+    if isinstance(error, HttpError):
+        if is_rate_limit_error(error):
+            return "rate_limit"
+        if idempotent and int(error.resp.status) >= 500:
+            return "server_error"
+        return None
+    if idempotent and isinstance(error, _network_error_types()) \
+            and not isinstance(error, ApiDeadlineExceeded):
+        return "network"
+    return None
+
+def _retry_after_seconds(error: Exception) -> float | None:
+    """Retry-After ヘッダー (秒数またはHTTP日付) が示す待ち時間。"""
+    resp = getattr(error, "resp", None)
+    value = resp.get("retry-after") if resp is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """attempt回目 (0始まり) の再試行までの待ち時間 (秒)。Retry-After がなければジッター付き指数バックオフ。"""
+    retry_after = _retry_after_seconds(error)
+    if retry_after is not None:
+        return retry_after
+    delay = min(settings.google_api_backoff_max_seconds, settings.google_api_backoff_base_seconds * (2 ** attempt))
+    return delay * (0.5 + random.random() / 2)
+
+def wait_before_retry(api: str, method: str, error: Exception, reason: str, attempt: int,
+                      deadline: float | None) -> bool:
+    """
+    再試行までの時間だけ待つ。再試行の上限に達した場合や、待つと期限を超える場合は待たずにFalseを返す。
+    """
+    if attempt >= settings.google_api_max_retries:
+        return False
+    delay = retry_delay(error, attempt)
+    if deadline is not None and time.monotonic() + delay > deadline:
+        return False
+    record_retry(api, reason)
+    print(f"Google API ({api}.{method}) の呼び出しが失敗しました ({reason})。"
+          f"{delay:.1f}秒後に再試行します ({attempt + 1}/{settings.google_api_max_retries})...")
+    time.sleep(delay)
+    return True
+
+def execute_with_policy(api: str, method: str, func, write: bool = False, cost: float | None = None):
+    """
+    func (リクエストを1回送る関数) をレート制限・再試行・期限付きで実行し、その戻り値を返す。
+    write は複製・更新などの書き込みリクエストかどうか。cost を指定するとバケットから取り出すトークン数を上書きする。
+    """
+    bucket_name, default_cost = request_cost(api, method, write)
+    bucket = get_bucket(bucket_name)
+    deadline = call_deadline()
+    attempt = 0
+    while True:
+        if bucket is not None:
+            bucket.acquire(default_cost if cost is None else cost, deadline)
+        try:
+            with track_api_call(api, method):
+                return func()
+        except Exception as error:
+            reason = retry_reason(error, idempotent=not write)
+            if reason is None or not wait_before_retry(api, method, error, reason, attempt, deadline):
+                raise
+            attempt += 1
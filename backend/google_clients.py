@@ -0,0 +1,277 @@
+"""
+Google APIの認証情報とサービスオブジェクトを管理するモジュール。
+google_services.py の各STEPや、複製・書き込みなどの補助モジュールから共通で使う。
+"""
+import datetime
+import threading
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import Resource, build, build_from_document
+from googleapiclient.http import HttpRequest
+
+from config import settings # .envからの設定情報を読み込む
+from discovery_docs import load_discovery_document
+from google_api_policy import execute_with_policy
+from google_transport import close_sessions, create_http, is_thread_safe
+from metrics import record_response_bytes
+
+# スコープ (get_refresh_token.pyと同じものを定義)
+SCOPES = [
+    'https://www.googleapis.com/auth/gmail.readonly',
+    'https://www.googleapis.com/auth/drive',
+    'https://www.googleapis.com/auth/documents'
+]
+
+# 認証情報ファイル (token.json) のパス
+# get_refresh_token.py で refresh_token を .env に保存する方式にしたので、
+# token.json を直接読み書きする処理は不要になる。
+# 代わりに、.env から読み込んだ refresh_token を使用して認証情報を生成する。
+# TOKEN_JSON_PATH = 'token.json' # 不要
+
+# --- 認証情報・APIクライアントのキャッシュ ---
+# 1回のワークフロー実行で各STEPが認証情報の取得とbuild()を繰り返さないように、
+# Credentialsはプロセス内で共有し、アクセストークンは有効期限が近づいた時だけリフレッシュする。
+# サービスオブジェクトは、接続プール付きのトランスポート (google_transport.py) ならスレッド間で共有する。
+# httplib2 はスレッドセーフではないため、その場合はSTEPを並行実行してもよいようにスレッドごとにキャッシュする。
+_credentials_lock = threading.Lock()
+_cached_credentials = None
+
+_service_cache_lock = threading.Lock() # _cache_statsのサービス関連カウンタ用
+_thread_local = threading.local() # services: {(api_name, api_version): (credentials, generation, service)}
+_shared_services = {} # スレッド間で共有するサービス (形式は _thread_local.services と同じ)
+_shared_build_lock = threading.Lock()
+# キャッシュの世代。clear_google_client_cache() などで増やし、全スレッドのサービスを作り直させる
+_service_generation = 0
+
+# サービスが使うHTTPトランスポートを作る関数 (認証情報を受け取り、httplib2.Http互換のオブジェクトを返す)。
+# 返すオブジェクトの thread_safe 属性がTrueならサービスをスレッド間で共有する。
+# Noneの場合は GOOGLE_HTTP_TRANSPORT に従って google_transport.create_http() で作る。
+_http_factory = None
+
+_cache_stats = {
+    "credentials_hits": 0,
+    "credentials_misses": 0,
+    "credentials_refreshes": 0,
+    "service_hits": 0,
+    "service_misses": 0,
+}
+
+def _utcnow():
+    # google-authのexpiryはタイムゾーンなしのUTCで保持されている
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def _needs_refresh(creds):
+    """アクセストークンが無い、または有効期限が近い場合にTrueを返す。"""
+    if not creds.token:
+        return True
+    if creds.expiry is None:
+        return False
+    margin = datetime.timedelta(seconds=settings.google_token_refresh_margin_seconds)
+    return creds.expiry - margin <= _utcnow()
+
+def get_credentials():
+    """Google APIの認証情報を取得または更新する。
+
+    一度作成した認証情報はプロセス内でキャッシュし、有効期限が近い場合のみリフレッシュする。
+    """
+    global _cached_credentials
+
+    with _credentials_lock:
+        creds = _cached_credentials
+        if creds and creds.valid and not _needs_refresh(creds):
+            _cache_stats["credentials_hits"] += 1
+            return creds
+
+        _cache_stats["credentials_misses"] += 1
+        if creds is None:
+            # .envファイルからリフレッシュトークンなどを読み込む
+            if settings.google_refresh_token and settings.google_client_id and settings.google_client_secret:
+                creds = Credentials.from_authorized_user_info(info={
+                    "refresh_token": settings.google_refresh_token,
+                    "client_id": settings.google_client_id,
+                    "client_secret": settings.google_client_secret,
+                    "token_uri": "https://oauth2.googleapis.com/token", # トークンエンドポイント
+                }, scopes=SCOPES) # Credentialsオブジェクト作成時にscopesを渡す
+
+        # 認証情報が存在し、かつ有効期限切れ(または期限間近)の場合はリフレッシュする
+        if creds and creds.refresh_token and _needs_refresh(creds):
+            try:
+                creds.refresh(Request())
+                _cache_stats["credentials_refreshes"] += 1
+            except Exception as e:
+                print(f"リフレッシュトークンの更新に失敗しました: {e}")
+                # ユーザーに再度get_refresh_token.pyの実行を促す必要がある
+                # Noneを返して、呼び出し元でエラー処理をする想定
+                _cached_credentials = None
+                return None
+
+        if not creds or not creds.valid:
+            # 有効な認証情報がない場合はエラーメッセージを表示 (本来はここで再度認証フローを促す)
+            print("有効な認証情報が見つかりません。get_refresh_token.py を実行して、")
+            print("取得したリフレッシュトークンを backend/.env に正しく設定してください。")
+            _cached_credentials = None
+            return None
+
+        _cached_credentials = creds
+        return creds
+
+class InstrumentedHttpRequest(HttpRequest):
+    """
+    execute() ごとに所要時間・結果・レスポンスサイズをメトリクスに記録するHttpRequest。
+    実行は google_api_policy を通し、レート制限・再試行・期限を適用する。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # methodIdは "gmail.users.messages.list" のような形式
+        self.api_name, _, self.api_method = (self.methodId or "unknown").partition(".")
+        original_postproc = self.postproc
+
+        def postproc(resp, content):
+            record_response_bytes(self.api_name, len(content or b""))
+            return original_postproc(resp, content)
+
+        self.postproc = postproc
+
+    def execute(self, http=None, num_retries=0):
+        # 再試行は google_api_policy で行うため、googleapiclient自身の再試行 (num_retries) は使わない
+        return execute_with_policy(
+            self.api_name, self.api_method, lambda: super(InstrumentedHttpRequest, self).execute(http=http),
+            write=self.method != "GET",
+        )
+
+def _lookup_service(services: dict, key, creds, generation):
+    cached = services.get(key)
+    # 認証情報が作り直された場合やキャッシュが破棄された場合はサービスも作り直す
+    if cached and cached[0] is creds and cached[1] == generation:
+        with _service_cache_lock:
+            _cache_stats["service_hits"] += 1
+        return cached[2]
+    return None
+
+def get_service(api_name: str, api_version: str, creds=None):
+    """キャッシュ済みのGoogle APIサービスオブジェクトを返す。
+
+    トランスポートがスレッドセーフ (接続プール付きのセッション) ならサービスはプロセス内で共有し、
+    httplib2 の場合はスレッドごとに作る。認証情報が取得できない場合はNoneを返す。
+    """
+    if creds is None:
+        creds = get_credentials()
+        if not creds:
+            return None
+
+    services = getattr(_thread_local, "services", None)
+    if services is None:
+        services = _thread_local.services = {}
+
+    key = (api_name, api_version)
+    generation = _service_generation
+    service = _lookup_service(_shared_services, key, creds, generation) or _lookup_service(services, key, creds, generation)
+    if service is not None:
+        return service
+
+    http = _http_factory(creds) if _http_factory is not None else create_http(creds)
+    if not is_thread_safe(http):
+        services[key] = (creds, generation, _build_service(api_name, api_version, http))
+        return services[key][2]
+
+    # build() はディスカバリー文書の解析で重いため、共有するサービスは1つのスレッドだけが作る
+    with _shared_build_lock:
+        service = _lookup_service(_shared_services, key, creds, generation)
+        if service is None:
+            service = _build_service(api_name, api_version, http)
+            _shared_services[key] = (creds, generation, service)
+        return service
+
+def _build_service(api_name: str, api_version: str, http):
+    with _service_cache_lock:
+        _cache_stats["service_misses"] += 1
+    # 同梱の前処理済みディスカバリー文書があればそれを使う (実行時に取得・解析し直さない)
+    document = load_discovery_document(api_name, api_version)
+    if document is not None:
+        service = build_from_document(document, http=http, requestBuilder=InstrumentedHttpRequest)
+    else:
+        service = build(
+            api_name, api_version, http=http, cache_discovery=False, requestBuilder=InstrumentedHttpRequest,
+        )
+    return CachedResource(service)
+
+# googleapiclientは service.documents() や service.users() を呼ぶたびに Resource を作り直し、
+# その際に全メソッドのdocstringをスキーマから生成する (Docs APIでは1回あたり数十ミリ秒のCPU時間)。
+# 書き込みや複製を並行実行するとこの処理がGILを占有し、イベントループの応答まで遅れるため、
+# コレクションの Resource はサービスごとに1回だけ作って使い回す (Resourceは呼び出しごとの状態を持たない)。
+# googleapiclientの内部属性には触れず、公開されている呼び出しと Resource 型だけでラップする。
+class CachedResource:
+    """
+    Resource のラッパー。引数なしの呼び出しが Resource を返す属性 (コレクション) は結果を使い回し、
+    それ以外の属性 (メソッドや new_batch_http_request など) はそのまま元の Resource に任せる。
+    """
+
+    def __init__(self, resource):
+        self._resource = resource
+        self._lock = threading.Lock()
+        self._collections = {} # 名前 -> CachedResource
+        self._methods = set() # 引数なしで呼んでも Resource を返さなかった名前
+
+    def __getattr__(self, name):
+        attr = getattr(self._resource, name)
+        if not callable(attr) or name in self._methods:
+            return attr
+
+        def call(*args, **kwargs):
+            if args or kwargs:
+                return attr(*args, **kwargs)
+            with self._lock:
+                cached = self._collections.get(name)
+            if cached is not None:
+                return cached
+            result = attr()
+            with self._lock:
+                if not isinstance(result, Resource):
+                    self._methods.add(name)
+                    return result
+                return self._collections.setdefault(name, CachedResource(result))
+
+        call.__doc__ = attr.__doc__
+        return call
+
+    def __dir__(self):
+        return dir(self._resource)
+
+def get_cache_stats():
+    """認証情報・サービスキャッシュのヒット/ミス数とリフレッシュ回数を返す。"""
+    with _credentials_lock, _service_cache_lock:
+        return dict(_cache_stats)
+
+def clear_google_client_cache():
+    """キャッシュ済みの認証情報とサービスオブジェクトを破棄する。
+
+    各スレッドのサービスは次に get_service() が呼ばれた時点で作り直される。
+    共有の接続プールも閉じ、次の呼び出しで接続し直す。
+    """
+    global _cached_credentials, _service_generation
+    with _credentials_lock:
+        _cached_credentials = None
+    with _service_cache_lock:
+        _service_generation += 1
+    close_sessions()
+
+def set_http_factory(factory):
+    """
+    サービスが使うHTTPトランスポートを差し替える (Noneでデフォルトに戻す)。
+    factory は認証情報を受け取り、httplib2.Http互換のオブジェクトを返す関数。
+    返すオブジェクトに thread_safe = True があれば、サービスはスレッド間で共有される。
+    ベンチマーク用の偽トランスポートなどを使う場合に呼ぶ。
+    """
+    global _http_factory, _service_generation
+    with _service_cache_lock:
+        _http_factory = factory
+        _service_generation += 1
+
+def set_credentials(creds):
+    """外部で用意した認証情報をキャッシュに設定する (ベンチマークなどで使う)。"""
+    global _cached_credentials, _service_generation
+    with _credentials_lock:
+        _cached_credentials = creds
+    with _service_cache_lock:
+        _service_generation += 1
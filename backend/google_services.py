@@ -1,75 +1,92 @@
 import os.path
 import re
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow # get_refresh_token.py で使用したが、ここでは直接は使わない想定
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
 from config import settings # .envからの設定情報を読み込む
+# 認証情報とサービスオブジェクトのキャッシュは google_clients.py で管理する
+from google_clients import (
+    SCOPES,
+    get_credentials,
+    get_service,
+    get_cache_stats,
+    clear_google_client_cache,
+)
+from doc_pool import get_document_pool
+from executors import map_bounded
+from drive_copy import CopyResult, bulk_copy_file, notify_copied
+from drive_folder_index import get_folder_index
+from gmail_cache import gmail_search_cache
+from gmail_mime import extract_message_text
+from gmail_quotes import iter_new_content
+from google_api_policy import GMAIL_METHOD_COSTS, call_deadline, execute_with_policy, retry_reason, wait_before_retry
+from template_cache import template_cache
+from url_extraction import extract_urls, iter_urls
+from metrics import observe_step
 
-# スコープ (get_refresh_token.pyと同じものを定義)
-SCOPES = [
-    'https://www.googleapis.com/auth/gmail.readonly',
-    'https://www.googleapis.com/auth/drive',
-    'https://www.googleapis.com/auth/documents'
-]
-
-# 認証情報ファイル (token.json) のパス
-# get_refresh_token.py で refresh_token を .env に保存する方式にしたので、
-# token.json を直接読み書きする処理は不要になる。
-# 代わりに、.env から読み込んだ refresh_token を使用して認証情報を生成する。
-# TOKEN_JSON_PATH = 'token.json' # 不要
-
-def get_credentials():
-    """Google APIの認証情報を取得または更新する。"""
-    creds = None
-    # .envファイルからリフレッシュトークンなどを読み込む
-    if settings.google_refresh_token and settings.google_client_id and settings.google_client_secret:
-        creds = Credentials.from_authorized_user_info(info={
-            "refresh_token": settings.google_refresh_token,
-            "client_id": settings.google_client_id,
-            "client_secret": settings.google_client_secret,
-            "token_uri": "https://oauth2.googleapis.com/token", # トークンエンドポイント
-            # "scopes": SCOPES # ここでscopesを指定することも可能だが、build時に渡すので必須ではない
-        }, scopes=SCOPES) # Credentialsオブジェクト作成時にscopesを渡す
-
-    # 認証情報が存在し、かつ有効期限切れの場合はリフレッシュする
-    if creds and creds.expired and creds.refresh_token:
-        try:
-            creds.refresh(Request())
-            # (オプション) リフレッシュ後の認証情報を保存する場合（今回は.envのrefresh_tokenを使うので不要）
-            # with open(TOKEN_JSON_PATH, 'w') as token_file:
-            #     token_file.write(creds.to_json())
-        except Exception as e:
-            print(f"リフレッシュトークンの更新に失敗しました: {e}")
-            # ここでエラーが発生した場合、ユーザーに再度get_refresh_token.pyの実行を促すなどの対応が必要
-            # 今回はNoneを返して、呼び出し元でエラー処理をする想定
-            return None
-    
-    if not creds or not creds.valid:
-        # 有効な認証情報がない場合はエラーメッセージを表示 (本来はここで再度認証フローを促す)
-        print("有効な認証情報が見つかりません。get_refresh_token.py を実行して、")
-        print("取得したリフレッシュトークンを backend/.env に正しく設定してください。")
-        return None
+def extract_urls_from_text(text):
+    """与えられたテキストからURLを抽出する。正規化したURLを、重複を除いて最初に出現した順に返す。"""
+    return extract_urls(text)
 
-    return creds
+def fetch_messages_batch(service, message_ids: list, format: str = 'full'):
+    """
+    複数のメッセージをGmailのバッチリクエストでまとめて取得する。
+    戻り値は {メッセージID: メッセージ} の辞書。いずれかの取得に失敗した場合はそのHttpErrorを送出する。
+    バッチ内の一部がレート制限などで失敗した場合は、その分だけを待ってから取得し直す。
+    """
+    fetched = {}
+    errors = {}
 
-def extract_urls_from_text(text):
-    """与えられたテキストからURLを抽出する。"""
-    if not text:
-        return []
-    # 簡単なURL抽出の正規表現 (より複雑なものが必要な場合あり)
-    url_pattern = r'https?://[\S]+'
-    urls = re.findall(url_pattern, text)
-    return list(set(urls)) # 重複を排除して返す
-
-def step1_get_audio_material_urls():
+    def callback(request_id, response, exception):
+        if exception is not None:
+            errors[request_id] = exception
+        else:
+            fetched[request_id] = response
+
+    batch_size = max(1, settings.gmail_batch_size)
+    deadline = call_deadline()
+    pending = list(message_ids)
+    attempt = 0
+    while pending:
+        errors.clear()
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            batch = service.new_batch_http_request(callback=callback)
+            for msg_id in chunk:
+                batch.add(service.users().messages().get(userId='me', id=msg_id, format=format), request_id=msg_id)
+            execute_with_policy(
+                'gmail', 'batch', batch.execute,
+                cost=len(chunk) * GMAIL_METHOD_COSTS['users.messages.get'],
+            )
+
+        failed = [msg_id for msg_id in pending if msg_id in errors]
+        if not failed:
+            break
+        first_error = errors[failed[0]]
+        reasons = {retry_reason(errors[msg_id]) for msg_id in failed}
+        if None in reasons or not wait_before_retry('gmail', 'batch', first_error, reasons.pop(), attempt, deadline):
+            raise first_error
+        pending = failed
+        attempt += 1
+    return fetched
+
+def _sender_address(msg) -> str:
+    """メッセージのFromヘッダーから送信者のメールアドレスを取り出す。"""
+    for header in msg.get('payload', {}).get('headers', []):
+        if header['name'].lower() == 'from':
+            sender = header['value']
+            # <example@example.com> のような形式からメールアドレスのみを抽出
+            match = re.search(r'<([^>]+)>', sender)
+            return match.group(1) if match else sender
+    return ""
+
+@observe_step("STEP1")
+def step1_get_audio_material_urls(query: str | None = None):
     """
     STEP1: 「本日の音声素材」というワードでGmailを検索し、
     検索結果で一番上のものを開く。
     そのメールそのものと、スレッドに返信されたURLを、
     それぞれ送信者を明記して全て出力する。ただし、同一URLは重複して出力しない。
+    query を省略した場合は GMAIL_QUERY_AUDIO で検索する。
     出力形式:
     送信者メールアドレス
     https://example.com/url
@@ -79,10 +96,17 @@ def step1_get_audio_material_urls():
         return "エラー: Gmail APIの認証に失敗しました。"
 
     try:
-        service = build('gmail', 'v1', credentials=creds)
+        service = get_service('gmail', 'v1', creds)
 
         # 1. 「本日の音声素材」でメールを検索
-        query = settings.gmail_query_audio
+        query = query or settings.gmail_query_audio
+
+        # 同じクエリの結果がキャッシュにあり、その後新着メールがなければそれを返す
+        cached_result = gmail_search_cache.lookup(service, "STEP1", query)
+        if cached_result is not None:
+            return cached_result
+        history_id = gmail_search_cache.current_history_id(service)
+
         print(f"Gmailを検索中: '{query}'")
         results = service.users().messages().list(userId='me', q=query, maxResults=1).execute()
         messages = results.get('messages', [])
@@ -94,49 +118,49 @@ def step1_get_audio_material_urls():
         # list APIは通常、最新のものが先頭に来るが、ソート順が保証されていない場合もあるため、
         # 必要であればthreadIdでソートするか、より詳細なクエリを使う。ここでは先頭を取得。
         message_id = messages[0]['id']
-        
+
         # スレッドIDを取得 (同じスレッド内のメールを全て取得するため)
-        message_detail = service.users().messages().get(userId='me', id=message_id, format='metadata', metadataHeaders=['threadId']).execute()
-        thread_id = message_detail.get('threadId')
+        # list APIの結果には通常threadIdが含まれているので、その場合はメタデータの再取得を省略する
+        thread_id = messages[0].get('threadId')
+        if not thread_id:
+            message_detail = service.users().messages().get(userId='me', id=message_id, format='metadata', metadataHeaders=['threadId']).execute()
+            thread_id = message_detail.get('threadId')
 
         if not thread_id:
             return "エラー: メールのスレッドIDを取得できませんでした。"
 
         print(f"スレッドID {thread_id} のメールを処理中...")
-        thread_messages = service.users().threads().get(userId='me', id=thread_id).execute()
-        
-        all_urls_with_senders = {} # {url: sender} の形式で重複を管理
+        # threads().get (format='full') はスレッド内の全メッセージのペイロードを含むため、
+        # メッセージごとに messages().get を呼ぶ必要はない
+        thread_messages = service.users().threads().get(userId='me', id=thread_id, format='full').execute()
+        thread_message_list = thread_messages.get('messages', [])
+
+        # ペイロードが欠けているメッセージがあれば、それだけをバッチリクエストでまとめて再取得する
+        missing_ids = [m['id'] for m in thread_message_list if 'payload' not in m]
+        if missing_ids:
+            print(f"ペイロードのないメッセージ {len(missing_ids)} 件をバッチ取得します...")
+            fetched_messages = fetch_messages_batch(service, missing_ids)
+            thread_message_list = [
+                fetched_messages.get(m['id'], m) if 'payload' not in m else m
+                for m in thread_message_list
+            ]
 
-        for msg_container in thread_messages.get('messages', []):
-            msg_id = msg_container['id']
-            msg = service.users().messages().get(userId='me', id=msg_id).execute()
-            
-            sender = ""
-            for header in msg.get('payload', {}).get('headers', []):
-                if header['name'].lower() == 'from':
-                    sender = header['value']
-                    # <example@example.com> のような形式からメールアドレスのみを抽出
-                    match = re.search(r'<([^>]+)>', sender)
-                    if match:
-                        sender = match.group(1)
-                    break
-            
-            body_text = ""
-            if 'parts' in msg.get('payload', {}):
-                for part in msg['payload']['parts']:
-                    if part['mimeType'] == 'text/plain' and 'data' in part.get('body',{}):
-                        import base64
-                        body_text += base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-                    # HTMLメールの場合の処理も追加可能
-            elif 'body' in msg.get('payload', {}) and 'data' in msg['payload']['body']:
-                 import base64
-                 body_text = base64.urlsafe_b64decode(msg['payload']['body']['data']).decode('utf-8')
-
-            urls_in_mail = extract_urls_from_text(body_text)
-            for url in urls_in_mail:
-                if url not in all_urls_with_senders: # 重複チェック
+        all_urls_with_senders = {} # {url: sender} の形式で、最初に出現した順に保持する
+        seen_url_keys = set() # 同じDrive/Boxのリンクなどを重複とみなすためのキー
+
+        # 返信はそれまでの履歴を引用しているため、古い順に並べて各メールの新しく書かれた部分だけを走査する
+        # (引用されたURLは、引用元のメールの送信者のものとして先に登録される)
+        thread_message_list.sort(key=lambda m: int(m.get('internalDate', 0)))
+        senders = [_sender_address(msg) for msg in thread_message_list]
+        # 入れ子のパートも含めて本文を取り出す (プレーンテキストがなければHTMLから変換)
+        bodies = (extract_message_text(msg.get('payload', {})).text for msg in thread_message_list)
+
+        for sender, body_text in zip(senders, iter_new_content(bodies)):
+            for url, key in iter_urls(body_text):
+                if key not in seen_url_keys: # 重複チェック
+                    seen_url_keys.add(key)
                     all_urls_with_senders[url] = sender
-        
+
         # スレッドの最初のメール本文からもURLを抽出 (もしスレッドAPIで取得した情報に含まれていなければ)
         # Gmail APIでは通常スレッドのメッセージには元のメッセージも含まれる
         # 上記のループで既に処理されているはずなので、ここの処理は冗長かもしれないが念のため。
@@ -155,8 +179,10 @@ def step1_get_audio_material_urls():
             output_lines.append(sender)
             output_lines.append(url)
         
+        result = "\n".join(output_lines)
+        gmail_search_cache.store("STEP1", query, result, history_id)
         print("STEP1 完了: URLと送信者を抽出しました。")
-        return "\n".join(output_lines)
+        return result
 
     except HttpError as error:
         print(f"Gmail APIでエラーが発生しました: {error}")
@@ -165,10 +191,12 @@ def step1_get_audio_material_urls():
         print(f"STEP1で予期せぬエラー: {e}")
         return f"STEP1で予期せぬエラー: {e}"
 
-def step2_get_latest_folder_url():
+@observe_step("STEP2")
+def step2_get_latest_folder_url(folder_id: str | None = None):
     """
     STEP2: 指定されたGoogle Driveフォルダ内で、作成日が最も新しいフォルダの
     フォルダ名とURLを出力する。
+    folder_id を省略した場合は DRIVE_FOLDER_ID_STEP2 のフォルダを検索する。
     出力形式:
     "フォルダ名"
     https://drive.google.com/drive/folders/フォルダID
@@ -178,29 +206,32 @@ def step2_get_latest_folder_url():
         return "エラー: Google Drive APIの認証に失敗しました。"
 
     try:
-        service = build('drive', 'v3', credentials=creds)
-        folder_id = settings.drive_folder_id_step2
+        service = get_service('drive', 'v3', creds)
+        folder_id = folder_id or settings.drive_folder_id_step2
 
         if not folder_id:
             return "エラー: .envにDRIVE_FOLDER_ID_STEP2が設定されていません。"
 
         print(f"Google Drive フォルダID '{folder_id}' 内を検索中...")
-        # フォルダ内で、フォルダタイプ(mimeType)で絞り込み、作成日で降順ソート、最初の1件を取得
-        # fieldsで取得する情報を絞り込む (id, name, webViewLink, createdTime)
-        query = f"'{folder_id}' in parents and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
-        results = service.files().list(
-            q=query,
-            orderBy='createdTime desc',
-            pageSize=1, # 最新の1件のみ取得
-            fields='files(id, name, webViewLink, createdTime)'
-        ).execute()
-        
-        items = results.get('files', [])
+        if settings.drive_folder_index_ttl_seconds > 0:
+            # サブフォルダの索引 (Changes APIで差分を反映) から最新のフォルダを求める
+            latest_folder = get_folder_index(folder_id).latest_folder(service)
+        else:
+            # フォルダ内で、フォルダタイプ(mimeType)で絞り込み、作成日で降順ソート、最初の1件を取得
+            # fieldsで取得する情報を絞り込む (id, name, webViewLink, createdTime)
+            query = f"'{folder_id}' in parents and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
+            results = service.files().list(
+                q=query,
+                orderBy='createdTime desc',
+                pageSize=1, # 最新の1件のみ取得
+                fields='files(id, name, webViewLink, createdTime)'
+            ).execute()
+            items = results.get('files', [])
+            latest_folder = items[0] if items else None
 
-        if not items:
+        if not latest_folder:
             return f"フォルダID '{folder_id}' 内にサブフォルダが見つかりませんでした。"
 
-        latest_folder = items[0]
         folder_name = latest_folder['name']
         folder_url = latest_folder['webViewLink'] # webViewLinkがユーザーがブラウザで開くURL
         # folder_id_latest = latest_folder['id'] # こちらはAPIで使うID
@@ -220,22 +251,30 @@ def step2_get_latest_folder_url():
         print(f"STEP2で予期せぬエラー: {e}")
         return f"STEP2で予期せぬエラー: {e}"
 
-def step3_get_script_email_body():
+@observe_step("STEP3")
+def step3_get_script_email_body(query: str | None = None):
     """
     STEP3: 「撮影分の台本について」というワードでメールを検索し、
     ヒットしたスレッドの一番最初のメールの本文を全て出力する。
+    query を省略した場合は GMAIL_QUERY_SCRIPT で検索する。
     """
     creds = get_credentials()
     if not creds:
         return "エラー: Gmail APIの認証に失敗しました。"
 
     try:
-        service = build('gmail', 'v1', credentials=creds)
-        query = settings.gmail_query_script
+        service = get_service('gmail', 'v1', creds)
+        query = query or settings.gmail_query_script
 
         if not query:
             return "エラー: .envにGMAIL_QUERY_SCRIPTが設定されていません。"
 
+        # 同じクエリの結果がキャッシュにあり、その後新着メールがなければそれを返す
+        cached_result = gmail_search_cache.lookup(service, "STEP3", query)
+        if cached_result is not None:
+            return cached_result
+        history_id = gmail_search_cache.current_history_id(service)
+
         print(f"Gmailを検索中: '{query}' (スレッドの最初のメールを取得する処理)")
         # 1. クエリに合致するメッセージリストを取得 (最新のものが先頭に来ることが多い)
         list_results = service.users().messages().list(userId='me', q=query, maxResults=1).execute()
@@ -280,35 +319,19 @@ def step3_get_script_email_body():
         # 6. そのメールの詳細を取得
         msg = service.users().messages().get(userId='me', id=first_email_in_thread_id).execute()
 
-        body_text = ""
-        payload = msg.get('payload', {})
-        
-        if 'parts' in payload:
-            for part in payload['parts']:
-                if part.get('mimeType') == 'text/plain' and 'body' in part and 'data' in part['body']:
-                    import base64
-                    body_text = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-                    break
-        elif 'body' in payload and 'data' in payload['body']:
-            if payload.get('mimeType') == 'text/plain':
-                import base64
-                body_text = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
-        
-        if not body_text:
-            if 'parts' in payload:
-                for part in payload['parts']:
-                    if part.get('mimeType') == 'text/html' and 'body' in part and 'data' in part['body']:
-                        import base64
-                        html_body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-                        body_text = re.sub(r'<[^>]+>', '', html_body).strip()
-                        if body_text:
-                             print("プレーンテキストが見つからず、HTMLからテキストを抽出しました（簡易処理）。")
-                             break 
-            if not body_text:
-                return "スレッドの最初のメールから本文 (プレーンテキスト) が見つかりませんでした。"
+        # 最初のtext/plainパートを本文とし、なければtext/htmlパートをテキストに変換する
+        message_text = extract_message_text(msg.get('payload', {}), first_only=True)
+        body_text = message_text.text
+        if message_text.from_html and body_text.strip():
+            print("プレーンテキストが見つからず、HTMLからテキストを抽出しました。")
+
+        if not body_text.strip():
+            return "スレッドの最初のメールから本文 (プレーンテキスト) が見つかりませんでした。"
 
+        result = body_text.strip()
+        gmail_search_cache.store("STEP3", query, result, history_id)
         print(f"STEP3 完了: スレッドの最初のメール (ID: '{first_email_in_thread_id}') の本文を取得しました。")
-        return body_text.strip()
+        return result
 
     except HttpError as error:
         print(f"Gmail APIでエラーが発生しました: {error}")
@@ -317,11 +340,16 @@ def step3_get_script_email_body():
         print(f"STEP3で予期せぬエラー: {e}")
         return f"STEP3で予期せぬエラー: {e}"
 
-def step4_duplicate_document(number_of_copies: int):
+@observe_step("STEP4")
+def step4_duplicate_document(number_of_copies: int, existing_files=None, on_copied=None,
+                             template_doc_id: str | None = None):
     """
     STEP4: 指定されたGoogleドキュメントを、指定された数だけ複製する。
     元のファイル名と保存場所を維持する。
     複製した各ドキュメントのタイトルとURLを出力する。
+    existing_files: 前回の実行で作成済みのドキュメント ({id, name}) のリスト。その分は複製せず、足りない分だけ作る
+    on_copied: 作成できたドキュメント (dict) ごとに呼ぶコールバック (実行記録用)
+    template_doc_id: 複製元のテンプレート。省略した場合は DOC_ID_FOR_STEP4
     出力形式:
     元ファイル名
     https://docs.google.com/document/d/複製されたドキュメントID1
@@ -331,30 +359,25 @@ def step4_duplicate_document(number_of_copies: int):
     """
     creds = get_credentials()
     if not creds:
-        return "エラー: Google Drive APIの認証に失敗しました。"
+        return "エラー: Google Drive APIの認証に失敗しました。", []
 
     if number_of_copies <= 0:
-        return "複製するファイル数は1以上である必要があります。"
+        return "エラー: 複製するファイル数は1以上である必要があります。", []
 
     try:
-        drive_service = build('drive', 'v3', credentials=creds)
-        original_doc_id = settings.doc_id_for_step4
+        drive_service = get_service('drive', 'v3', creds)
+        original_doc_id = template_doc_id or settings.doc_id_for_step4
 
         if not original_doc_id:
-            return "エラー: .envにDOC_ID_FOR_STEP4が設定されていません。"
-
-        # 1. 元のドキュメントの情報を取得 (名前と親フォルダID)
-        print(f"元のドキュメントID '{original_doc_id}' の情報を取得中...")
-        original_file_metadata = drive_service.files().get(
-            fileId=original_doc_id,
-            fields='name, parents' # 名前と親フォルダIDを取得
-        ).execute()
+            return "エラー: .envにDOC_ID_FOR_STEP4が設定されていません。", []
 
-        original_doc_name = original_file_metadata.get('name')
-        original_parent_folders = original_file_metadata.get('parents')
+        # 1. 元のドキュメントの情報 (名前と親フォルダID) をキャッシュから取得 (一定間隔で更新の有無を確認する)
+        template = template_cache.describe(drive_service, original_doc_id)
+        original_doc_name = template.name
+        original_parent_folders = template.parents
 
         if not original_doc_name:
-            return f"エラー: 元のドキュメントID '{original_doc_id}' の名前を取得できませんでした。"
+            return f"エラー: 元のドキュメントID '{original_doc_id}' の名前を取得できませんでした。", []
         
         # 親フォルダIDはリストで返ってくるが、通常ドキュメントは1つのフォルダに属すると想定
         # 複数の親を持つ場合も考慮するなら、どの親に複製を置くか選択するロジックが必要
@@ -368,34 +391,63 @@ def step4_duplicate_document(number_of_copies: int):
         duplicated_files_output = [] # STEP4の出力用 (名前とURLのペア)
         duplicated_doc_ids = []      # STEP5への引き渡し用 (ドキュメントIDのリスト)
 
-        print(f"ドキュメント '{original_doc_name}' (ID: {original_doc_id}) を {number_of_copies} 回複製します...")
-
-        for i in range(number_of_copies):
-            print(f"{i+1}回目の複製処理を開始...")
-            copied_file_body = {
-                'name': original_doc_name
-            }
-            if parent_folder_id:
-                copied_file_body['parents'] = [parent_folder_id]
-            
-            copied_file = drive_service.files().copy(
-                fileId=original_doc_id,
-                body=copied_file_body,
-                fields='id, name, webViewLink' # 複製されたファイルのID, 名前, URLを取得
-            ).execute()
-            
-            doc_id = copied_file.get('id')
-            doc_name = copied_file.get('name')
+        # 前回の実行で作成済みのドキュメントはそのまま使い、足りない分だけ作る
+        existing_results = [CopyResult(i, file=f) for i, f in enumerate((existing_files or [])[:number_of_copies])]
+        remaining = number_of_copies - len(existing_results)
+        if existing_results:
+            print(f"作成済みの {len(existing_results)} 個のドキュメントを使います。")
+
+        print(f"ドキュメント '{original_doc_name}' (ID: {original_doc_id}) を {remaining} 回複製します...")
+
+        copied_file_body = {
+            'name': original_doc_name
+        }
+        if parent_folder_id:
+            copied_file_body['parents'] = [parent_folder_id]
+
+        # ドキュメントプールが有効なら、あらかじめ複製しておいたものを移動して使う
+        # (プールの在庫は DOC_ID_FOR_STEP4 の複製なので、別のテンプレートでは使わない)
+        pooled_results = []
+        pool = get_document_pool() if original_doc_id == settings.doc_id_for_step4 else None
+        if pool and remaining > 0:
+            pooled_files = pool.claim(drive_service, template, parent_folder_id, remaining)
+            pooled_results = [notify_copied(CopyResult(i, file=f), on_copied) for i, f in enumerate(pooled_files)]
+
+        # 足りない分の複製リクエストは並行して送信し、結果は依頼順に受け取る
+        copy_results = existing_results + pooled_results + bulk_copy_file(
+            original_doc_id, copied_file_body, remaining - len(pooled_results), on_copied=on_copied
+        )
+
+        failed_results = []
+        for result in copy_results:
+            if not result.ok:
+                failed_results.append(result)
+                continue
+            doc_id = result.file.get('id')
+            doc_name = result.file.get('name')
             doc_url = f"https://docs.google.com/document/d/{doc_id}/edit" # Docsの編集URL形式
-            
+
             duplicated_files_output.append(doc_name)
             duplicated_files_output.append(doc_url)
             duplicated_doc_ids.append(doc_id) # IDをリストに追加
-            print(f"{i+1}回目の複製完了: {doc_name} ({doc_url})")
 
         if not duplicated_doc_ids: # duplicated_files_outputでも良い
-            return "ドキュメントの複製に失敗しました。", [] # STEP5のために空リストも返す
-        
+            first_error = failed_results[0].error if failed_results else None
+            return f"ドキュメントの複製に失敗しました。{first_error or ''}", [] # STEP5のために空リストも返す
+
+        callback_failures = [result for result in copy_results if result.callback_error is not None]
+        if callback_failures:
+            # 複製したドキュメントはこの実行で使うが、実行記録がないため再実行時には使われない
+            print(f"STEP4: {len(callback_failures)}個のドキュメントの実行記録に失敗しました: {callback_failures[0].callback_error}")
+
+        if failed_results:
+            # 一部だけ失敗した場合も、作成済みのドキュメントは出力とIDリストに残す
+            print(f"STEP4: {number_of_copies}個中{len(failed_results)}個の複製に失敗しました。")
+            duplicated_files_output.append(
+                f"エラー: {number_of_copies}個中{len(failed_results)}個の複製に失敗しました: {failed_results[0].error}"
+            )
+            return "\n".join(duplicated_files_output), duplicated_doc_ids
+
         print(f"STEP4 完了: {number_of_copies}個のドキュメントを複製しました。")
         # STEP4の出力文字列と、複製されたドキュメントIDのリストをタプルで返す
         return "\n".join(duplicated_files_output), duplicated_doc_ids
@@ -407,22 +459,17 @@ def step4_duplicate_document(number_of_copies: int):
         print(f"STEP4で予期せぬエラー: {e}")
         return f"STEP4で予期せぬエラー: {e}", []
 
-def step5_write_info_to_documents(document_ids: list, step1_data: str, step2_data: str, step3_data: str):
-    """
-    STEP5: STEP1〜3で出力した内容を、STEP4で複製した全てのファイルに記入する。
-    その後、特定のメッセージを出力する。
-    """
-    creds = get_credentials()
-    if not creds:
-        return "エラー: Google Docs APIの認証に失敗しました。"
-
-    if not document_ids:
-        return "書き込み対象のドキュメントがありません。"
+# STEP5でテンプレートに置いておくと、STEP1〜3の出力に置き換えるプレースホルダー
+STEP5_PLACEHOLDERS = {
+    "STEP1": "{{AUDIO_URLS}}",    # 本日の音声素材関連情報
+    "STEP2": "{{VIDEO_FOLDER}}",  # 最新動画素材フォルダ情報
+    "STEP3": "{{SCRIPT_BODY}}",   # 撮影分の台本メール本文
+}
 
-    try:
-        docs_service = build('docs', 'v1', credentials=creds)
-        
-        content_to_write = f"""【自動追記情報】
+def _step5_append_requests(docs_service, template_id: str, sample_doc_id: str,
+                           step1_data: str, step2_data: str, step3_data: str) -> list:
+    """STEP1〜3の出力をまとめてドキュメントの末尾に追記するリクエストを返す (プレースホルダーのないテンプレート用)。"""
+    content_to_write = f"""【自動追記情報】
 
 --- STEP1: 本日の音声素材関連情報 ---
 {step1_data}
@@ -436,82 +483,126 @@ def step5_write_info_to_documents(document_ids: list, step1_data: str, step2_dat
 --- 自動追記終了 ---
 
 """
-        num_docs = len(document_ids)
-        print(f"合計 {num_docs} 個のドキュメントに情報を書き込みます...")
+    # 複製直後のドキュメントは全てテンプレートと同じ構造なので、
+    # 追記前に改行を入れるかどうかはテンプレートの本文の末尾インデックス (版ごとにキャッシュ) で判定する
+    end_index = template_cache.end_index(docs_service, template_id, sample_doc_id)
+    has_content = end_index > 1 # つまりドキュメントに既に何かしらコンテンツがある
+
+    # endOfSegmentLocation を使用した追記 (推奨)
+    requests = [
+        {
+            'insertText': {
+                'endOfSegmentLocation': {
+                    'segmentId': '' # 空文字列はデフォルトのボディセグメントを示す
+                },
+                'text': content_to_write
+            }
+        }
+    ]
+
+    # ドキュメントが空でない場合、追記内容の前に2行改行を入れる
+    if has_content:
+        requests.insert(0, {
+            'insertText': {
+                'endOfSegmentLocation': {
+                    'segmentId': ''
+                },
+                'text': '\n\n' # 2行改行
+            }
+        })
+    return requests
 
-        for i, doc_id in enumerate(document_ids):
-            print(f"{i+1}/{num_docs} 番目のドキュメント (ID: {doc_id}) に書き込み中...")
-            
-            # ドキュメントの末尾に追記するためのリクエストを作成
-            # まずドキュメントの現在の内容の長さを取得 (あるいは末尾を指定する他の方法)
-            # 簡単な方法として、新しい段落を末尾に挿入する。
-            # Google Docs APIでは、テキストの挿入は通常、特定のインデックスに対して行う。
-            # ドキュメントの末尾に追記するには、まずドキュメントの現在のコンテンツの長さを取得するか、
-            # endOfSegmentLocation を利用できる。
-            # ここでは、まずドキュメントの末尾を示すための空のセグメントIDを指定するアプローチを試みる。
-            # より堅牢なのは、ドキュメントを読み取り、末尾のインデックスを計算すること。
-            # しかし、単純な追記であれば、insertTextで末尾を指定できればよい。
-            # Google Docs APIのinsertTextは通常、location.indexを指定する。
-            # ドキュメントの最後に挿入する場合、ドキュメントの現在の長さを知る必要がある。
-            # Document.body.content の末尾の endIndex を使うのが一般的。
-
-            # ドキュメントの現在の内容を取得して末尾のインデックスを特定
-            document = docs_service.documents().get(documentId=doc_id, fields='body').execute()
-            body_content = document.get('body', {}).get('content', [])
-            end_index = 1 # デフォルトはドキュメントの先頭 (1-based index)
-            if body_content:
-                # ボディの最後の要素のendIndexを取得
-                # ただし、タイトルやヘッダーフッターを含まないメインボディの末尾を意図
-                # Google Docs APIの構造はネストされることがあるので注意
-                # 簡単にするため、最後の構造要素のendIndexを探す
-                # Documentのbody.contentはList of StructuralElement
-                # StructuralElementはparagraph, table, sectionBreak, tableOfContentsを持つ
-                # ここでは最後のStructuralElementのendIndexを単純に取得するが、ドキュメントが空の場合などを考慮
-                # もしドキュメントが完全に空なら、最初の位置(1)に挿入される
-                last_element = body_content[-1]
-                if 'endIndex' in last_element:
-                    end_index = last_element['endIndex']
-                # もしドキュメントの最後に空行を追加してから書き込みたい場合は、
-                # 先に改行を挿入するリクエストを送ることもできる。
-                # 今回は取得したend_indexの直前（つまりコンテンツの本当の末尾）に挿入する。
-                # insertTextのindexは、そのindexの「前」にテキストを挿入する。
-                # なので、end_index -1 が適切。ただし、ドキュメントが空(end_index=1)の場合は1になる。
-                # Google Docs APIでは、endOfSegmentLocation を使った方がより簡単で確実かもしれない。
-                # requests = [
-                #     {
-                #         'insertText': {
-                #             'location': {
-                #                 'index': end_index -1 if end_index > 1 else 1
-                #             },
-                #             'text': content_to_write
-                #         }
-                #     }
-                # ]
-            # endOfSegmentLocation を使用した追記 (推奨)
+@observe_step("STEP5")
+def step5_write_info_to_documents(document_ids: list, step1_data: str, step2_data: str, step3_data: str,
+                                  written_doc_ids=(), on_written=None, template_doc_id: str | None = None):
+    """
+    STEP5: STEP1〜3で出力した内容を、STEP4で複製した全てのファイルに記入する。
+    その後、特定のメッセージを出力する。
+    テンプレートにプレースホルダー (STEP5_PLACEHOLDERS) があればその位置を置き換え、なければ末尾に追記する
+    (STEP5_WRITE_MODE で固定もできる)。どちらも1ドキュメントにつき batchUpdate 1回で書き込む。
+    written_doc_ids: 前回の実行で書き込み済みのドキュメントID。これらには書き込まない
+    on_written: 書き込みが完了したドキュメントIDごとに呼ぶコールバック (実行記録用)
+    template_doc_id: 複製元のテンプレート。省略した場合は DOC_ID_FOR_STEP4
+    """
+    creds = get_credentials()
+    if not creds:
+        return "エラー: Google Docs APIの認証に失敗しました。"
+
+    if not document_ids:
+        return "書き込み対象のドキュメントがありません。"
+
+    try:
+        docs_service = get_service('docs', 'v1', creds)
+        
+        num_docs = len(document_ids)
+        # 同じドキュメントに二重に追記しないよう、書き込み済みのものは飛ばす
+        written = set(written_doc_ids)
+        pending_doc_ids = [doc_id for doc_id in document_ids if doc_id not in written]
+        if not pending_doc_ids:
+            print("全てのドキュメントに書き込み済みです。")
+            return "全てのファイルに情報を記入しました。"
+        if len(pending_doc_ids) < num_docs:
+            print(f"{num_docs - len(pending_doc_ids)} 個のドキュメントは書き込み済みのため飛ばします。")
+        print(f"合計 {len(pending_doc_ids)} 個のドキュメントに情報を書き込みます...")
+
+        template_id = template_doc_id or settings.doc_id_for_step4
+        replacements = {
+            STEP5_PLACEHOLDERS["STEP1"]: step1_data,
+            STEP5_PLACEHOLDERS["STEP2"]: step2_data,
+            STEP5_PLACEHOLDERS["STEP3"]: step3_data,
+        }
+        write_mode = settings.step5_write_mode.lower()
+        if write_mode == "auto":
+            # 複製直後のドキュメントは全てテンプレートと同じ内容なので、
+            # プレースホルダーの有無はテンプレートの本文 (版ごとにキャッシュ) で判定する
+            template_text = template_cache.text(docs_service, template_id, pending_doc_ids[0])
+            write_mode = "placeholders" if any(p in template_text for p in replacements) else "append"
+
+        if write_mode == "placeholders":
+            # replaceAllText は位置を指定しないため、書き込み前にドキュメントを読む必要がない
             requests = [
                 {
-                    'insertText': {
-                        'endOfSegmentLocation': {
-                            'segmentId': '' # 空文字列はデフォルトのボディセグメントを示す
-                        },
-                        'text': content_to_write
+                    'replaceAllText': {
+                        'containsText': {'text': placeholder, 'matchCase': True},
+                        'replaceText': value,
                     }
                 }
+                for placeholder, value in replacements.items()
             ]
-
-            # ドキュメントが空でない場合、追記内容の前に2行改行を入れる
-            if end_index > 1: # つまりドキュメントに既に何かしらコンテンツがある
-                 requests.insert(0, {
-                    'insertText': {
-                        'endOfSegmentLocation': {
-                            'segmentId': ''
-                        },
-                        'text': '\n\n' # 2行改行
-                    }
-                })
-
-            docs_service.documents().batchUpdate(documentId=doc_id, body={'requests': requests}).execute()
-            print(f"ドキュメントID: {doc_id} への書き込み完了。")
+        elif write_mode == "append":
+            requests = _step5_append_requests(
+                docs_service, template_id, pending_doc_ids[0], step1_data, step2_data, step3_data)
+        else:
+            return f"エラー: 不明なSTEP5_WRITE_MODEです: {settings.step5_write_mode}"
+
+        def write_one(doc_id):
+            # get_service はトランスポートに応じて共有またはスレッドごとのサービスを返す
+            try:
+                service = get_service('docs', 'v1')
+                if not service:
+                    raise RuntimeError("Google Docs APIの認証に失敗しました。")
+                response = service.documents().batchUpdate(documentId=doc_id, body={'requests': requests}).execute()
+                if write_mode == "placeholders":
+                    replaced = sum(
+                        reply.get('replaceAllText', {}).get('occurrencesChanged', 0)
+                        for reply in response.get('replies', [])
+                    )
+                    if not replaced:
+                        # 何も書き込まれていないため、書き込み済みとして記録せずにエラーとする
+                        raise RuntimeError(f"ドキュメントID: {doc_id} にプレースホルダーが見つかりませんでした。")
+                if on_written:
+                    on_written(doc_id)
+                print(f"ドキュメントID: {doc_id} への書き込み完了。")
+                return None
+            except Exception as e:
+                print(f"ドキュメントID: {doc_id} への書き込みに失敗しました: {e}")
+                return e
+
+        # 各ドキュメントへの書き込みは独立しているため、共有のAPI用スレッドプールで上限付きで並行実行する
+        errors = [e for e in map_bounded(write_one, pending_doc_ids, settings.step5_max_workers) if e is not None]
+
+        if errors:
+            return f"Google Docs APIエラー: {len(pending_doc_ids)}個中{len(errors)}個のドキュメントへの書き込みに失敗しました: {errors[0]}"
 
         final_message = "全てのファイルに情報を記入しました。"
         print(f"STEP5 完了: {final_message}")
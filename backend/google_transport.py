@@ -0,0 +1,130 @@
+"""
+Google APIのサービスオブジェクトが使うHTTPトランスポート。
+googleapiclientが呼び出す httplib2.Http 互換の request() を、接続プール付きのHTTPクライアントの上に実装する。
+GOOGLE_HTTP_TRANSPORT で切り替える。
+    requests: google-authの AuthorizedSession (urllib3の接続プールとHTTP/1.1 keep-alive) (デフォルト)
+    httpx:    httpxのクライアントでHTTP/2を使う (httpx と h2 パッケージが必要。無ければ requests を使う)
+    httplib2: googleapiclientのデフォルトと同じ AuthorizedHttp + httplib2 (スレッドごとに接続を持つ)
+
+requests / httpx のクライアントはプロセス内で1つを共有し、同時に送られたリクエストには
+プール内の別々の接続を割り当てる (httpxのHTTP/2では1つの接続で多重化する)。
+STEPが変わっても接続を使い回すため、小さなGmail/Docsの呼び出しのたびにTLSハンドシェイクをしなくて済む。
+"""
+import threading
+
+import httplib2
+from requests.adapters import HTTPAdapter
+from google.auth.transport.requests import AuthorizedSession, Request
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.http import build_http
+
+from config import settings
+
+# レスポンスのうち、クライアントが処理済みのためgoogleapiclientに渡さないヘッダー
+# (requests/httpxは gzip を展開済みなので、Content-Encoding と Content-Length は展開前の値になっている)
+_CONSUMED_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+def _timeout() -> float | None:
+    # ソケットのタイムアウトは呼び出しの期限 (google_api_policy) に合わせる
+    return settings.google_api_call_deadline_seconds if settings.google_api_call_deadline_seconds > 0 else None
+
+def _to_httplib2_response(status: int, headers) -> httplib2.Response:
+    info = {key.lower(): value for key, value in headers.items() if key.lower() not in _CONSUMED_HEADERS}
+    info["status"] = str(status)
+    return httplib2.Response(info)
+
+def _request_body(body, headers: dict):
+    # Content-Length はクライアントが送る本文から計算し直す
+    headers = {key: value for key, value in (headers or {}).items() if key.lower() != "content-length"}
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return body, headers
+
+class PooledHttp:
+    """httplib2.Http 互換のアダプタ。共有のセッションにリクエストを渡すだけなので、スレッド間で共有してよい。"""
+
+    thread_safe = True
+
+    def __init__(self, session):
+        self.session = session
+        self.timeout = _timeout()
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=5, connection_type=None):
+        body, headers = _request_body(body, headers)
+        response = self.session.request(
+            method, uri, data=body, headers=headers, timeout=self.timeout, allow_redirects=redirections > 0,
+        )
+        return _to_httplib2_response(response.status_code, response.headers), response.content
+
+class _HttpxAuthorizedClient:
+    """httpx.Client に認証ヘッダーの付与と、401の場合のトークンのリフレッシュを加えたもの。"""
+
+    def __init__(self, client, creds):
+        self.client = client
+        self.creds = creds
+        self._refresh_request = Request()
+        self._refresh_lock = threading.Lock()
+
+    def request(self, method, uri, data=None, headers=None, timeout=None, allow_redirects=True):
+        for attempt in range(2):
+            request_headers = dict(headers or {})
+            with self._refresh_lock:
+                self.creds.before_request(self._refresh_request, method, uri, request_headers)
+            response = self.client.request(
+                method, uri, content=data, headers=request_headers, timeout=timeout, follow_redirects=allow_redirects,
+            )
+            if response.status_code != 401 or attempt:
+                return response
+            with self._refresh_lock:
+                self.creds.refresh(self._refresh_request)
+        return response
+
+_session_lock = threading.Lock()
+_session = None # (認証情報, トランスポート名, セッション)
+
+def _create_session(creds, transport: str):
+    pool_size = max(1, settings.google_http_pool_size)
+    if transport == "httpx":
+        try:
+            import httpx # 任意の依存 (GOOGLE_HTTP_TRANSPORT=httpx の時だけ必要)
+            import h2 # noqa: F401 HTTP/2にはh2パッケージが必要
+        except ImportError:
+            print("httpx または h2 がインストールされていないため、HTTP/2ではなく requests のトランスポートを使います。")
+        else:
+            limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+            return _HttpxAuthorizedClient(httpx.Client(http2=True, limits=limits), creds)
+
+    session = AuthorizedSession(creds)
+    # 同時に実行するワーカー数よりプールが小さいと、入りきらない接続を使い捨てることになる
+    session.mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+    return session
+
+def get_session(creds):
+    """認証情報に対応する共有セッションを返す。認証情報が作り直された場合はセッションも作り直す。"""
+    global _session
+    transport = settings.google_http_transport
+    with _session_lock:
+        if _session is None or _session[0] is not creds or _session[1] != transport:
+            _session = (creds, transport, _create_session(creds, transport))
+        return _session[2]
+
+def close_sessions():
+    """共有セッションを破棄する (プールの接続は閉じる)。"""
+    global _session
+    with _session_lock:
+        session = _session[2] if _session else None
+        _session = None
+    if session is not None:
+        (session.client if isinstance(session, _HttpxAuthorizedClient) else session).close()
+
+def create_http(creds):
+    """サービスオブジェクト用のトランスポートを作る。thread_safe 属性がTrueならスレッド間で共有してよい。"""
+    if settings.google_http_transport == "httplib2":
+        http = build_http()
+        if _timeout():
+            http.timeout = _timeout()
+        return AuthorizedHttp(creds, http=http)
+    return PooledHttp(get_session(creds))
+
+def is_thread_safe(http) -> bool:
+    return bool(getattr(http, "thread_safe", False))
@@ -0,0 +1,340 @@
+"""
+ワークフローの非同期ジョブ実行と、その状態を保存するジョブストア。
+POST /api/jobs でジョブを登録するとすぐにジョブIDを返し、
+ワークフローはバックグラウンドのワーカースレッドで実行される。
+各STEPの開始・完了・失敗はイベントとしてジョブストアに記録され、
+GET /api/jobs/{id} (ポーリング) や SSE ストリームから参照できる。
+
+ジョブストアは JOB_STORE_BACKEND で切り替える。
+    memory: プロセス内の辞書に保存 (デフォルト)
+    sqlite: JOB_STORE_SQLITE_PATH のSQLiteファイルに保存 (複数ワーカーで共有可能)
+"""
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from config import settings
+
+# ジョブの状態
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+FINISHED_STATUSES = {JOB_SUCCEEDED, JOB_FAILED}
+
+class JobStore(ABC):
+    """
+    ジョブストアのインターフェース。
+    ジョブは dict (id, status, params, result, error, created_at, updated_at) で表し、
+    イベントは seq (1始まりの連番) 付きの dict で表す。
+    """
+
+    @abstractmethod
+    def create_job(self, params: dict) -> dict:
+        """params を持つ待機中のジョブを作り、返す。"""
+
+    @abstractmethod
+    def get_job(self, job_id: str) -> dict | None:
+        """ジョブを返す。なければNone。"""
+
+    @abstractmethod
+    def update_job(self, job_id: str, **fields):
+        """ジョブの status / result / error を更新する。"""
+
+    @abstractmethod
+    def append_event(self, job_id: str, event: dict):
+        """イベントに次の seq を付けて記録する。"""
+
+    @abstractmethod
+    def list_events(self, job_id: str, after_seq: int = 0) -> list:
+        """seq が after_seq より大きいイベントを古い順に返す。"""
+
+    @staticmethod
+    def _new_job(params: dict) -> dict:
+        now = time.time()
+        return {
+            "id": uuid.uuid4().hex,
+            "status": JOB_QUEUED,
+            "params": params,
+            "result": None,
+            "error": None,
+            "created_at": now,
+            "updated_at": now,
+        }
+
+class InMemoryJobStore(JobStore):
+    """
+    プロセス内の辞書にジョブを保存するストア。
+    常駐するプロセスでメモリが増え続けないよう、ジョブを登録する時に、終了から retention_seconds 以上たったジョブと、
+    max_jobs 個を超えた分の終了済みのジョブ (古い順) をイベントごと捨てる。
+    """
+
+    def __init__(self, retention_seconds: float = 3600, max_jobs: int = 1000):
+        self._lock = threading.Lock()
+        self._jobs = {} # 登録順
+        self._events = {}
+        self.retention_seconds = retention_seconds
+        self.max_jobs = max_jobs
+
+    def create_job(self, params: dict) -> dict:
+        job = self._new_job(params)
+        with self._lock:
+            self._evict(job["created_at"])
+            self._jobs[job["id"]] = job
+            self._events[job["id"]] = []
+        return dict(job)
+
+    def _evict(self, now: float):
+        finished = [job_id for job_id, job in self._jobs.items() if job["status"] in FINISHED_STATUSES]
+        expired = {job_id for job_id in finished if now - self._jobs[job_id]["updated_at"] >= self.retention_seconds}
+        overflow = len(self._jobs) - len(expired) - (self.max_jobs - 1)
+        if overflow > 0:
+            # 実行中のジョブは捨てない
+            expired.update([job_id for job_id in finished if job_id not in expired][:overflow])
+        for job_id in expired:
+            del self._jobs[job_id]
+            self._events.pop(job_id, None)
+
+    def get_job(self, job_id: str) -> dict | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def update_job(self, job_id: str, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields, updated_at=time.time())
+
+    def append_event(self, job_id: str, event: dict):
+        with self._lock:
+            events = self._events.get(job_id)
+            if events is not None:
+                events.append(dict(event, seq=len(events) + 1, timestamp=time.time()))
+
+    def list_events(self, job_id: str, after_seq: int = 0) -> list:
+        with self._lock:
+            return [dict(e) for e in self._events.get(job_id, [])[after_seq:]]
+
+class SQLiteJobStore(JobStore):
+    """SQLiteファイルにジョブを保存するストア。外部サービスなしで複数プロセスから参照できる。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, status TEXT NOT NULL, params TEXT, result TEXT, error TEXT,"
+                " created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_events ("
+                " job_id TEXT NOT NULL, seq INTEGER NOT NULL, event TEXT NOT NULL, timestamp REAL NOT NULL,"
+                " PRIMARY KEY (job_id, seq))"
+            )
+
+    @contextmanager
+    def _connect(self):
+        # 接続はスレッド間で共有せず、操作ごとに開いてコミット後に閉じる
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _row_to_job(row) -> dict:
+        job_id, status, params, result, error, created_at, updated_at = row
+        return {
+            "id": job_id,
+            "status": status,
+            "params": json.loads(params) if params else None,
+            "result": json.loads(result) if result else None,
+            "error": error,
+            "created_at": created_at,
+            "updated_at": updated_at,
+        }
+
+    def create_job(self, params: dict) -> dict:
+        job = self._new_job(params)
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, params, result, error, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job["id"], job["status"], json.dumps(params), None, None, job["created_at"], job["updated_at"]),
+            )
+        return job
+
+    def get_job(self, job_id: str) -> dict | None:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, status, params, result, error, created_at, updated_at FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def update_job(self, job_id: str, **fields):
+        columns = []
+        values = []
+        for key, value in fields.items():
+            if key not in ("status", "result", "error"):
+                raise ValueError(f"更新できない項目です: {key}")
+            columns.append(f"{key} = ?")
+            values.append(json.dumps(value, ensure_ascii=False) if key == "result" else value)
+        columns.append("updated_at = ?")
+        values.append(time.time())
+        with self._lock, self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {', '.join(columns)} WHERE id = ?", (*values, job_id))
+
+    def append_event(self, job_id: str, event: dict):
+        with self._lock, self._connect() as conn:
+            (last_seq,) = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM job_events WHERE job_id = ?", (job_id,)
+            ).fetchone()
+            conn.execute(
+                "INSERT INTO job_events (job_id, seq, event, timestamp) VALUES (?, ?, ?, ?)",
+                (job_id, last_seq + 1, json.dumps(event, ensure_ascii=False), time.time()),
+            )
+
+    def list_events(self, job_id: str, after_seq: int = 0) -> list:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT seq, event, timestamp FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq",
+                (job_id, after_seq),
+            ).fetchall()
+        return [dict(json.loads(event), seq=seq, timestamp=timestamp) for seq, event, timestamp in rows]
+
+_job_store = None
+_job_store_lock = threading.Lock()
+
+def get_job_store() -> JobStore:
+    """設定 (JOB_STORE_BACKEND) に応じたジョブストアを返す。"""
+    global _job_store
+    with _job_store_lock:
+        if _job_store is None:
+            backend = settings.job_store_backend.lower()
+            if backend == "sqlite":
+                _job_store = SQLiteJobStore(settings.job_store_sqlite_path)
+            elif backend == "memory":
+                _job_store = InMemoryJobStore(settings.job_retention_seconds, settings.job_max_retained)
+            else:
+                raise ValueError(f"不明なJOB_STORE_BACKENDです: {settings.job_store_backend}")
+        return _job_store
+
+# --- ジョブの実行 ---
+
+_job_executor = None
+_job_executor_lock = threading.Lock()
+
+def _get_job_executor() -> ThreadPoolExecutor:
+    global _job_executor
+    with _job_executor_lock:
+        if _job_executor is None:
+            _job_executor = ThreadPoolExecutor(
+                max_workers=max(1, settings.job_max_workers), thread_name_prefix="workflow-job")
+        return _job_executor
+
+def _run_job(job_id: str, number_of_copies: int, idempotency_key: str | None = None):
+    """ワーカースレッドでワークフローを実行し、結果をジョブストアに記録する。"""
+    # Google APIのライブラリは読み込みが重いため、最初にジョブを実行する時に読み込む
+    from workflow import StepError, run_workflow
+    from workflow_checkpoints import IdempotencyKeyConflict
+
+    store = get_job_store()
+    store.update_job(job_id, status=JOB_RUNNING)
+    store.append_event(job_id, {"type": "job_started"})
+
+    def on_event(event: dict):
+        store.append_event(job_id, event)
+
+    try:
+        details = asyncio.run(run_workflow(number_of_copies, on_event=on_event, idempotency_key=idempotency_key))
+        result = {
+            "message": "ワークフローが正常に完了しました。",
+            "details": details,
+        }
+        # SSEストリームが最後のイベントを取りこぼさないよう、イベントを先に記録してから状態を更新する
+        store.append_event(job_id, {"type": "job_succeeded", "result": result})
+        store.update_job(job_id, status=JOB_SUCCEEDED, result=result)
+    except (StepError, IdempotencyKeyConflict) as step_error:
+        store.append_event(job_id, {"type": "job_failed", "error": str(step_error)})
+        store.update_job(job_id, status=JOB_FAILED, error=str(step_error))
+    except Exception as e:
+        print(f"ジョブ {job_id} の実行中に予期せぬエラー: {e}")
+        import traceback
+        traceback.print_exc()
+        error = f"ワークフロー実行中に予期せぬサーバーエラーが発生しました: {str(e)}"
+        store.append_event(job_id, {"type": "job_failed", "error": error})
+        store.update_job(job_id, status=JOB_FAILED, error=error)
+
+def start_workflow_job(number_of_copies: int, idempotency_key: str | None = None) -> dict:
+    """
+    ワークフローのジョブを登録してバックグラウンドで開始し、ジョブを返す。
+    idempotency_key を指定すると、同じキーの前回の実行 (ジョブ・/api/execute_workflow) の続きから再開する。
+    """
+    store = get_job_store()
+    job = store.create_job({"number_of_copies": number_of_copies, "idempotency_key": idempotency_key})
+    _get_job_executor().submit(_run_job, job["id"], number_of_copies, idempotency_key)
+    print(f"ワークフロージョブ {job['id']} を登録しました (複製数: {number_of_copies})")
+    return job
+
+def describe_job(job: dict) -> dict:
+    """ジョブとイベントから、API応答用のジョブ状態 (STEPごとの出力と所要時間を含む) を組み立てる。"""
+    steps = {}
+    for event in get_job_store().list_events(job["id"]):
+        step_name = event.get("step")
+        if not step_name:
+            continue
+        step = steps.setdefault(step_name, {"status": JOB_QUEUED})
+        if event["type"] == "step_started":
+            step["status"] = JOB_RUNNING
+        elif event["type"] == "step_completed":
+            step.update(status=JOB_SUCCEEDED, output=event.get("output"), elapsed_seconds=event.get("elapsed_seconds"))
+        elif event["type"] == "step_failed":
+            step.update(status=JOB_FAILED, error=event.get("detail"), elapsed_seconds=event.get("elapsed_seconds"))
+
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "params": job["params"],
+        "steps": steps,
+        "timings": {name: step.get("elapsed_seconds") for name, step in steps.items() if "elapsed_seconds" in step},
+        "result": job["result"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
+
+def format_sse_event(event: dict) -> str:
+    """イベントをServer-Sent Events形式の文字列にする。"""
+    data = json.dumps(event, ensure_ascii=False)
+    return f"id: {event['seq']}\nevent: {event['type']}\ndata: {data}\n\n"
+
+async def stream_job_events(job_id: str, after_seq: int = 0):
+    """ジョブが終了するまでイベントをSSE形式で送り続ける非同期ジェネレータ。"""
+    store = get_job_store()
+    last_sent_at = time.monotonic()
+    while True:
+        # 状態を先に読んでおき、終了済みならその時点までのイベントを全て送ってから終える
+        # (SQLiteのストアはファイルを読むため、イベントループを止めないようスレッドで呼ぶ)
+        job = await asyncio.to_thread(store.get_job, job_id)
+        events = await asyncio.to_thread(store.list_events, job_id, after_seq)
+        for event in events:
+            after_seq = event["seq"]
+            yield format_sse_event(event)
+            last_sent_at = time.monotonic()
+
+        if job is None or job["status"] in FINISHED_STATUSES:
+            break
+        if time.monotonic() - last_sent_at >= 15:
+            # 接続維持用のコメント
+            yield ": keep-alive\n\n"
+            last_sent_at = time.monotonic()
+        await asyncio.sleep(settings.job_event_poll_interval_seconds)
@@ -0,0 +1,228 @@
+"""
+プロセス内のメトリクス (カウンタ・ヒストグラム) と、Prometheusテキスト形式への出力。
+各STEPの所要時間・API呼び出し回数と、Google API呼び出しごとの所要時間・
+レスポンスサイズ・再試行回数などを記録し、/api/metrics で公開する。
+"""
+import contextvars
+import functools
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# 秒単位のヒストグラムのデフォルトバケット
+DEFAULT_TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# 回数用のヒストグラムのバケット
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Counter:
+    """単調増加するカウンタ。"""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def collect(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+class Histogram:
+    """累積バケット・合計・件数を持つヒストグラム。"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_TIME_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._lock = threading.Lock()
+        self._values = {} # {labelvalues: [bucketごとの件数..., 合計, 件数]}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def collect(self):
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        for key, state in items:
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets, state):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, extra=[("le", _format_value(upper_bound))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(state[-2])}"
+            yield f"{self.name}_count{labels} {state[-1]}"
+
+class Registry:
+    """メトリクスをまとめてPrometheusテキスト形式で出力する。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"メトリクス {metric.name} は既に登録されています。")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_TIME_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+# --- ワークフロー・Google API用のメトリクス ---
+
+STEP_DURATION = REGISTRY.histogram(
+    "workflow_step_duration_seconds", "ワークフローの各STEPの所要時間 (秒)", ["step"])
+STEP_API_CALLS = REGISTRY.histogram(
+    "workflow_step_api_calls", "1回のSTEP実行中に行われたGoogle API呼び出し回数", ["step"], buckets=COUNT_BUCKETS)
+API_CALL_DURATION = REGISTRY.histogram(
+    "google_api_call_duration_seconds", "Google API呼び出し1回あたりの所要時間 (秒)", ["api", "method"])
+API_CALLS = REGISTRY.counter(
+    "google_api_calls_total", "Google API呼び出し回数", ["api", "method", "status"])
+API_RESPONSE_BYTES = REGISTRY.counter(
+    "google_api_response_bytes_total", "Google APIのレスポンス本文の合計バイト数", ["api"])
+API_RETRIES = REGISTRY.counter(
+    "google_api_retries_total", "Google API呼び出しの再試行回数", ["api", "reason"])
+BYTES_DECODED = REGISTRY.counter(
+    "gmail_body_bytes_decoded_total", "Gmailのメール本文としてデコードしたバイト数", ["step"])
+
+class _StepStats:
+    """実行中のSTEPで発生したAPI呼び出し回数 (スレッド間で共有するため更新はロック付き)。"""
+
+    def __init__(self, step: str):
+        self.step = step
+        self.api_calls = 0
+        self._lock = threading.Lock()
+
+    def add_api_call(self):
+        with self._lock:
+            self.api_calls += 1
+
+_current_step = contextvars.ContextVar("current_step", default=None)
+
+def current_step_name() -> str:
+    stats = _current_step.get()
+    return stats.step if stats else ""
+
+def observe_step(step: str):
+    """STEP関数の所要時間と、その間のGoogle API呼び出し回数を記録するデコレータ。"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stats = _StepStats(step)
+            token = _current_step.set(stats)
+            started_at = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                STEP_DURATION.observe(time.perf_counter() - started_at, step=step)
+                STEP_API_CALLS.observe(stats.api_calls, step=step)
+                _current_step.reset(token)
+        return wrapper
+    return decorator
+
+def bind_step_context(func):
+    """
+    現在のSTEPのコンテキストを引き継いで func を呼ぶ関数を返す。
+    STEP内で別スレッド (ThreadPoolExecutor) にAPI呼び出しを投げる場合に使う。
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # 同じContextは複数スレッドで同時にrunできないため、呼び出しごとにコピーする
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
+
+@contextmanager
+def track_api_call(api: str, method: str):
+    """Google API呼び出し1回分の所要時間と結果を記録する。"""
+    stats = _current_step.get()
+    if stats:
+        stats.add_api_call()
+    started_at = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except Exception as e:
+        resp = getattr(e, "resp", None)
+        status = str(getattr(resp, "status", "")) or type(e).__name__
+        raise
+    finally:
+        API_CALL_DURATION.observe(time.perf_counter() - started_at, api=api, method=method)
+        API_CALLS.inc(api=api, method=method, status=status)
+
+def record_response_bytes(api: str, size: int):
+    API_RESPONSE_BYTES.inc(size, api=api)
+
+def record_retry(api: str, reason: str):
+    API_RETRIES.inc(api=api, reason=reason)
+
+def record_bytes_decoded(size: int):
+    BYTES_DECODED.inc(size, step=current_step_name())
+
+def render_prometheus() -> str:
+    """全メトリクスをPrometheusのテキスト形式で返す。"""
+    return REGISTRY.render()
@@ -0,0 +1,126 @@
+"""
+STEP4の複製元テンプレートの情報 (名前・親フォルダ・版) と、STEP5で使う本文の末尾インデックス・テキストのキャッシュ。
+テンプレートはほとんど変更されないため、TEMPLATE_CACHE_CHECK_INTERVAL_SECONDS 秒の間は
+Drive/Docs APIを呼ばずにキャッシュを使う。期限が過ぎたら files.get でメタデータを取り直し、
+版 (version / modifiedTime) が変わっていれば本文も読み直す。
+"""
+import threading
+import time
+
+from config import settings
+from google_clients import get_service
+from metrics import REGISTRY
+
+TEMPLATE_LOOKUPS = REGISTRY.counter(
+    "template_cache_lookups_total",
+    "テンプレート情報のキャッシュ参照回数 (hit: 確認なし / unchanged: 確認して変更なし / changed / miss)",
+    ["result"],
+)
+
+class TemplateDescriptor:
+    """テンプレートのメタデータ。version はGoogleドキュメントの変更ごとに増える版番号。"""
+
+    def __init__(self, template_id: str, name: str | None, parents: list, version: str | None,
+                 modified_time: str | None):
+        self.template_id = template_id
+        self.name = name
+        self.parents = parents
+        self.version = version
+        self.modified_time = modified_time
+        self.checked_at = time.monotonic()
+
+    @classmethod
+    def from_file(cls, template_id: str, file: dict):
+        return cls(template_id, file.get('name'), file.get('parents') or [], file.get('version'), file.get('modifiedTime'))
+
+    def same_revision(self, other) -> bool:
+        return (self.version, self.modified_time) == (other.version, other.modified_time)
+
+class TemplateCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._descriptors = {} # {テンプレートID: TemplateDescriptor}
+        self._bodies = {} # {テンプレートID: (version, 本文の末尾インデックス, 本文のテキスト)}
+
+    def describe(self, drive_service, template_id: str) -> TemplateDescriptor:
+        """テンプレートの情報を返す。確認間隔を過ぎていれば files.get で取り直す。"""
+        with self._lock:
+            cached = self._descriptors.get(template_id)
+        if cached and time.monotonic() - cached.checked_at < settings.template_cache_check_interval_seconds:
+            TEMPLATE_LOOKUPS.inc(result="hit")
+            return cached
+
+        file = drive_service.files().get(
+            fileId=template_id,
+            fields='name, parents, version, modifiedTime',
+        ).execute()
+        descriptor = TemplateDescriptor.from_file(template_id, file)
+        if cached is None:
+            TEMPLATE_LOOKUPS.inc(result="miss")
+        elif cached.same_revision(descriptor):
+            TEMPLATE_LOOKUPS.inc(result="unchanged")
+        else:
+            TEMPLATE_LOOKUPS.inc(result="changed")
+            print(f"テンプレート '{descriptor.name}' が更新されていたため、キャッシュを更新しました。")
+        with self._lock:
+            self._descriptors[template_id] = descriptor
+        return descriptor
+
+    def end_index(self, docs_service, template_id: str, sample_doc_id: str | None = None) -> int:
+        """
+        テンプレート本文の末尾インデックスを返す (1なら空のドキュメント)。
+        テンプレートの版が変わっていなければ前回読んだ値を使う。
+        読む場合は、テンプレートと同じ内容を持つ複製済みのドキュメント (sample_doc_id) があればそちらを読む。
+        """
+        return self._body(docs_service, template_id, sample_doc_id)[0]
+
+    def text(self, docs_service, template_id: str, sample_doc_id: str | None = None) -> str:
+        """テンプレート本文 (表の中を含む) のテキストを返す。読み直す条件は end_index と同じ。"""
+        return self._body(docs_service, template_id, sample_doc_id)[1]
+
+    def _body(self, docs_service, template_id: str, sample_doc_id: str | None) -> tuple:
+        # STEP4を実行せずにSTEP5だけを実行する場合 (実行記録からの再開) もあるため、
+        # 本文のキャッシュを使う前にここでも版を確認する (確認間隔内ならAPIは呼ばない)
+        descriptor = self.describe(get_service('drive', 'v3'), template_id)
+        with self._lock:
+            cached = self._bodies.get(template_id)
+        version = descriptor.version
+        if cached and version is not None and cached[0] == version:
+            return cached[1:]
+
+        document = docs_service.documents().get(
+            documentId=sample_doc_id or template_id,
+            fields='body(content(endIndex,paragraph(elements(textRun(content))),table))',
+        ).execute()
+        body_content = document.get('body', {}).get('content', [])
+        end_index = 1 # デフォルトはドキュメントの先頭 (1-based index)
+        if body_content:
+            # Documentのbody.contentはList of StructuralElement。最後の要素のendIndexを末尾とみなす
+            end_index = body_content[-1].get('endIndex', 1)
+        text = "".join(_iter_text_runs(body_content))
+        if version is not None:
+            with self._lock:
+                self._bodies[template_id] = (version, end_index, text)
+        return end_index, text
+
+    def clear(self):
+        with self._lock:
+            self._descriptors.clear()
+            self._bodies.clear()
+
+def _iter_text_runs(node):
+    """StructuralElementのリストから、段落・表のセル内のテキストを出現順に返す。"""
+    if isinstance(node, list):
+        for item in node:
+            yield from _iter_text_runs(item)
+    elif isinstance(node, dict):
+        text_run = node.get('textRun')
+        if text_run:
+            yield text_run.get('content', '')
+            return
+        for value in node.values():
+            if isinstance(value, (dict, list)):
+                yield from _iter_text_runs(value)
+
+# プロセス内で共有するキャッシュ
+template_cache = TemplateCache()
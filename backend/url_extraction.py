@@ -0,0 +1,144 @@
+"""
+メール本文からのURL抽出と正規化。
+正規表現はモジュール読み込み時に1度だけコンパイルし、本文は1回の走査で処理する。
+
+・URLは空白 (全角スペースを含む) と、、。「」（）などの全角の区切り文字の直前までとする。
+  日本語のファイル名などを含むURLはそのまま取り出す。「>」付きの引用行や <URL> 形式でも同様に取り出せる。
+・文末の句読点や対応の取れていない閉じ括弧は取り除く。
+・Googleのリダイレクト (google.com/url?q=...) と Outlookのセーフリンクは転送先のURLに戻す。
+・出力するのは送信者が書いたURL (末尾の句読点を除いたもの) で、正規化した形は重複の判定にだけ使う。
+  Google Drive/ドキュメントのリンクはファイルID (とスプレッドシートの gid などのフラグメント) ごと、
+  Boxのリンクはパスごとに同じURLとみなす (クエリ文字列の違いは無視する)。
+  それ以外のURLはスキーム・ホストを小文字にし、utm_* パラメータを除いて比べる。
+・結果は最初に出現した順に返す。
+"""
+import functools
+import re
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# 空白と区切り文字以外の連続。URLに使えない <>" と、URLの直後に来る全角の区切り文字で終わる。
+# IGNORECASEを付けると先頭の "http" による高速な前方一致検索が効かなくなるため、スキームは小文字のみとする
+_URL_RE = re.compile(r'https?://[^\s<>"、。，．「」『』（）【】＜＞]+')
+# URLの末尾にあっても文の区切りとみなす文字
+_TRAILING_PUNCTUATION = ".,;:!?'\"*"
+_CLOSING_BRACKETS = {")": "(", "]": "["}
+
+# Google Drive / ドキュメントのファイルID・フォルダID
+_DRIVE_HOSTS = frozenset({"drive.google.com", "docs.google.com"})
+_DRIVE_ID_RE = re.compile(r"/(?:u/\d+/)?d/([A-Za-z0-9_-]{10,})")
+_DRIVE_FOLDER_RE = re.compile(r"/folders/([A-Za-z0-9_-]{10,})")
+_DOCS_KIND_RE = re.compile(r"^/(document|spreadsheets|presentation|forms|drawings)/")
+# Boxの共有リンク (/s/共有名、/s/共有名/file/ファイルID) とファイル・フォルダのリンク
+_BOX_PATH_RE = re.compile(r"^/(s|file|folder)/([A-Za-z0-9]+)")
+
+# 展開するリダイレクトの最大段数
+_MAX_REDIRECT_DEPTH = 3
+
+def _trim(url: str) -> str:
+    """末尾の句読点と、対応する開き括弧のない閉じ括弧を取り除く。"""
+    end = len(url)
+    open_counts = {opening: url.count(opening) for opening in _CLOSING_BRACKETS.values()}
+    close_counts = {closing: url.count(closing) for closing in _CLOSING_BRACKETS}
+    while end:
+        last = url[end - 1]
+        if last in _TRAILING_PUNCTUATION:
+            end -= 1
+        elif last in _CLOSING_BRACKETS and close_counts[last] > open_counts[_CLOSING_BRACKETS[last]]:
+            close_counts[last] -= 1
+            end -= 1
+        else:
+            break
+    return url[:end]
+
+def _unwrap_redirect(parts):
+    """リダイレクト用のURLであれば転送先のURLを返す。そうでなければNone。"""
+    host = parts.hostname or ""
+    target = None
+    if host in ("google.com", "www.google.com") and parts.path == "/url":
+        params = dict(parse_qsl(parts.query))
+        target = params.get("q") or params.get("url")
+    elif host.endswith("safelinks.protection.outlook.com"):
+        target = dict(parse_qsl(parts.query)).get("url")
+    if target and target.lower().startswith(("http://", "https://")):
+        return target
+    return None
+
+def _drive_key(parts):
+    """Drive/ドキュメントのURLの重複判定キー。IDが取れなければNone。"""
+    params = dict(parse_qsl(parts.query))
+    # スプレッドシートのシート (gid) や見出しへのリンクなど、フラグメントが違えば別のリンクとみなす
+    fragment = parts.fragment
+    gid = dict(parse_qsl(fragment)).get("gid") or params.get("gid")
+    if gid:
+        fragment = f"gid={gid}"
+
+    folder = _DRIVE_FOLDER_RE.search(parts.path)
+    if folder:
+        return ("drive", folder.group(1), fragment)
+    match = _DRIVE_ID_RE.search(parts.path)
+    file_id = match.group(1) if match else params.get("id")
+    if not file_id:
+        return None
+    return ("drive", file_id, fragment)
+
+def _box_key(parts):
+    """Boxのリンクの重複判定キー。共有フォルダ内のファイル (/s/共有名/file/ID) もパスごとに区別する。"""
+    if not _BOX_PATH_RE.match(parts.path):
+        return None
+    # 企業用サブドメイン (xxx.app.box.com) のリンクはそのホストでしか開けないことがあるので区別する
+    return ("box", parts.hostname, parts.path.rstrip("/"))
+
+# 引用された履歴には同じURLが何度も現れるため、正規化の結果を再利用する
+@functools.lru_cache(maxsize=4096)
+def normalize_url(url: str) -> tuple:
+    """抽出したURLを (出力するURL, 重複判定キー) にする。出力するURLはリダイレクトを戻した以外は書かれたまま。"""
+    for _ in range(_MAX_REDIRECT_DEPTH):
+        target = _unwrap_redirect(urlsplit(url))
+        if target is None:
+            break
+        url = target
+    parts = urlsplit(url)
+
+    host = (parts.hostname or "").lower()
+    parts = parts._replace(scheme=parts.scheme.lower(), netloc=parts.netloc.lower())
+    if host in _DRIVE_HOSTS:
+        key = _drive_key(parts)
+        if key:
+            return url, key
+    if host == "box.com" or host.endswith(".box.com"):
+        key = _box_key(parts)
+        if key:
+            return url, key
+
+    netloc = host
+    if parts.port and (parts.scheme, parts.port) not in (("http", 80), ("https", 443)):
+        netloc = f"{host}:{parts.port}"
+    if "@" in parts.netloc:
+        netloc = f"{urlsplit(url).netloc.rsplit('@', 1)[0]}@{netloc}"
+    query = parts.query
+    if "utm_" in query:
+        query = urlencode([(k, v) for k, v in parse_qsl(query, keep_blank_values=True) if not k.startswith("utm_")])
+    return url, urlunsplit((parts.scheme, netloc, parts.path or "/", query, parts.fragment))
+
+def iter_urls(text: str):
+    """テキスト中のURLを出現順に (出力するURL, 重複判定キー) で返すジェネレータ。重複は除かない。"""
+    if not text:
+        return
+    for url in _URL_RE.findall(text):
+        if url[-1] in _TRAILING_PUNCTUATION or url[-1] in _CLOSING_BRACKETS:
+            url = _trim(url)
+        if url.find("://") + 3 >= len(url):
+            continue # ホスト部分がない
+        try:
+            yield normalize_url(url)
+        except ValueError:
+            # ポート番号が不正な場合など、分解できないURLはそのまま扱う
+            yield url, url
+
+def extract_urls(text: str) -> list:
+    """テキストからURLを、同じリンクの重複を除いて最初に出現した順に返す。"""
+    seen = {}
+    for url, key in iter_urls(text):
+        if key not in seen:
+            seen[key] = url
+    return list(seen.values())
@@ -0,0 +1,258 @@
+"""
+短縮URLの保存先。
+バックエンドは URL_STORE_BACKEND で切り替える。
+    sqlite: URL_STORE_SQLITE_PATH のSQLiteファイルに保存 (デフォルト)
+    redis:  URL_STORE_REDIS_URL のRedis互換サーバーに保存 (redisパッケージが必要。
+            "fakeredis://" を指定するとfakeredisパッケージのインメモリ実装を使う)
+どのバックエンドも、読み取りはプロセス内のLRUキャッシュ (URL_STORE_CACHE_SIZE件) を経由する。
+
+短縮IDは連番カウンタから衝突なしに生成する。
+6文字 (62^6通り) の範囲では連番を可逆な変換でばらしてから base62 にするため、
+IDが推測しやすい連番にならず、空きIDを探して再試行する必要もない。
+"""
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from config import settings
+
+BASE62_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+SHORT_ID_LENGTH = 6
+_ID_SPACE = 62 ** SHORT_ID_LENGTH
+# 62^6と互いに素な乗数 (2でも31でも割り切れない) による置換で、連番を6文字のIDに1対1で対応させる
+_ID_MULTIPLIER = 35_104_526_917
+_ID_OFFSET = 1_234_567_890
+
+def encode_base62(number: int) -> str:
+    if number == 0:
+        return BASE62_ALPHABET[0]
+    digits = []
+    while number:
+        number, remainder = divmod(number, 62)
+        digits.append(BASE62_ALPHABET[remainder])
+    return "".join(reversed(digits))
+
+def short_id_from_counter(counter: int) -> str:
+    """連番 (0以上) から短縮IDを作る。異なる連番は必ず異なるIDになる。"""
+    if counter < _ID_SPACE:
+        scrambled = (counter * _ID_MULTIPLIER + _ID_OFFSET) % _ID_SPACE
+        return encode_base62(scrambled).rjust(SHORT_ID_LENGTH, BASE62_ALPHABET[0])
+    # 6文字の範囲を使い切った後は7文字以上になるので、6文字のIDとは衝突しない
+    return encode_base62(counter)
+
+class UrlStore(ABC):
+    """短縮URLストアのインターフェース。"""
+
+    @abstractmethod
+    def create(self, original_url: str) -> str:
+        """URLを保存し、新しい短縮IDを返す。"""
+
+    @abstractmethod
+    def get(self, short_id: str) -> str | None:
+        """短縮IDに対応する元のURLを返す。なければNone。"""
+
+    @abstractmethod
+    def list_entries(self, after_seq: int = 0, limit: int = 100, prefix: str | None = None,
+                     created_since: float | None = None) -> list:
+        """
+        連番 after_seq より後のエントリを連番順に最大 limit 件返す (カーソル方式のページング)。
+        prefix を指定すると元のURLがその文字列で始まるもの、
+        created_since (UNIX時刻) を指定するとそれ以降に作成されたものだけを返す。
+        各エントリは {"seq", "short_id", "original_url", "created_at"} の dict。
+        """
+
+    def iter_entries(self, after_seq: int = 0, prefix: str | None = None, created_since: float | None = None,
+                     batch_size: int = 500):
+        """条件に合う全エントリを、batch_size件ずつ読みながら順に返すジェネレータ。"""
+        while True:
+            entries = self.list_entries(after_seq, batch_size, prefix, created_since)
+            yield from entries
+            if len(entries) < batch_size:
+                return
+            after_seq = entries[-1]["seq"]
+
+class SQLiteUrlStore(UrlStore):
+    """SQLiteに保存するストア。短縮IDにはユニークインデックスを張る。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS urls ("
+                " seq INTEGER PRIMARY KEY AUTOINCREMENT, short_id TEXT UNIQUE,"
+                " original_url TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS urls_created_at ON urls (created_at)")
+
+    @contextmanager
+    def _connect(self):
+        # 接続はスレッド間で共有せず、操作ごとに開いてコミット後に閉じる
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def create(self, original_url: str) -> str:
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO urls (original_url, created_at) VALUES (?, ?)", (original_url, time.time())
+            )
+            seq = cursor.lastrowid
+            short_id = short_id_from_counter(seq)
+            conn.execute("UPDATE urls SET short_id = ? WHERE seq = ?", (short_id, seq))
+        return short_id
+
+    def get(self, short_id: str) -> str | None:
+        with self._connect() as conn:
+            row = conn.execute("SELECT original_url FROM urls WHERE short_id = ?", (short_id,)).fetchone()
+        return row[0] if row else None
+
+    def list_entries(self, after_seq: int = 0, limit: int = 100, prefix: str | None = None,
+                     created_since: float | None = None) -> list:
+        conditions = ["seq > ?"]
+        params = [after_seq]
+        if prefix:
+            # substrで比較し、LIKEのワイルドカード文字 (% と _) をURL中で気にしなくて済むようにする
+            conditions.append("substr(original_url, 1, ?) = ?")
+            params.extend([len(prefix), prefix])
+        if created_since is not None:
+            conditions.append("created_at >= ?")
+            params.append(created_since)
+        params.append(limit)
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT seq, short_id, original_url, created_at FROM urls"
+                f" WHERE {' AND '.join(conditions)} ORDER BY seq LIMIT ?",
+                params,
+            ).fetchall()
+        return [
+            {"seq": seq, "short_id": short_id, "original_url": original_url, "created_at": created_at}
+            for seq, short_id, original_url, created_at in rows
+        ]
+
+class RedisUrlStore(UrlStore):
+    """
+    Redis互換サーバーに保存するストア。
+    url:counter をINCRして連番を払い出し、url:{短縮ID} のハッシュにURLを保存する。
+    一覧用に urls:by_seq (連番をスコアとするソート済みセット) も更新する。
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url: str):
+        if url.startswith("fakeredis://"):
+            import fakeredis # ローカル用のインメモリ実装 (任意の依存)
+            return cls(fakeredis.FakeStrictRedis(decode_responses=True))
+        import redis # 任意の依存 (URL_STORE_BACKEND=redis の時だけ必要)
+        return cls(redis.Redis.from_url(url, decode_responses=True))
+
+    def create(self, original_url: str) -> str:
+        seq = self.client.incr("url:counter")
+        short_id = short_id_from_counter(seq)
+        pipe = self.client.pipeline()
+        pipe.hset(f"url:{short_id}", mapping={"url": original_url, "created_at": time.time(), "seq": seq})
+        pipe.zadd("urls:by_seq", {short_id: seq})
+        pipe.execute()
+        return short_id
+
+    def get(self, short_id: str) -> str | None:
+        return self.client.hget(f"url:{short_id}", "url")
+
+    def list_entries(self, after_seq: int = 0, limit: int = 100, prefix: str | None = None,
+                     created_since: float | None = None) -> list:
+        entries = []
+        # 連番順に少しずつ読み、条件で絞り込みながら limit 件に達するまで続ける
+        scan_size = max(limit, 100)
+        while len(entries) < limit:
+            short_ids = self.client.zrangebyscore("urls:by_seq", f"({after_seq}", "+inf", start=0, num=scan_size)
+            if not short_ids:
+                break
+            pipe = self.client.pipeline()
+            for short_id in short_ids:
+                pipe.hgetall(f"url:{short_id}")
+            for short_id, record in zip(short_ids, pipe.execute()):
+                after_seq = int(record["seq"])
+                created_at = float(record["created_at"])
+                if prefix and not record["url"].startswith(prefix):
+                    continue
+                if created_since is not None and created_at < created_since:
+                    continue
+                entries.append(
+                    {"seq": after_seq, "short_id": short_id, "original_url": record["url"], "created_at": created_at}
+                )
+                if len(entries) >= limit:
+                    break
+            if len(short_ids) < scan_size:
+                break
+        return entries
+
+class CachedUrlStore(UrlStore):
+    """読み取りをプロセス内のLRUキャッシュで受ける読み取りスルー型のラッパー。"""
+
+    def __init__(self, store: UrlStore, capacity: int):
+        self.store = store
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, short_id: str, original_url: str):
+        with self._lock:
+            self._cache[short_id] = original_url
+            self._cache.move_to_end(short_id)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def create(self, original_url: str) -> str:
+        short_id = self.store.create(original_url)
+        self._remember(short_id, original_url)
+        return short_id
+
+    def get(self, short_id: str) -> str | None:
+        with self._lock:
+            original_url = self._cache.get(short_id)
+            if original_url is not None:
+                self._cache.move_to_end(short_id)
+                self.hits += 1
+                return original_url
+            self.misses += 1
+
+        original_url = self.store.get(short_id)
+        if original_url is not None:
+            self._remember(short_id, original_url)
+        return original_url
+
+    def list_entries(self, after_seq: int = 0, limit: int = 100, prefix: str | None = None,
+                     created_since: float | None = None) -> list:
+        # 一覧はキャッシュを経由せず、保存先から直接読む
+        return self.store.list_entries(after_seq, limit, prefix, created_since)
+
+_url_store = None
+_url_store_lock = threading.Lock()
+
+def get_url_store() -> UrlStore:
+    """設定 (URL_STORE_BACKEND) に応じた短縮URLストアを返す。"""
+    global _url_store
+    with _url_store_lock:
+        if _url_store is None:
+            backend = settings.url_store_backend.lower()
+            if backend == "sqlite":
+                if settings.running_serverless:
+                    # /tmp はインスタンスごとに別で、インスタンスが破棄されると消える
+                    print(f"警告: サーバーレス環境では短縮URLを {settings.url_store_sqlite_path} に保存するため、"
+                          "他のインスタンスからは参照できません。永続化するには URL_STORE_BACKEND=redis を設定してください。")
+                store = SQLiteUrlStore(settings.url_store_sqlite_path)
+            elif backend == "redis":
+                store = RedisUrlStore.from_url(settings.url_store_redis_url)
+            else:
+                raise ValueError(f"不明なURL_STORE_BACKENDです: {settings.url_store_backend}")
+            _url_store = CachedUrlStore(store, settings.url_store_cache_size)
+        return _url_store
@@ -0,0 +1,375 @@
+"""
+ワークフロー(STEP1〜5)の実行スケジューラ。
+各STEPの依存関係をDAGとして定義し、互いに依存しないSTEPは
+上限付きのスレッドプール (executors.py) で並行実行する。
+STEP関数は同期関数のため、イベントループからはスレッドプールに渡して await で待つ。
+STEP1〜3 (Gmail/Drive検索) とSTEP4 (ドキュメント複製) は独立しているため同時に走り、
+STEP5はそれら全ての完了を待ってから実行される。
+
+STEP1〜3は入力 (検索クエリ・フォルダID) が同じなら結果も同じなため、
+複数のワークフローが同時に実行された場合は実行中の1回の結果を共有する (single-flight)。
+STEP4/STEP5はワークフローごとに実行する。
+
+1回の実行で複数の出力先 (番組、workflow_targets.WorkflowTarget) を扱う場合も同じスケジューラで実行する。
+STEP1〜3は検索条件ごとに1回だけ実行して出力先間で共有し、出力先ごとのSTEP4/STEP5は並行に実行する。
+
+冪等キーを指定した実行では、完了したSTEPの出力と作成・書き込み済みのドキュメントを
+workflow_checkpoints に記録し、同じキーで再実行した時は最初の未完了のSTEPから再開する。
+冪等キーがない実行でSTEP1〜3が失敗した場合やSTEP4が一部だけ失敗した場合は、STEP4が作成したドキュメントは
+再実行でも使われないため、ゴミ箱へ移す (STEP5まで進んだ出力先のドキュメントはそのまま残す)。
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import settings
+from drive_copy import trash_files
+from executors import get_workflow_executor
+from metrics import REGISTRY
+from workflow_checkpoints import RunCheckpoint, get_checkpoint_log
+from workflow_targets import WorkflowTarget, validate_targets
+from google_services import (
+    step1_get_audio_material_urls,
+    step2_get_latest_folder_url,
+    step3_get_script_email_body,
+    step4_duplicate_document,
+    step5_write_info_to_documents,
+)
+
+class StepError(Exception):
+    """STEPの出力がエラーだった場合に送出する例外。"""
+
+    def __init__(self, step_name: str, detail: str, output=None):
+        super().__init__(f"{step_name}処理エラー: {detail}")
+        self.step_name = step_name
+        self.detail = detail
+        # エラーと判定された出力 (STEP4の一部失敗では作成済みのドキュメントIDを含む)
+        self.output = output
+
+STEP_COALESCED = REGISTRY.counter(
+    "workflow_step_coalesced_total", "同時実行中の同じSTEPの結果を共有した回数", ["step"])
+ORPHANS_TRASHED = REGISTRY.counter(
+    "workflow_orphan_documents_trashed_total", "STEP1〜3の失敗で使われなくなり、ゴミ箱へ移したSTEP4のドキュメント数")
+
+class WorkflowStep:
+    """
+    ワークフローの1ステップ。
+    func: 依存STEPの出力 ({STEP名: 出力}) を受け取り、このSTEPの出力を返す同期関数
+    depends_on: 先に完了している必要があるSTEP名
+    check: 出力を受け取り、エラーならエラー内容(文字列)、正常ならNoneを返す関数
+    coalesce_key: 指定すると、同じキーで実行中の呼び出しがあればその結果を共有する
+                  (依存STEPの出力を使わないSTEPにだけ指定する)
+    """
+
+    def __init__(self, name: str, func, depends_on=(), check=None, coalesce_key=None):
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+        self.check = check
+        self.coalesce_key = coalesce_key
+
+class SingleFlight:
+    """
+    同じキーの処理が実行中なら、新たに実行せずにその Future を返す。
+    concurrent.futures.Future を使うため、別スレッドのイベントループ (ジョブ) からも共有できる。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def submit(self, key, executor: ThreadPoolExecutor, func):
+        """(Future, 実行中の呼び出しを共有したか) を返す。"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, True
+            future = executor.submit(func)
+            self._calls[key] = future
+        # 完了したら登録を消し、次の呼び出しは新たに実行する
+        future.add_done_callback(lambda f: self._forget(key, f))
+        return future, False
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+_single_flight = SingleFlight()
+
+class StepScheduler:
+    """
+    WorkflowStepのDAGを実行する。
+    依存STEPは定義順で先に宣言されている必要がある (循環依存を防ぐため)。
+    いずれかのSTEPが失敗した場合、そのSTEPに依存するSTEPは実行されず、
+    全てのSTEPが終わった後に定義順で最初に失敗したSTEPのエラーを送出する。
+    """
+
+    def __init__(self, steps, executor: ThreadPoolExecutor, on_event=None, checkpoint=None):
+        declared = set()
+        for step in steps:
+            for dep in step.depends_on:
+                if dep not in declared:
+                    raise ValueError(f"{step.name} の依存先 {dep} が先に定義されていません。")
+            if step.name in declared:
+                raise ValueError(f"STEP名 {step.name} が重複しています。")
+            declared.add(step.name)
+        self.steps = list(steps)
+        self.executor = executor
+        # STEPの開始・完了・失敗を通知するコールバック (ジョブの進捗記録などに使う)
+        self.on_event = on_event
+        # 実行記録 (RunCheckpoint)。指定すると完了済みのSTEPは記録した出力を使い、完了したSTEPの出力を記録する
+        self.checkpoint = checkpoint
+        # 完了したSTEPの出力 ({STEP名: 出力})。失敗した場合も、それまでに完了したSTEPの出力が残る
+        self.results = {}
+        # エラーと判定されたSTEPの出力 ({STEP名: 出力})
+        self.failed_outputs = {}
+
+    def _emit(self, event: dict):
+        if self.on_event:
+            self.on_event(event)
+
+    async def run(self) -> dict:
+        """全STEPを実行し、{STEP名: 出力} を返す。"""
+        loop = asyncio.get_running_loop()
+        results = self.results
+        tasks = {}
+
+        async def run_step(step: WorkflowStep):
+            # 依存STEPが失敗していればここで同じ例外が送出され、このSTEPは実行されない
+            for dep in step.depends_on:
+                await tasks[dep]
+
+            if self.checkpoint:
+                found, output = await asyncio.to_thread(self.checkpoint.load_step, step.name)
+                if found:
+                    results[step.name] = output
+                    print(f"{step.name} は前回の実行で完了しているため、記録した出力を使います。")
+                    self._emit({"type": "step_completed", "step": step.name, "output": output,
+                                "elapsed_seconds": 0.0, "resumed": True})
+                    return output
+
+            print(f"{step.name} 実行中...")
+            self._emit({"type": "step_started", "step": step.name})
+            started_at = time.perf_counter()
+            if step.coalesce_key is not None and settings.workflow_coalesce_steps:
+                future, shared = _single_flight.submit(
+                    step.coalesce_key, self.executor, lambda: step.func(results)
+                )
+                if shared:
+                    STEP_COALESCED.inc(step=step.name)
+                    print(f"{step.name}: 同時に実行中の結果を共有します。")
+                # 共有している Future は他のワークフローも待っているため、このタスクが
+                # キャンセルされても Future 自体はキャンセルしない
+                output = await asyncio.shield(asyncio.wrap_future(future))
+            else:
+                output = await loop.run_in_executor(self.executor, step.func, results)
+            elapsed = time.perf_counter() - started_at
+
+            error = step.check(output) if step.check else None
+            if error:
+                print(f"{step.name}エラー: {error}")
+                self._emit({"type": "step_failed", "step": step.name, "detail": error, "elapsed_seconds": elapsed})
+                self.failed_outputs[step.name] = output
+                raise StepError(step.name, error, output)
+
+            if self.checkpoint:
+                await asyncio.to_thread(self.checkpoint.save_step, step.name, output)
+            results[step.name] = output
+            print(f"{step.name} 完了 ({elapsed:.2f}秒)")
+            self._emit({"type": "step_completed", "step": step.name, "output": output, "elapsed_seconds": elapsed})
+            return output
+
+        for step in self.steps:
+            tasks[step.name] = asyncio.ensure_future(run_step(step))
+
+        outcomes = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        for outcome in outcomes:
+            if isinstance(outcome, BaseException):
+                raise outcome
+        return results
+
+# --- ワークフロー定義 ---
+
+def _check_text_output(output: str):
+    """STEP1〜3の出力文字列がエラーかどうかを判定する。"""
+    if "エラー:" in output or "見つかりませんでした" in output:
+        return output
+    return None
+
+def _check_step4_output(output):
+    if isinstance(output, str): # (出力, IDリスト) ではなく文字列だけが返された場合はエラーとする
+        return output
+    step4_output_str, duplicated_doc_ids = output
+    if "エラー:" in step4_output_str or "失敗しました" in step4_output_str:
+        return step4_output_str
+    if not duplicated_doc_ids: # IDリストが空の場合もエラーと見なす
+        return f"複製されたドキュメントIDが取得できませんでした。出力: {step4_output_str}"
+    return None
+
+def _check_step5_output(output: str):
+    if "エラー:" in output:
+        return output
+    return None
+
+_LOOKUP_STEPS = {
+    "STEP1": (step1_get_audio_material_urls, "gmail_query_audio"),
+    "STEP2": (step2_get_latest_folder_url, "drive_folder_id"),
+    "STEP3": (step3_get_script_email_body, "gmail_query_script"),
+}
+
+def build_target_steps(targets: list, checkpoint=None):
+    """
+    出力先 (WorkflowTarget) のリストから、STEP定義と {出力先名: {STEP1〜5: STEP名}} の対応を返す。
+    STEP1〜3は検索条件 (クエリ・フォルダ) ごとに1回だけ定義し、同じ条件の出力先で結果を共有する。
+    STEP4/STEP5は出力先ごとに定義し、互いに独立しているため並行に実行される。
+    出力先が1つの場合のSTEP名は STEP1〜STEP5、複数の場合は STEP1[検索クエリ] や STEP4[出力先名] になる。
+    checkpoint (RunCheckpoint) を指定すると、STEP4は作成済みのドキュメントを使って足りない分だけ複製し、
+    STEP5は書き込み済みのドキュメントを飛ばす。作成・書き込みはドキュメントごとに記録する。
+    """
+    single = len(targets) == 1
+    steps = []
+    lookups = {} # (STEP, 検索条件) -> STEP名
+    plan = {}
+
+    for target in targets:
+        names = {}
+        for kind, (func, attr) in _LOOKUP_STEPS.items():
+            value = getattr(target, attr)
+            if (kind, value) not in lookups:
+                name = kind if single else f"{kind}[{value}]"
+                lookups[(kind, value)] = name
+                steps.append(WorkflowStep(name, lambda r, func=func, value=value: func(value),
+                                          check=_check_text_output, coalesce_key=(kind, value)))
+            names[kind] = lookups[(kind, value)]
+        names["STEP4"] = "STEP4" if single else f"STEP4[{target.name}]"
+        names["STEP5"] = "STEP5" if single else f"STEP5[{target.name}]"
+        plan[target.name] = names
+
+    for target in targets:
+        names = plan[target.name]
+        # 出力先が複数の場合、作成・書き込み済みのドキュメントは出力先ごとに記録する
+        target_checkpoint = None
+        if checkpoint is not None:
+            target_checkpoint = checkpoint if single else checkpoint.for_target(target.name)
+
+        def step4(r, target=target, target_checkpoint=target_checkpoint):
+            if target_checkpoint is None:
+                return step4_duplicate_document(target.number_of_copies, template_doc_id=target.template_doc_id)
+            return step4_duplicate_document(
+                target.number_of_copies,
+                existing_files=target_checkpoint.created_documents(),
+                on_copied=target_checkpoint.record_created_document,
+                template_doc_id=target.template_doc_id,
+            )
+
+        def step5(r, target=target, names=names, target_checkpoint=target_checkpoint):
+            args = (r[names["STEP4"]][1], r[names["STEP1"]], r[names["STEP2"]], r[names["STEP3"]])
+            if target_checkpoint is None:
+                return step5_write_info_to_documents(*args, template_doc_id=target.template_doc_id)
+            return step5_write_info_to_documents(
+                *args,
+                written_doc_ids=target_checkpoint.written_documents(),
+                on_written=target_checkpoint.record_written_document,
+                template_doc_id=target.template_doc_id,
+            )
+
+        steps.append(WorkflowStep(names["STEP4"], step4, check=_check_step4_output))
+        steps.append(WorkflowStep(
+            names["STEP5"],
+            step5,
+            depends_on=(names["STEP1"], names["STEP2"], names["STEP3"], names["STEP4"]),
+            check=_check_step5_output,
+        ))
+    # 依存先が先に定義されているよう、STEP5は全てのSTEP1〜4の後に並べる
+    steps.sort(key=lambda step: step.name.startswith("STEP5"))
+    return steps, plan
+
+def build_workflow_steps(number_of_copies: int, checkpoint=None):
+    """execute_workflow用 (.envの設定の出力先1つ) のSTEP定義を返す。"""
+    steps, _ = build_target_steps([WorkflowTarget("default", number_of_copies)], checkpoint)
+    return steps
+
+def _target_details(results: dict, names: dict) -> dict:
+    step4_output_str, duplicated_doc_ids = results[names["STEP4"]]
+    return {
+        "step1_output": results[names["STEP1"]],
+        "step2_output": results[names["STEP2"]],
+        "step3_output": results[names["STEP3"]],
+        "step4_output": step4_output_str,
+        "step4_duplicated_ids": duplicated_doc_ids, # デバッグ用にIDも返す
+        "step5_final_message": results[names["STEP5"]],
+    }
+
+async def run_workflow(number_of_copies: int, on_event=None, idempotency_key: str | None = None) -> dict:
+    """
+    STEP1〜5を依存関係に従って実行し、APIレスポンスの details 部分を返す。
+    STEPが失敗した場合は StepError を送出する。
+    on_event を指定すると、各STEPの開始・完了・失敗時にイベント(dict)が渡される。
+    idempotency_key を指定すると実行を記録し、同じキーの再実行は最初の未完了のSTEPから再開する
+    (キーが別の複製数で使われている場合や、同じキーの実行が進行中の場合は IdempotencyKeyConflict)。
+    """
+    target = WorkflowTarget("default", number_of_copies)
+    details = await _run_targets([target], on_event, idempotency_key, {"number_of_copies": number_of_copies})
+    return details[target.name]
+
+async def run_workflow_targets(targets: list, on_event=None, idempotency_key: str | None = None) -> dict:
+    """
+    複数の出力先 (WorkflowTarget) のワークフローを1回の実行でまとめて行い、{出力先名: details} を返す。
+    STEP1〜3は同じ検索条件の出力先で共有し、出力先ごとのSTEP4/STEP5は並行に実行する。
+    いずれかの出力先のSTEPが失敗した場合は、他の出力先のSTEPが終わるのを待ってから StepError を送出する
+    (idempotency_key を指定していれば、再実行時は失敗した出力先の続きだけを実行する)。
+    """
+    validate_targets(targets)
+    params = {"targets": [target.to_dict() for target in targets]}
+    return await _run_targets(targets, on_event, idempotency_key, params)
+
+async def _run_targets(targets: list, on_event, idempotency_key: str | None, params: dict) -> dict:
+    if not idempotency_key:
+        return await _run_steps(targets, on_event, None)
+
+    log = get_checkpoint_log()
+    with log.hold(idempotency_key):
+        resumed = await asyncio.to_thread(log.start_run, idempotency_key, params)
+        if resumed:
+            print(f"冪等キー {idempotency_key} の前回の実行を再開します。")
+        checkpoint = RunCheckpoint(log, idempotency_key)
+        try:
+            details = await _run_steps(targets, on_event, checkpoint)
+        except BaseException:
+            await asyncio.to_thread(log.finish_run, idempotency_key, "failed")
+            raise
+        await asyncio.to_thread(log.finish_run, idempotency_key, "succeeded")
+        return details
+
+async def _run_steps(targets: list, on_event, checkpoint) -> dict:
+    steps, plan = build_target_steps(targets, checkpoint)
+    scheduler = StepScheduler(steps, get_workflow_executor(), on_event=on_event, checkpoint=checkpoint)
+    try:
+        results = await scheduler.run()
+    except Exception:
+        # STEPのエラー以外 (予期しない例外) で止まった場合も、使われないドキュメントを片付ける
+        if checkpoint is None:
+            await asyncio.to_thread(_trash_orphan_documents, scheduler.results, scheduler.failed_outputs, plan)
+        raise
+    return {name: _target_details(results, names) for name, names in plan.items()}
+
+def _trash_orphan_documents(results: dict, failed_outputs: dict, plan: dict):
+    """
+    STEP5が実行されなかった出力先について、STEP4で作成したドキュメントをゴミ箱へ移す。
+    対象は、STEP1〜3のいずれかが失敗した出力先と、STEP4が一部だけ失敗した出力先 (作成できた分)。
+    """
+    orphan_ids = []
+    for names in plan.values():
+        lookups_done = all(names[kind] in results for kind in _LOOKUP_STEPS)
+        if names["STEP4"] in results and not lookups_done:
+            orphan_ids.extend(results[names["STEP4"]][1])
+        partial = failed_outputs.get(names["STEP4"])
+        if isinstance(partial, tuple):
+            orphan_ids.extend(partial[1])
+    if not orphan_ids:
+        return
+    trashed = trash_files(orphan_ids)
+    ORPHANS_TRASHED.inc(trashed)
+    print(f"ワークフローが失敗したため、STEP4で作成した {len(orphan_ids)} 個中 {trashed} 個のドキュメントをゴミ箱へ移しました。")
@@ -0,0 +1,200 @@
+"""
+ワークフローの実行記録 (チェックポイント)。
+/api/execute_workflow などで冪等キー (idempotency_key) を指定すると、そのキーの実行について
+・各STEPの出力 (完了したSTEPだけ)
+・STEP4で作成 (複製・プールから移動) したドキュメント
+・STEP5で書き込みが完了したドキュメント
+をSQLiteファイル (WORKFLOW_CHECKPOINT_SQLITE_PATH) に記録する。
+同じキーで再実行すると、完了済みのSTEPは記録した出力を使って実行せず、
+STEP4は足りない分だけ複製し、STEP5はまだ書き込んでいないドキュメントだけに書き込む。
+全STEPが完了したキーで再実行した場合は、Google APIを呼ばずに前回と同じ結果を返す。
+"""
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from config import settings
+
+class IdempotencyKeyConflict(ValueError):
+    """冪等キーが別の条件の実行に使われている、または同じキーの実行が進行中の場合に送出する例外。"""
+
+class WorkflowCheckpointLog:
+    """冪等キーごとの実行記録をSQLiteファイルに保存するストア。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._active_keys = set()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS workflow_runs ("
+                " key TEXT PRIMARY KEY, params TEXT NOT NULL, status TEXT NOT NULL,"
+                " created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS workflow_step_outputs ("
+                " key TEXT NOT NULL, step TEXT NOT NULL, output TEXT NOT NULL, completed_at REAL NOT NULL,"
+                " PRIMARY KEY (key, step))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS workflow_documents ("
+                " key TEXT NOT NULL, doc_id TEXT NOT NULL, file TEXT NOT NULL, seq INTEGER NOT NULL,"
+                " written_at REAL, PRIMARY KEY (key, doc_id))"
+            )
+
+    @contextmanager
+    def _connect(self):
+        # 接続はスレッド間で共有せず、操作ごとに開いてコミット後に閉じる
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def start_run(self, key: str, params: dict) -> bool:
+        """
+        キーの実行記録を作る。既に記録があれば再開として True を返す。
+        同じキーが別の条件 (params) で使われていれば IdempotencyKeyConflict を送出する。
+        """
+        params_json = json.dumps(params, sort_keys=True)
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT params FROM workflow_runs WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                conn.execute(
+                    "INSERT INTO workflow_runs (key, params, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, params_json, "running", now, now),
+                )
+                return False
+            if row[0] != params_json:
+                raise IdempotencyKeyConflict(f"冪等キー {key} は別の条件 ({row[0]}) の実行に使われています。")
+            conn.execute("UPDATE workflow_runs SET status = ?, updated_at = ? WHERE key = ?", ("running", now, key))
+            return True
+
+    def finish_run(self, key: str, status: str):
+        with self._lock, self._connect() as conn:
+            conn.execute("UPDATE workflow_runs SET status = ?, updated_at = ? WHERE key = ?", (status, time.time(), key))
+
+    def get_run(self, key: str) -> dict | None:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT key, params, status, created_at, updated_at FROM workflow_runs WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            steps = [step for (step,) in conn.execute(
+                "SELECT step FROM workflow_step_outputs WHERE key = ? ORDER BY completed_at", (key,))]
+            (created, written) = conn.execute(
+                "SELECT COUNT(*), COUNT(written_at) FROM workflow_documents WHERE key = ?", (key,)
+            ).fetchone()
+        return {
+            "key": row[0],
+            "params": json.loads(row[1]),
+            "status": row[2],
+            "created_at": row[3],
+            "updated_at": row[4],
+            "completed_steps": steps,
+            "created_documents": created,
+            "written_documents": written,
+        }
+
+    @contextmanager
+    def hold(self, key: str):
+        """同じキーの実行がこのプロセスで同時に走らないようにする。"""
+        with self._lock:
+            if key in self._active_keys:
+                raise IdempotencyKeyConflict(f"冪等キー {key} のワークフローは実行中です。")
+            self._active_keys.add(key)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active_keys.discard(key)
+
+    def step_output(self, key: str, step: str):
+        """(記録があるか, 出力) を返す。"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT output FROM workflow_step_outputs WHERE key = ? AND step = ?", (key, step)
+            ).fetchone()
+        return (True, json.loads(row[0])) if row else (False, None)
+
+    def complete_step(self, key: str, step: str, output):
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO workflow_step_outputs (key, step, output, completed_at) VALUES (?, ?, ?, ?)",
+                (key, step, json.dumps(output, ensure_ascii=False), time.time()),
+            )
+
+    def record_created_document(self, key: str, file: dict):
+        with self._lock, self._connect() as conn:
+            (last_seq,) = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM workflow_documents WHERE key = ?", (key,)
+            ).fetchone()
+            conn.execute(
+                "INSERT OR IGNORE INTO workflow_documents (key, doc_id, file, seq, written_at) VALUES (?, ?, ?, ?, NULL)",
+                (key, file["id"], json.dumps(file, ensure_ascii=False), last_seq + 1),
+            )
+
+    def created_documents(self, key: str) -> list:
+        """作成済みのドキュメント ({id, name, ...}) を作成順に返す。"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT file FROM workflow_documents WHERE key = ? ORDER BY seq", (key,)
+            ).fetchall()
+        return [json.loads(file) for (file,) in rows]
+
+    def record_written_document(self, key: str, doc_id: str):
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE workflow_documents SET written_at = ? WHERE key = ? AND doc_id = ?", (time.time(), key, doc_id)
+            )
+
+    def written_documents(self, key: str) -> set:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT doc_id FROM workflow_documents WHERE key = ? AND written_at IS NOT NULL", (key,)
+            ).fetchall()
+        return {doc_id for (doc_id,) in rows}
+
+class RunCheckpoint:
+    """1つの冪等キーの実行記録。StepSchedulerとSTEP4/STEP5に渡して使う。"""
+
+    def __init__(self, log: WorkflowCheckpointLog, key: str):
+        self.log = log
+        self.key = key
+
+    def load_step(self, step: str):
+        return self.log.step_output(self.key, step)
+
+    def save_step(self, step: str, output):
+        self.log.complete_step(self.key, step, output)
+
+    def created_documents(self) -> list:
+        return self.log.created_documents(self.key)
+
+    def record_created_document(self, file: dict):
+        self.log.record_created_document(self.key, file)
+
+    def written_documents(self) -> set:
+        return self.log.written_documents(self.key)
+
+    def record_written_document(self, doc_id: str):
+        self.log.record_written_document(self.key, doc_id)
+
+    def for_target(self, target_name: str):
+        """複数の出力先をまとめて実行する時に、出力先ごとのドキュメントを記録するための実行記録を返す。"""
+        return RunCheckpoint(self.log, f"{self.key}/{target_name}")
+
+_checkpoint_log = None
+_checkpoint_log_lock = threading.Lock()
+
+def get_checkpoint_log() -> WorkflowCheckpointLog:
+    global _checkpoint_log
+    with _checkpoint_log_lock:
+        if _checkpoint_log is None:
+            _checkpoint_log = WorkflowCheckpointLog(settings.workflow_checkpoint_sqlite_path)
+        return _checkpoint_log
@@ -0,0 +1,88 @@
+"""
+ワークフローの出力先 (番組) の定義。
+1回の実行で複数の番組の指示書を作る場合、番組ごとにテンプレート・複製数・素材フォルダ・Gmailの検索クエリを指定する。
+指定しなかった項目は .env の設定 (DOC_ID_FOR_STEP4 / DRIVE_FOLDER_ID_STEP2 / GMAIL_QUERY_AUDIO / GMAIL_QUERY_SCRIPT) を使う。
+定義はリクエストの targets か、WORKFLOW_DEFINITION_PATH のJSONファイルで渡す。
+
+JSONファイルの形式:
+    {"targets": [
+        {"name": "番組A", "number_of_copies": 3, "template_doc_id": "...", "drive_folder_id": "..."},
+        {"name": "番組B", "number_of_copies": 1, "gmail_query_script": "番組Bの台本について"}
+    ]}
+"""
+import json
+
+from config import settings
+
+class WorkflowTarget:
+    """1つの番組の出力先。STEP1〜3の検索条件と、STEP4/STEP5のテンプレート・複製数を持つ。"""
+
+    FIELDS = ("name", "number_of_copies", "template_doc_id", "drive_folder_id", "gmail_query_audio", "gmail_query_script")
+    REQUIRED_FIELDS = ("name", "number_of_copies")
+
+    def __init__(self, name: str, number_of_copies: int, template_doc_id: str | None = None,
+                 drive_folder_id: str | None = None, gmail_query_audio: str | None = None,
+                 gmail_query_script: str | None = None):
+        self.name = name
+        self.number_of_copies = number_of_copies
+        self.template_doc_id = template_doc_id or settings.doc_id_for_step4
+        self.drive_folder_id = drive_folder_id or settings.drive_folder_id_step2
+        self.gmail_query_audio = gmail_query_audio or settings.gmail_query_audio
+        self.gmail_query_script = gmail_query_script or settings.gmail_query_script
+
+    @classmethod
+    def from_dict(cls, data: dict, index: int = 0):
+        """
+        dict (リクエストやJSONファイルの1要素) から出力先を作る。
+        必須項目 (name, number_of_copies) の欠落や型の誤りは、何番目の出力先かを含めた ValueError にする。
+        """
+        where = f"{index + 1}番目の出力先"
+        if not isinstance(data, dict):
+            raise ValueError(f"{where}の定義はオブジェクトである必要があります。")
+        unknown = set(data) - set(cls.FIELDS)
+        if unknown:
+            raise ValueError(f"{where}の定義に不明な項目があります: {', '.join(sorted(unknown))}")
+        missing = [field for field in cls.REQUIRED_FIELDS if field not in data]
+        if missing:
+            raise ValueError(f"{where}の定義に必須の項目がありません: {', '.join(missing)}")
+        if not isinstance(data["name"], str):
+            raise ValueError(f"{where}の name は文字列である必要があります。")
+        # bool は int のサブクラスのため明示的に除く
+        copies = data["number_of_copies"]
+        if not isinstance(copies, int) or isinstance(copies, bool):
+            raise ValueError(f"{where}の number_of_copies は整数である必要があります。")
+        for field in cls.FIELDS[len(cls.REQUIRED_FIELDS):]:
+            if data.get(field) is not None and not isinstance(data[field], str):
+                raise ValueError(f"{where}の {field} は文字列である必要があります。")
+        return cls(**data)
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+def validate_targets(targets: list):
+    """出力先の定義を検証し、問題があれば ValueError を送出する。"""
+    if not targets:
+        raise ValueError("出力先が1つも定義されていません。")
+    names = set()
+    for target in targets:
+        if not target.name:
+            raise ValueError("出力先の name は必須です。")
+        if target.name in names:
+            raise ValueError(f"出力先の name が重複しています: {target.name}")
+        names.add(target.name)
+        if target.number_of_copies <= 0:
+            raise ValueError(f"{target.name}: 複製数は1以上である必要があります。")
+
+def load_workflow_definition(path: str | None = None) -> list:
+    """JSONファイル (デフォルトは WORKFLOW_DEFINITION_PATH) から出力先の定義を読み込む。"""
+    path = path or settings.workflow_definition_path
+    if not path:
+        raise ValueError("WORKFLOW_DEFINITION_PATH が設定されていません。")
+    with open(path, encoding="utf-8") as f:
+        definition = json.load(f)
+    items = definition.get("targets", []) if isinstance(definition, dict) else None
+    if not isinstance(items, list):
+        raise ValueError(f"{path} の targets はリストである必要があります。")
+    targets = [WorkflowTarget.from_dict(item, index) for index, item in enumerate(items)]
+    validate_targets(targets)
+    return targets
@@ -1,6 +1,75 @@
 'use client';
 import { useState } from 'react';
 
+const API_BASE_URL = 'https://aim-instructionsdocs-gen.vercel.app';
+const JOB_POLL_INTERVAL_MS = 2000; // ジョブ状態のポーリング間隔
+
+const STEP_STATUS_LABELS = {
+  queued: '待機中',
+  running: '実行中',
+  succeeded: '完了',
+  failed: '失敗',
+};
+
+// NEXT_PUBLIC_WORKFLOW_JOB_MODE=true の場合は /api/jobs でジョブを登録して進捗をポーリングする。
+// ジョブはバックエンドのプロセス内で実行されるため、uvicornなど常駐するプロセスで
+// JOB_MODE_ENABLED=true にした時だけ使う (Vercelのサーバーレス環境では同期実行のまま)。
+const WORKFLOW_JOB_MODE = process.env.NEXT_PUBLIC_WORKFLOW_JOB_MODE === 'true';
+
+// /api/execute_workflow でワークフローを同期実行し、結果を返す
+async function executeWorkflowSync(numberOfCopies) {
+  const response = await fetch(`${API_BASE_URL}/api/execute_workflow`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify({ number_of_copies: parseInt(numberOfCopies, 10) }), // 数値型で送信
+  });
+  const data = await response.json();
+  if (!response.ok) {
+    throw new Error(data.detail || 'ワークフローの実行に失敗しました。');
+  }
+  return data;
+}
+
+// ジョブを登録して完了までポーリングし、結果を返す。
+// バックエンドでジョブモードが無効 (503) の場合は null を返し、呼び出し側で同期実行に切り替える
+async function executeWorkflowJob(numberOfCopies, onProgress) {
+  const response = await fetch(`${API_BASE_URL}/api/jobs`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify({ number_of_copies: parseInt(numberOfCopies, 10) }), // 数値型で送信
+  });
+  if (response.status === 503 || response.status === 404) {
+    return null;
+  }
+  const data = await response.json();
+  if (!response.ok) {
+    throw new Error(data.detail || 'ワークフローの実行に失敗しました。');
+  }
+
+  // ジョブが終わるまで状態をポーリングし、STEPごとの進捗を表示する
+  while (true) {
+    await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+    const jobResponse = await fetch(`${API_BASE_URL}/api/jobs/${data.job_id}`);
+    const job = await jobResponse.json();
+
+    if (!jobResponse.ok) {
+      throw new Error(job.detail || 'ワークフローの状態を取得できませんでした。');
+    }
+
+    onProgress(job.steps);
+    if (job.status === 'succeeded') {
+      return job.result;
+    }
+    if (job.status === 'failed') {
+      throw new Error(job.error || 'ワークフローの実行に失敗しました。');
+    }
+  }
+}
+
 export default function Home() {
   // Google連携ワークフロー用の状態変数のみ残す
   const [numberOfCopies, setNumberOfCopies] = useState(1); // デフォルト値を1に設定
@@ -8,6 +77,7 @@ export default function Home() {
   const [workflowIsLoading, setWorkflowIsLoading] = useState(false);
   const [workflowResults, setWorkflowResults] = useState(null);
   const [workflowError, setWorkflowError] = useState('');
+  const [workflowProgress, setWorkflowProgress] = useState(null); // 各STEPの進捗 (ジョブAPIのsteps)
 
   const handleInputChange = (e) => {
     setInputValue(e.target.value);
@@ -29,6 +99,7 @@ export default function Home() {
     setWorkflowIsLoading(true);
     setWorkflowResults(null);
     setWorkflowError('');
+    setWorkflowProgress(null);
 
     if (numberOfCopies <= 0) {
         setWorkflowError('複製数は1以上である必要があります。');
@@ -37,21 +108,11 @@ export default function Home() {
     }
 
     try {
-      const response = await fetch('https://aim-instructionsdocs-gen.vercel.app/api/execute_workflow', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({ number_of_copies: parseInt(numberOfCopies, 10) }), // 数値型で送信
-      });
-
-      const data = await response.json();
-
-      if (!response.ok) {
-        throw new Error(data.detail || 'ワークフローの実行に失敗しました。');
-      }
-      
-      setWorkflowResults(data);
+      // ジョブモード (常駐するバックエンドでのみ有効) でなければ、ワークフローの完了まで1回のリクエストで待つ
+      const results = WORKFLOW_JOB_MODE
+        ? await executeWorkflowJob(numberOfCopies, setWorkflowProgress)
+        : null;
+      setWorkflowResults(results ?? await executeWorkflowSync(numberOfCopies));
     } catch (error) {
       console.error('Workflow Error:', error);
       setWorkflowError(error.message || 'ワークフローの実行中に不明なエラーが発生しました。');
@@ -105,6 +166,20 @@ export default function Home() {
               </button>
             </div>
 
+            {workflowProgress && Object.keys(workflowProgress).length > 0 && (
+              <ul className="mt-4 p-3 bg-gray-50 border border-gray-200 rounded-md text-sm text-gray-700 space-y-1">
+                {Object.entries(workflowProgress).map(([stepName, step]) => (
+                  <li key={stepName} className="flex justify-between">
+                    <span>{stepName}</span>
+                    <span>
+                      {STEP_STATUS_LABELS[step.status] || step.status}
+                      {step.elapsed_seconds != null && ` (${step.elapsed_seconds.toFixed(1)}秒)`}
+                    </span>
+                  </li>
+                ))}
+              </ul>
+            )}
+
             {workflowError && (
               <div role="alert" className="mt-4 p-3 bg-red-50 border border-red-200 text-red-700 rounded-md">
                 <p className="font-medium">エラーが発生しました:</p>